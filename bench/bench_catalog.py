@@ -0,0 +1,135 @@
+"""
+`products` filtering through SQL versus the NumPy catalog index.
+
+    $ python bench/bench_catalog.py --products 1000000 --repeat 5
+
+Fills a scratch SQLite database with random products, then times a set of
+filter + sort + page queries through both paths of the resolver logic:
+SQL (filter/order/limit in SQLite, ORM hydration) and the column store
+(vectorized masks, hydration of the page only). Requires NumPy.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from storeify import catalog, db  # noqa: E402
+from storeify.catalog import ProductSort  # noqa: E402
+from storeify.config import Config  # noqa: E402
+from storeify.models import Product  # noqa: E402
+
+QUERIES = [
+    ('in stock, by price, first 50',
+     dict(inventory_minimum=1, sort=ProductSort.PRICE.value, first=50)),
+    ('purchasable USD 10-20$, first 50',
+     dict(can_purchase=True, currency='USD', price_minimum=1000,
+          price_maximum=2000, first=50)),
+    ('top inventory, first 20',
+     dict(sort=ProductSort.INVENTORY_COUNT_DESC.value, first=20)),
+    ('exact title', dict(title='Product 4242')),
+]
+
+
+def populate(count):
+    db.create_db()
+    engine = db.get_db_session().get_bind()
+    rng = random.Random(42)
+    batch = []
+    for i in range(count):
+        batch.append(dict(title='Product %d' % i,
+                          price=rng.randint(1, 100000),
+                          currency=rng.choice(['USD', 'CAD', 'EUR']),
+                          inventory_count=rng.randint(0, 500),
+                          can_purchase=rng.random() < 0.9,
+                          version=1))
+        if len(batch) == 50000:
+            engine.execute(Product.__table__.insert(), batch)
+            batch = []
+    if batch:
+        engine.execute(Product.__table__.insert(), batch)
+
+
+def sql_path(session, id=None, title=None, inventory_minimum=None,
+             can_purchase=None, price_minimum=None, price_maximum=None,
+             currency=None, sort=None, first=None, offset=None):
+    # Mirrors the SQL branch of SQLAlchemyRepository.find_products
+    from storeify.repository import PRODUCT_SORT_ORDER
+    query = session.query(Product)
+    if title is not None:
+        query = query.filter_by(title=title)
+    if inventory_minimum is not None:
+        query = query.filter(Product.inventory_count >= inventory_minimum)
+    if can_purchase is not None:
+        query = query.filter_by(can_purchase=can_purchase)
+    if price_minimum is not None:
+        query = query.filter(Product.price >= price_minimum)
+    if price_maximum is not None:
+        query = query.filter(Product.price <= price_maximum)
+    if currency is not None:
+        query = query.filter(Product.currency == currency)
+    if sort is not None:
+        query = query.order_by(*PRODUCT_SORT_ORDER[ProductSort(sort)])
+    if first is not None:
+        query = query.limit(first)
+    return query.all()
+
+
+def index_path(session, **kwargs):
+    index = catalog.get_catalog_index(session)
+    return catalog.hydrate_products(session.query(Product),
+                                    index.query(**kwargs))
+
+
+def best_of(repeat, fn, *args, **kwargs):
+    best = None
+    for _ in range(repeat):
+        db.get_db_session().expunge_all()
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    if catalog.numpy is None:
+        sys.exit('NumPy is required for this benchmark.')
+
+    db_path = tempfile.mkstemp(suffix='.sqlite3')[1]
+    Config.DATABASE_URI = 'sqlite:///' + db_path
+    Config.CATALOG_INDEX_MAX_AGE = float('inf')
+    try:
+        start = time.perf_counter()
+        populate(args.products)
+        print('populated %d products in %.1fs' % (
+            args.products, time.perf_counter() - start))
+        session = db.get_db_session()
+
+        start = time.perf_counter()
+        catalog.get_catalog_index(session)
+        print('built index in %.1fs\n' % (time.perf_counter() - start))
+
+        print('%-36s %10s %10s %8s' % ('query', 'sql ms', 'index ms',
+                                       'speedup'))
+        for name, kwargs in QUERIES:
+            assert [p.id for p in sql_path(session, **kwargs)] == \
+                [p.id for p in index_path(session, **kwargs)], name
+            sql = best_of(args.repeat, sql_path, session, **kwargs)
+            index = best_of(args.repeat, index_path, session, **kwargs)
+            print('%-36s %10.2f %10.2f %7.1fx' % (
+                name, sql * 1000, index * 1000, sql / index))
+    finally:
+        db.dispose_db_engine()
+        os.remove(db_path)
+
+
+if __name__ == '__main__':
+    main()
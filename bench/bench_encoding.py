@@ -0,0 +1,75 @@
+"""
+Encode time and bytes on the wire for large `products` responses.
+
+    $ python bench/bench_encoding.py --sizes 1000 10000
+
+Builds execution results shaped like a `products { id title price currency
+inventoryCount canPurchase }` response and, for each available serializer
+and compressor in storeify.encoding, reports the encode (and compress)
+time and the resulting size.
+"""
+import argparse
+import base64
+import os
+import random
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from storeify import encoding  # noqa: E402
+
+
+def products_result(count):
+    rng = random.Random(0)
+    products = []
+    for i in range(1, count + 1):
+        products.append(OrderedDict([
+            ('id', base64.b64encode(('Product:%d' % i).encode()).decode()),
+            ('title', 'Product %d' % i),
+            ('price', rng.randint(1, 100000)),
+            ('currency', rng.choice(['USD', 'CAD', 'EUR'])),
+            ('inventoryCount', rng.randint(0, 500)),
+            ('canPurchase', rng.random() < 0.9),
+        ]))
+    return {'data': OrderedDict([('products', products)])}
+
+
+def best_of(repeat, fn, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, value
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print('%8s %-8s %-6s %10s %12s' % ('products', 'encoder', 'comp',
+                                        'ms', 'bytes'))
+    for size in args.sizes:
+        result = products_result(size)
+        for name in sorted(encoding.SERIALIZERS):
+            serializer = encoding.SERIALIZERS[name]
+            seconds, body = best_of(args.repeat, serializer, result)
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            print('%8d %-8s %-6s %10.2f %12d' % (size, name, '-',
+                                                 seconds * 1000, len(body)))
+            for comp in sorted(encoding.COMPRESSORS):
+                comp_seconds, compressed = best_of(
+                    args.repeat, encoding.COMPRESSORS[comp], body)
+                print('%8d %-8s %-6s %10.2f %12d' % (
+                    size, name, comp, (seconds + comp_seconds) * 1000,
+                    len(compressed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Per-call overhead of the primary key lookups behind get_product, get_cart
+and get_cart_item: Query.get against the baked get_by_key.
+
+    $ python bench/bench_lookups.py --calls 20000 --repeat 5
+
+Fills a scratch SQLite database with a few hundred products, carts and cart
+items, then looks them up by the string keys the API decodes from global
+IDs (so, as in a request, every call reaches the database) and reports the
+microseconds per call of each path.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from storeify import db  # noqa: E402
+from storeify.config import Config  # noqa: E402
+from storeify.models import Cart, CartItem, Product  # noqa: E402
+from storeify.repository import get_by_key  # noqa: E402
+
+ROWS = 500
+
+
+def populate():
+    db.create_db()
+    engine = db.get_db_session().get_bind()
+    engine.execute(Product.__table__.insert(), [
+        dict(title='Product %d' % i, price=100 + i, currency='USD',
+             inventory_count=10, can_purchase=True, version=1)
+        for i in range(ROWS)])
+    engine.execute(Cart.__table__.insert(), [
+        dict(userid=i, currency=0, version=1) for i in range(ROWS)])
+    engine.execute(CartItem.__table__.insert(), [
+        dict(product_id=i + 1, cart_id=i + 1, quantity=1, userid=i,
+             version=1) for i in range(ROWS)])
+
+
+def query_get(session, model, key):
+    return session.query(model).get(key)
+
+
+def best_of(repeat, calls, fn, session, model):
+    keys = [str(i % ROWS + 1) for i in range(calls)]
+    best = None
+    for _ in range(repeat):
+        session.expunge_all()
+        start = time.perf_counter()
+        for key in keys:
+            fn(session, model, key)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    db_path = tempfile.mkstemp(suffix='.sqlite3')[1]
+    Config.DATABASE_URI = 'sqlite:///' + db_path
+    try:
+        populate()
+        session = db.get_db_session()()
+
+        print('%-10s %14s %14s %8s' % ('model', 'query.get us',
+                                       'baked us', 'speedup'))
+        for model in (Product, Cart, CartItem):
+            for key in ('1', str(ROWS), 'nope'):
+                assert query_get(session, model, key) is \
+                    get_by_key(session, model, key), (model, key)
+            plain = best_of(args.repeat, args.calls, query_get, session,
+                            model)
+            baked = best_of(args.repeat, args.calls, get_by_key, session,
+                            model)
+            print('%-10s %14.1f %14.1f %7.1fx' % (
+                model.__name__, plain * 1e6, baked * 1e6, plain / baked))
+    finally:
+        db.dispose_db_engine()
+        os.remove(db_path)
+
+
+if __name__ == '__main__':
+    main()
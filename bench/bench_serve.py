@@ -0,0 +1,107 @@
+"""
+Throughput of storeify.serve as the number of worker processes grows.
+
+    $ python bench/bench_serve.py --workers 1 2 4 --clients 16 --duration 10
+
+For every worker count a fresh server is started on a scratch SQLite
+database loaded with test/products.csv, then a pool of client processes
+hammer the `products` query for --duration seconds. Requests/second and the
+scaling efficiency relative to a single worker are printed.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from storeify import db, util  # noqa: E402
+from storeify.config import Config  # noqa: E402
+
+QUERY = json.dumps({'query': '{ products { id title price currency } }'})
+
+
+def run_server(port, workers):
+    from storeify.app import create_app
+    from storeify.serve import Arbiter
+    Arbiter(create_app(debug=False), port=port, workers=workers).run()
+
+
+def run_client(url, duration, counter):
+    data = QUERY.encode('utf-8')
+    done = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        req = urllib.request.Request(
+            url, data=data, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req) as resp:
+            resp.read()
+        done += 1
+    with counter.get_lock():
+        counter.value += done
+
+
+def wait_until_up(url, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            run_client(url, 0.01, multiprocessing.Value('i', 0))
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start')
+
+
+def bench(port, workers, clients, duration):
+    server = multiprocessing.Process(target=run_server, args=(port, workers))
+    server.start()
+    url = 'http://127.0.0.1:%d/graphql' % port
+    try:
+        wait_until_up(url)
+        counter = multiprocessing.Value('i', 0)
+        procs = [multiprocessing.Process(target=run_client,
+                                         args=(url, duration, counter))
+                 for _ in range(clients)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        return counter.value / float(duration)
+    finally:
+        os.kill(server.pid, signal.SIGTERM)
+        server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, multiprocessing.cpu_count()])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    db_path = tempfile.mkstemp(suffix='.sqlite3')[1]
+    Config.DATABASE_URI = 'sqlite:///' + db_path
+    db.create_db()
+    util.load_test_data(os.path.join(os.path.dirname(__file__), '..',
+                                     'test', 'products.csv'))
+    db.dispose_db_engine()
+
+    print('%8s %12s %10s' % ('workers', 'req/s', 'scaling'))
+    baseline = None
+    for workers in sorted(set(args.workers)):
+        rps = bench(args.port, workers, args.clients, args.duration)
+        baseline = baseline or rps / workers
+        print('%8d %12.1f %9.0f%%' % (workers, rps,
+                                       100 * rps / (baseline * workers)))
+    os.remove(db_path)
+
+
+if __name__ == '__main__':
+    main()
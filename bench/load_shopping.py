@@ -0,0 +1,425 @@
+"""
+Concurrent virtual shoppers running the real shopping flow over /graphql.
+
+    $ python bench/load_shopping.py --workers 4 --shoppers 32 --rate 50 \
+          --duration 30 --mix 50:30:20 --skew 1.2
+
+Unless --url points at a running server, a fresh storeify.serve server is
+started on a scratch SQLite database holding --products random products
+with --inventory units each. Shoppers then arrive at --rate per second
+(Poisson arrivals; 0 keeps --shoppers of them shopping back to back) and,
+according to --mix (browse:cart:purchase weights), either
+
+    browse      query products
+    cart        ...then cartItemCreate for a few products, cartCreate,
+                cartAddItems and query the cart total
+    purchase    ...then cartPurchase
+
+Products are picked with a Zipf --skew over a random ranking, so a few hot
+products draw most of the carts and sell out. At most --shoppers shop at
+once; later arrivals wait for one to finish.
+
+The report gives throughput, latency percentiles per operation, and errors
+by class: out of stock (including "only N units left" and unpurchasable
+items), conflicts retried to exhaustion, database lock timeouts, HTTP
+failures and anything else. Finally every product's inventory is compared
+with what it started at minus what the shoppers bought: a negative count or
+a shortfall means oversold stock. A purchase whose response never arrived
+(a timeout or dropped connection) may still have committed; such purchases
+are counted as unknown and settled by asking whether their cart was
+purchased before the check. With --url, other traffic against the same
+server shows up there too.
+
+Every shopper draws from its own random.Random(--seed + n), n being its
+number, and the arrivals from random.Random(--seed).
+"""
+import argparse
+import bisect
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from storeify import db  # noqa: E402
+from storeify.config import Config  # noqa: E402
+from storeify.repository import get_repository  # noqa: E402
+
+FLOWS = ('browse', 'cart', 'purchase')
+ERROR_CLASSES = [
+    ('out_of_stock', ('out of stock', 'units left', 'cannot be purchased')),
+    ('conflict', ('conflicted with concurrent updates',
+                  'modified concurrently')),
+    ('lock_timeout', ('database is locked', 'lock wait timeout',
+                      'lock timeout', 'timed out')),
+]
+
+BROWSE = '{ products(inventoryMinimum: 1, first: 20) { id title price } }'
+CART_ITEM_CREATE = '''
+    mutation($product: ID!, $quantity: Int!, $userid: Int) {
+        cartItemCreate(productID: $product, quantity: $quantity,
+                       userid: $userid) { cartItem { id } }
+    }'''
+CART_CREATE = '''
+    mutation($userid: Int!) {
+        cartCreate(userid: $userid, currency: USD, cartItems: []) {
+            cart { id }
+        }
+    }'''
+CART_ADD_ITEMS = '''
+    mutation($cart: ID!, $items: [ID!]!) {
+        cartAddItems(cartID: $cart, cartItems: $items) { ok }
+    }'''
+CART_TOTAL = 'query($cart: ID!) { cart(id: $cart) { total } }'
+CART_PURCHASE = '''
+    mutation($cart: ID!) {
+        cartPurchase(cartID: $cart) { order { id } }
+    }'''
+CART_PURCHASED = 'query($cart: ID!) { cart(id: $cart) { purchasedAt } }'
+INVENTORY = '{ products { id inventoryCount } }'
+
+
+class OperationFailed(Exception):
+    def __init__(self, error_class, message):
+        super(OperationFailed, self).__init__(message)
+        self.error_class = error_class
+
+
+def classify(message):
+    message = message.lower()
+    for error_class, fragments in ERROR_CLASSES:
+        if any(fragment in message for fragment in fragments):
+            return error_class
+    return 'other'
+
+
+def post(url, query, variables=None, timeout=30):
+    data = json.dumps({'query': query, 'variables': variables or {}})
+    req = urllib.request.Request(url, data=data.encode('utf-8'),
+                                 headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            body = resp.read()
+    except urllib.error.HTTPError as e:
+        # Flask-GraphQL answers 400 for some GraphQL errors; keep the body
+        body = e.read()
+        if not body:
+            raise OperationFailed('http', 'HTTP %d' % e.code)
+    except (OSError, urllib.error.URLError) as e:
+        raise OperationFailed('http', str(e))
+    try:
+        result = json.loads(body.decode('utf-8'))
+    except ValueError:
+        raise OperationFailed('http', 'Unparseable response')
+    if result.get('errors'):
+        message = result['errors'][0].get('message', '')
+        raise OperationFailed(classify(message), message)
+    return result['data']
+
+
+class Stats(object):
+    """Latencies and errors per operation, shared by every shopper."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self.flows = defaultdict(int)
+        self.sold = defaultdict(int)
+        # (cart, {product: quantity}) of purchases with no response
+        self.unknown = []
+
+    def call(self, operation, url, query, variables=None):
+        start = time.perf_counter()
+        try:
+            return post(url, query, variables)
+        except OperationFailed as e:
+            with self.lock:
+                self.errors[operation][e.error_class] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.latencies[operation].append(elapsed)
+
+
+class Shopper(object):
+    def __init__(self, url, stats, products, weights, args, number):
+        self.url = url
+        self.stats = stats
+        self.products = products
+        self.cumulative = list(itertools.accumulate(weights))
+        self.flow_weights = list(itertools.accumulate(args.mix))
+        self.args = args
+        # Its own generator, as random.Random is not safe to share between
+        # threads
+        self.rng = random.Random(args.seed + number)
+
+    def pick_product(self):
+        point = self.rng.random() * self.cumulative[-1]
+        return self.products[bisect.bisect(self.cumulative, point)]
+
+    def pick_flow(self):
+        point = self.rng.random() * self.flow_weights[-1]
+        return FLOWS[bisect.bisect(self.flow_weights, point)]
+
+    def shop(self, flow, userid):
+        call = self.stats.call
+        call('products', self.url, BROWSE)
+        if flow == 'browse':
+            return
+
+        picked = {}
+        for _ in range(self.rng.randint(1, self.args.items)):
+            picked[self.pick_product()] = self.rng.randint(
+                1, self.args.quantity)
+        items = []
+        for product, quantity in picked.items():
+            data = call('cartItemCreate', self.url, CART_ITEM_CREATE,
+                        {'product': product, 'quantity': quantity,
+                         'userid': userid})
+            items.append(data['cartItemCreate']['cartItem']['id'])
+        data = call('cartCreate', self.url, CART_CREATE, {'userid': userid})
+        cart = data['cartCreate']['cart']['id']
+        call('cartAddItems', self.url, CART_ADD_ITEMS,
+             {'cart': cart, 'items': items})
+        call('cart.total', self.url, CART_TOTAL, {'cart': cart})
+        if flow == 'purchase':
+            try:
+                call('cartPurchase', self.url, CART_PURCHASE, {'cart': cart})
+            except OperationFailed as e:
+                if e.error_class == 'http':
+                    # The server may have committed it all the same
+                    with self.stats.lock:
+                        self.stats.unknown.append((cart, picked))
+                raise
+            with self.stats.lock:
+                for product, quantity in picked.items():
+                    self.stats.sold[product] += quantity
+
+    def run(self, userid):
+        flow = self.pick_flow()
+        try:
+            self.shop(flow, userid)
+            outcome = flow
+        except OperationFailed:
+            outcome = flow + ' (failed)'
+        with self.stats.lock:
+            self.stats.flows[outcome] += 1
+
+
+def zipf_weights(count, skew):
+    return [1.0 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_load(url, args):
+    # Only used by this thread
+    rng = random.Random(args.seed)
+    inventory = dict((product['id'], product['inventoryCount'])
+                     for product in post(url, INVENTORY)['products'])
+    products = sorted(inventory)
+    rng.shuffle(products)
+    weights = zipf_weights(len(products), args.skew)
+    stats = Stats()
+    userids = itertools.count(1)
+    numbers = itertools.count(1)
+
+    def shopper():
+        return Shopper(url, stats, products, weights, args, next(numbers))
+
+    start = time.perf_counter()
+    deadline = start + args.duration
+    with ThreadPoolExecutor(max_workers=args.shoppers) as pool:
+        if args.rate:
+            arrival = start
+            while True:
+                arrival += rng.expovariate(args.rate)
+                if arrival >= deadline:
+                    break
+                time.sleep(max(0.0, arrival - time.perf_counter()))
+                pool.submit(shopper().run, next(userids))
+        else:
+            def loop(virtual):
+                while time.perf_counter() < deadline:
+                    virtual.run(next(userids))
+            for _ in range(args.shoppers):
+                pool.submit(loop, shopper())
+    elapsed = time.perf_counter() - start
+
+    report(stats, elapsed)
+    settle_unknown(url, stats)
+    return check_oversell(url, inventory, stats.sold)
+
+
+def report(stats, elapsed):
+    requests = sum(len(values) for values in stats.latencies.values())
+    sessions = sum(stats.flows.values())
+    print('%d shoppers and %d requests in %.1fs: %.1f shoppers/s, '
+          '%.1f req/s' % (sessions, requests, elapsed, sessions / elapsed,
+                          requests / elapsed))
+    for outcome in sorted(stats.flows):
+        print('  %-20s %8d' % (outcome, stats.flows[outcome]))
+
+    print()
+    print('%-16s %8s %8s %8s %8s %8s %8s' % (
+        'operation', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+        'errors'))
+    for operation in sorted(stats.latencies):
+        ordered = sorted(stats.latencies[operation])
+        print('%-16s %8d %8.1f %8.1f %8.1f %8.1f %8d' % (
+            operation, len(ordered),
+            1000 * percentile(ordered, 0.50),
+            1000 * percentile(ordered, 0.90),
+            1000 * percentile(ordered, 0.99),
+            1000 * ordered[-1],
+            sum(stats.errors.get(operation, {}).values())))
+
+    if stats.errors:
+        print()
+        print('%-16s %-14s %8s' % ('operation', 'error', 'count'))
+        for operation in sorted(stats.errors):
+            for error_class, count in sorted(stats.errors[operation].items()):
+                print('%-16s %-14s %8d' % (operation, error_class, count))
+
+
+def settle_unknown(url, stats):
+    """
+    Counts the unknown purchases whose cart turns out to be purchased as
+    sold, so that the oversell check does not mistake them for oversold
+    stock.
+    """
+    if not stats.unknown:
+        return
+    committed = 0
+    for cart, picked in stats.unknown:
+        data = post(url, CART_PURCHASED, {'cart': cart})
+        if data['cart'] is not None and \
+                data['cart']['purchasedAt'] is not None:
+            committed += 1
+            for product, quantity in picked.items():
+                stats.sold[product] += quantity
+    print()
+    print('Unknown purchases: %d, of which %d committed' % (
+        len(stats.unknown), committed))
+
+
+def check_oversell(url, initial, sold):
+    """Prints and returns the number of products with inconsistent stock."""
+    final = dict((product['id'], product['inventoryCount'])
+                 for product in post(url, INVENTORY)['products'])
+    problems = 0
+    for product in sorted(initial):
+        expected = initial[product] - sold.get(product, 0)
+        actual = final.get(product)
+        if actual is None or actual < 0 or actual != expected:
+            problems += 1
+            print('Product %s: started with %d, sold %d, now %s' % (
+                product, initial[product], sold.get(product, 0), actual))
+    print()
+    print('Oversell check: %s (%d units sold over %d products)' % (
+        'FAILED' if problems else 'ok', sum(sold.values()), len(sold)))
+    return problems
+
+
+def populate(count, inventory):
+    # Through the repository, which fills in versions and converted prices
+    db.create_db()
+    repository = get_repository()
+    rng = random.Random(42)
+    with repository.transaction():
+        for i in range(count):
+            repository.create_product(title='Product %d' % i,
+                                      price=rng.randint(100, 10000),
+                                      currency='USD',
+                                      inventory_count=inventory,
+                                      can_purchase=True)
+    db.dispose_db_engine()
+
+
+def run_server(port, workers):
+    from storeify.app import create_app
+    from storeify.serve import Arbiter
+    # Out of stock errors are expected; don't log a traceback for each
+    logging.getLogger('graphql').setLevel(logging.CRITICAL)
+    Arbiter(create_app(debug=False), port=port, workers=workers).run()
+
+
+def wait_until_up(url, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            post(url, BROWSE)
+            return
+        except OperationFailed:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url',
+                        help='GraphQL endpoint of a running server; '
+                        'by default a scratch one is started')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--port', type=int, default=5056)
+    parser.add_argument('--products', type=int, default=100)
+    parser.add_argument('--inventory', type=int, default=50)
+    parser.add_argument('--shoppers', type=int, default=16,
+                        help='virtual shoppers shopping at once')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='shoppers arriving per second (0: closed loop)')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--mix', default='50:30:20',
+                        help='browse:cart:purchase weights')
+    parser.add_argument('--skew', type=float, default=1.1,
+                        help='Zipf exponent of product popularity')
+    parser.add_argument('--items', type=int, default=3,
+                        help='most products in one cart')
+    parser.add_argument('--quantity', type=int, default=2,
+                        help='most units of a product in one cart')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    args.mix = [float(weight) for weight in args.mix.split(':')]
+    if len(args.mix) != len(FLOWS):
+        parser.error('--mix takes %d weights' % len(FLOWS))
+
+    if args.url:
+        sys.exit(1 if run_load(args.url, args) else 0)
+
+    db_path = tempfile.mkstemp(suffix='.sqlite3')[1]
+    Config.DATABASE_URI = 'sqlite:///' + db_path
+    populate(args.products, args.inventory)
+    server = multiprocessing.Process(target=run_server,
+                                     args=(args.port, args.workers))
+    server.start()
+    url = 'http://127.0.0.1:%d/graphql' % args.port
+    try:
+        wait_until_up(url)
+        problems = run_load(url, args)
+    finally:
+        os.kill(server.pid, signal.SIGTERM)
+        server.join()
+        os.remove(db_path)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
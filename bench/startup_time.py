@@ -0,0 +1,76 @@
+"""
+Cold start cost of a storeify worker.
+
+    $ python bench/startup_time.py [--top 15]
+
+Runs a fresh interpreter with `-X importtime` and reports the wall time of
+each startup phase (importing storeify.app, create_app(), building the
+schema, serving the first request) followed by the cumulative import time
+of the heaviest top-level packages.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+PHASES = r'''
+import json, os, sys, tempfile, time
+t0 = time.perf_counter()
+from storeify.config import Config
+Config.DATABASE_URI = 'sqlite:///' + tempfile.mkstemp(suffix='.sqlite3')[1]
+from storeify.app import create_app
+t1 = time.perf_counter()
+app = create_app(debug=False)
+t2 = time.perf_counter()
+from storeify.schema import get_schema
+get_schema()
+t3 = time.perf_counter()
+from storeify import db
+db.create_db()
+client = app.test_client()
+client.post('/graphql', data=json.dumps({'query': '{ products { id } }'}),
+            content_type='application/json')
+t4 = time.perf_counter()
+os.remove(Config.DATABASE_URI[len('sqlite:///'):])
+sys.stdout.write(json.dumps([t1 - t0, t2 - t1, t3 - t2, t4 - t3]))
+'''
+
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+\d+ \| *(\S+)')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', PHASES],
+                          cwd=ROOT, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+    phases = zip(['import storeify.app', 'create_app()', 'build schema',
+                  'first request'], json.loads(proc.stdout))
+    print('%-22s %10s' % ('phase', 'ms'))
+    for name, seconds in phases:
+        print('%-22s %10.1f' % (name, seconds * 1000))
+
+    # Sum self time (excluding nested imports) per top-level package so
+    # nothing is counted twice.
+    packages = defaultdict(int)
+    for line in proc.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            packages[match.group(2).split('.')[0]] += int(match.group(1))
+
+    print('\n%-22s %10s' % ('package (self time)', 'ms'))
+    ranked = sorted(packages.items(), key=lambda item: -item[1])
+    for name, micros in ranked[:args.top]:
+        print('%-22s %10.1f' % (name, micros / 1000.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+Admission control for /graphql.
+
+Requests are let through to execution by one of two pools: writes, for
+requests with a mutation among their operations, and reads, for everything
+else, so that a spike of checkouts cannot starve the catalog queries of
+their slots or the other way round. Each pool lets a limited number of
+requests run at once. A request finding its pool full waits in the pool's
+queue, of at most Config.ADMISSION_{READ,WRITE}_QUEUE_SIZE requests, for up
+to Config.ADMISSION_QUEUE_TIMEOUT seconds. One that finds the queue full too
+is turned away at once with 429, and one that waits out the timeout with
+503, both with a Retry-After header estimated from the pool's latency. Under
+load clients are then told to back off within milliseconds instead of
+piling up on SQLite's write lock until they time out.
+
+Each pool's limit adapts to the latency it observes, much as TCP's
+congestion window does. The pool keeps a baseline (the lowest latency seen,
+drifting slowly upwards) and a smoothed latency. While the smoothed latency
+stays within Config.ADMISSION_LATENCY_TOLERANCE times the baseline and the
+pool is full, the limit grows by one request per limit's worth of requests.
+Once it exceeds that, the limit is multiplied by Config.ADMISSION_BACKOFF,
+at most once per request's latency, down to Config.ADMISSION_MIN_LIMIT. The
+limit so settles at the concurrency the database can serve without queueing
+inside it.
+
+Pools are per process and only hold back concurrent requests, so they
+matter with a threaded server: `flask run`, or storeify.serve with
+--threads. An incremental (@defer/@stream) response holds its slot until
+its last part is sent, or the client goes away.
+"""
+import math
+import threading
+import time
+
+from graphql import GraphQLError
+from graphql.utils.get_operation_ast import get_operation_ast
+from graphql_server import HttpQueryError, get_graphql_params
+
+from storeify.backend import document_backend
+from storeify.config import Config
+
+READ = 'read'
+WRITE = 'write'
+
+# Weight of a new latency in the smoothed latency, and how far towards it
+# the baseline drifts when it is higher
+SMOOTHING = 0.2
+BASELINE_DRIFT = 0.01
+
+
+class Pool(object):
+    """Concurrency limit, wait queue and adaptive limit of one pool."""
+
+    def __init__(self, name, limit, max_limit, queue_size):
+        self.name = name
+        self.condition = threading.Condition()
+        self.limit = float(limit)
+        self.max_limit = max_limit
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.waiting = 0
+        self.baseline = None
+        self.latency = None
+        self.decreased_at = 0.0
+        self.rejected = dict(queue_full=0, timeout=0)
+
+    @property
+    def capacity(self):
+        return max(int(self.limit), 1)
+
+    def retry_after(self):
+        """Seconds until a request sent now would likely get a slot."""
+        latency = self.latency or 0.0
+        return max(int(math.ceil(
+            latency * (self.waiting + 1) / self.capacity)), 1)
+
+    def _reject(self, status_code, reason, message):
+        self.rejected[reason] += 1
+        return HttpQueryError(status_code, message, headers={
+            'Retry-After': str(self.retry_after())})
+
+    def acquire(self):
+        """
+        Takes a slot, waiting for one if need be. Raises HttpQueryError (429
+        or 503) if the queue is full or no slot comes up in time.
+        """
+        with self.condition:
+            if self.in_flight < self.capacity and not self.waiting:
+                self.in_flight += 1
+                return
+            if self.waiting >= self.queue_size:
+                raise self._reject(
+                    429, 'queue_full', 'Too many concurrent %s requests; '
+                    'retry later.' % self.name)
+            self.waiting += 1
+            deadline = time.monotonic() + Config.ADMISSION_QUEUE_TIMEOUT
+            try:
+                while self.in_flight >= self.capacity:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise self._reject(
+                            503, 'timeout', 'Timed out waiting to run a %s '
+                            'request; retry later.' % self.name)
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+
+    def release(self, seconds):
+        """Gives the slot back, adapting the limit to how long it was held."""
+        with self.condition:
+            self.in_flight -= 1
+            self._adapt(seconds)
+            free = self.capacity - self.in_flight
+            if free > 0:
+                self.condition.notify(free)
+
+    def _adapt(self, seconds):
+        if self.baseline is None or seconds < self.baseline:
+            self.baseline = seconds
+        else:
+            # Drifts up, so that a baseline from a quiet moment does not hold
+            # forever once the work itself gets slower
+            self.baseline += (seconds - self.baseline) * BASELINE_DRIFT
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += (seconds - self.latency) * SMOOTHING
+
+        now = time.monotonic()
+        if self.latency > self.baseline * Config.ADMISSION_LATENCY_TOLERANCE:
+            if now - self.decreased_at >= self.latency:
+                self.limit = max(self.limit * Config.ADMISSION_BACKOFF,
+                                 float(Config.ADMISSION_MIN_LIMIT))
+                self.decreased_at = now
+        elif self.in_flight + 1 >= self.capacity:
+            # The pool was full and kept up; let one more in
+            self.limit = min(self.limit + 1.0 / self.limit,
+                             float(self.max_limit))
+
+    def as_dict(self):
+        with self.condition:
+            return dict(limit=self.limit, in_flight=self.in_flight,
+                        waiting=self.waiting, latency=self.latency,
+                        rejected=dict(self.rejected))
+
+
+_lock = threading.Lock()
+pools = {}
+
+
+def get_pool(kind):
+    """The READ or WRITE pool, built from Config on first use."""
+    with _lock:
+        if kind not in pools:
+            if kind == WRITE:
+                pools[kind] = Pool(WRITE, Config.ADMISSION_WRITE_LIMIT,
+                                   Config.ADMISSION_WRITE_MAX_LIMIT,
+                                   Config.ADMISSION_WRITE_QUEUE_SIZE)
+            else:
+                pools[kind] = Pool(READ, Config.ADMISSION_READ_LIMIT,
+                                   Config.ADMISSION_READ_MAX_LIMIT,
+                                   Config.ADMISSION_READ_QUEUE_SIZE)
+        return pools[kind]
+
+
+def reset():
+    """Drops the pools, so that they are built from Config again."""
+    with _lock:
+        pools.clear()
+
+
+def is_write(schema, data, args):
+    """Whether a parsed /graphql request body has a mutation to run."""
+    for operation in data if isinstance(data, list) else [data]:
+        if not isinstance(operation, dict):
+            continue
+        try:
+            params = get_graphql_params(operation, args)
+            if not params.query:
+                continue
+            # Cached, so execution finds it parsed and validated already
+            document = document_backend.document_from_string(schema,
+                                                             params.query)
+        except (HttpQueryError, GraphQLError):
+            continue
+        definition = get_operation_ast(document.document_ast,
+                                       params.operation_name)
+        if definition is not None and definition.operation == 'mutation':
+            return True
+    return False
+
+
+def pool_for(schema, data, args):
+    """The pool to admit a request by, or None with admission control off."""
+    if not Config.ADMISSION_CONTROL:
+        return None
+    return get_pool(WRITE if is_write(schema, data, args) else READ)
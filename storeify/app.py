@@ -1,31 +1,179 @@
-from flask import Flask
-from flask_graphql import GraphQLView
+import json
 
+import click
+from flask import Flask, Response, abort, request, send_file
+
+from storeify.config import Config
 from storeify.db import get_db_session
-from storeify.schema import schema
+from storeify.encoding import compress_response
+from storeify.pricing import register_price_hooks
+from storeify.repository import get_repository
+from storeify.view import StoreifyGraphQLView
 
 
 def create_app(debug=True, database=None):
     app = Flask(__name__)
-    app.debug = True
+    app.debug = debug
+
+    register_price_hooks()
 
     app.add_url_rule(
         '/graphql',
-        view_func=GraphQLView.as_view(
+        view_func=StoreifyGraphQLView.as_view(
             'graphql',
-            schema=schema,
             graphiql=True
         )
     )
 
-    app.teardown_appcontext
+    if Config.SLOW_QUERY_THRESHOLD is not None:
+        from storeify.slow_queries import install
+        install()
+
+    if Config.METRICS_ENABLED:
+        @app.route('/metrics')
+        def prometheus_metrics():
+            from storeify.metrics import CONTENT_TYPE, metrics
+            return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+    @app.route('/profiles')
+    def profiles():
+        from storeify.encoding import json_encode
+        from storeify.profiling import authorized, list_profiles
+        if not authorized(request):
+            abort(404)
+        return Response(json_encode(list_profiles(
+            request.args.get('operation'))), content_type='application/json')
+
+    @app.route('/profiles/<name>')
+    def profile_file(name):
+        from storeify.profiling import authorized, profile_path
+        path = authorized(request) and profile_path(name)
+        if not path:
+            abort(404)
+        return send_file(path, mimetype='application/octet-stream',
+                         as_attachment=True, attachment_filename=name)
 
+    @app.route('/slow-queries')
+    def slow_query_report():
+        from storeify.encoding import json_encode
+        from storeify.profiling import authorized
+        from storeify.slow_queries import report
+        if not authorized(request):
+            abort(404)
+        return Response(json_encode(report()),
+                        content_type='application/json')
+
+    app.after_request(compress_response)
+
+    @app.teardown_appcontext
     def shutdown_session(exception=None):
-        get_db_session.remove()
+        get_repository().close()
+
+    @app.cli.command('update-rates')
+    @click.argument('rates', nargs=-1, required=True)
+    def update_rates(rates):
+        """Set exchange rates, e.g. USD/CAD=1.34, and reprice products."""
+        from storeify.currency import currency_code
+        from storeify.pricing import update_exchange_rates
+
+        parsed = {}
+        for rate in rates:
+            pair, _, value = rate.partition('=')
+            codes = pair.upper().split('/')
+            try:
+                if len(codes) != 2:
+                    raise ValueError("Expected BASE/QUOTE=RATE.")
+                base, quote = (currency_code(code).name for code in codes)
+                parsed[(base, quote)] = float(value)
+            except ValueError as e:
+                raise click.BadParameter('%s: %s' % (rate, e),
+                                         param_hint='rates')
+        updated = update_exchange_rates(get_db_session(), parsed)
+        click.echo('Repriced %d products.' % updated)
+
+    @app.cli.command('rebuild-rollups')
+    def rebuild_sales_rollups():
+        """Recompute the sales rollups from the order ledger."""
+        get_repository().rebuild_rollups()
+        click.echo('Sales rollups rebuilt.')
+
+    @app.cli.command('sweep')
+    @click.option('--forever', is_flag=True,
+                  help='Keep sweeping every SWEEPER_INTERVAL seconds.')
+    def sweep_carts(forever):
+        """Delete orphan cart items and abandoned carts."""
+        from storeify.sweeper import Sweeper, sweep
+
+        if forever:
+            sweeper = Sweeper()
+            sweeper.start()
+            try:
+                while sweeper.is_alive():
+                    sweeper.join(1)
+            except KeyboardInterrupt:
+                sweeper.stop()
+            return
+        cart_items, carts = sweep()
+        click.echo('Deleted %d cart items and %d carts.' % (cart_items, carts))
+
+    @app.cli.command('shards')
+    def show_shards():
+        """Count the carts and cart items in every shard."""
+        from storeify.sharding import shard_stats, sharding_enabled
+
+        if not sharding_enabled():
+            click.echo('Sharding is off; set SHARD_URIS to enable it.')
+            return
+        for shard_id, counts in sorted(shard_stats().items()):
+            click.echo('%s: %d carts, %d cart items (%d orphans)' % (
+                shard_id, counts['carts'], counts['cart_items'],
+                counts['orphan_cart_items']))
+
+    @app.cli.command('changes')
+    @click.option('--after', default=0, help='Seq of the last change seen.')
+    @click.option('--follow', is_flag=True,
+                  help='Keep printing changes as they are committed.')
+    def show_changes(after, follow):
+        """Print the change log after a cursor, one JSON object a line."""
+        from storeify.changelog import follow as follow_changes
+        from storeify.encoding import json_encode
+
+        def echo(batch):
+            for change in batch:
+                line = json_encode(dict(
+                    seq=change.seq, entity=change.entity,
+                    entity_id=change.entity_id, operation=change.operation,
+                    fields=json.loads(change.fields),
+                    created_at=change.created_at))
+                click.echo(line if isinstance(line, str) else line.decode())
+
+        if follow:
+            try:
+                for batch in follow_changes(after):
+                    echo(batch)
+            except KeyboardInterrupt:
+                pass
+            return
+        repository = get_repository()
+        while True:
+            batch = repository.changes(after, Config.CHANGE_LOG_PAGE_SIZE)
+            if not batch:
+                break
+            echo(batch)
+            after = batch[-1].seq
+
+    @app.cli.command('compact-changes')
+    def compact_changes():
+        """Fold change log entries older than CHANGE_LOG_COMPACT_AFTER."""
+        from storeify.models import unix_time
+
+        deleted = get_repository().compact_changes(
+            unix_time() - Config.CHANGE_LOG_COMPACT_AFTER)
+        click.echo('Folded away %d changes.' % deleted)
 
     return app
 
 
 if __name__ == '__main__':
     app = create_app()
-    app.run
+    app.run()
@@ -0,0 +1,65 @@
+import threading
+from collections import OrderedDict
+from functools import partial
+
+from graphql import parse, validate, execute
+from graphql.backend import GraphQLBackend, GraphQLDocument
+from graphql.execution import ExecutionResult
+
+from storeify.config import Config
+from storeify.metrics import CacheStats
+
+
+def _invalid(errors, *args, **kwargs):
+    return ExecutionResult(errors=errors, invalid=True)
+
+
+class CachedDocumentBackend(GraphQLBackend):
+    """
+    Parses and validates each distinct request string once, then reuses the
+    document for later requests. Holds at most max_size documents, evicting
+    the least recently used.
+    """
+
+    def __init__(self, max_size=None, executor=None):
+        self.max_size = max_size or Config.DOCUMENT_CACHE_SIZE
+        self.executor = executor
+        self.documents = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def document_from_string(self, schema, document_string):
+        key = (schema, document_string)
+        with self.lock:
+            document = self.documents.get(key)
+            if document is not None:
+                self.documents.move_to_end(key)
+                self.stats.hit()
+                return document
+        self.stats.miss()
+
+        document_ast = parse(document_string)
+        errors = validate(schema, document_ast)
+        if errors:
+            run = partial(_invalid, errors)
+        else:
+            run = partial(execute, schema, document_ast,
+                          executor=self.executor)
+        document = GraphQLDocument(schema=schema,
+                                   document_string=document_string,
+                                   document_ast=document_ast,
+                                   execute=run)
+        document.errors = errors
+
+        with self.lock:
+            self.documents[key] = document
+            while len(self.documents) > self.max_size:
+                self.documents.popitem(last=False)
+        return document
+
+    def clear(self):
+        with self.lock:
+            self.documents.clear()
+
+
+document_backend = CachedDocumentBackend()
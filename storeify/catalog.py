@@ -0,0 +1,302 @@
+"""
+In-memory column store of the product catalog.
+
+Keeps the fields the `products` query filters and sorts on in NumPy arrays so
+that a filter is a handful of vectorized comparisons and only the requested
+page of products is loaded through the ORM. NumPy is optional: without it,
+or with Config.CATALOG_INDEX off, resolvers keep using plain SQL.
+
+The index is loaded from the database on first use, patched from the ORM
+flush events of every committed session, and fully reloaded once older than
+Config.CATALOG_INDEX_MAX_AGE to pick up writes made by other processes.
+"""
+import threading
+import time
+from enum import Enum
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+
+from storeify.config import Config
+from storeify.currency import currency_code
+from storeify.metrics import CacheStats
+from storeify.models import Product
+
+
+# SQLite's default limit on bound parameters is 999
+HYDRATE_CHUNK_SIZE = 500
+
+
+class ProductSort(Enum):
+    ID = 0
+    PRICE = 1
+    PRICE_DESC = 2
+    INVENTORY_COUNT = 3
+    INVENTORY_COUNT_DESC = 4
+
+
+def _currency_value(currency):
+    try:
+        return currency_code(currency).value
+    except ValueError:
+        return -1
+
+
+def catalog_index_enabled():
+    return Config.CATALOG_INDEX and numpy is not None
+
+
+class CatalogIndex(object):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded_at = None
+        self._allocate(0)
+
+    def _allocate(self, capacity):
+        self.size = 0
+        self.dead = 0
+        self.rows = {}
+        self.title_rows = {}
+        self.ids = numpy.zeros(capacity, dtype=numpy.int64)
+        self.titles = numpy.zeros(capacity, dtype=object)
+        self.price = numpy.zeros(capacity, dtype=numpy.int64)
+        self.currency = numpy.zeros(capacity, dtype=numpy.int8)
+        self.inventory = numpy.zeros(capacity, dtype=numpy.int64)
+        self.can_purchase = numpy.zeros(capacity, dtype=numpy.bool_)
+        self.live = numpy.zeros(capacity, dtype=numpy.bool_)
+
+    def _columns(self):
+        return ('ids', 'titles', 'price', 'currency', 'inventory',
+                'can_purchase', 'live')
+
+    def load(self, session):
+        columns = Product.__table__.c
+        rows = session.execute(
+            select([columns.id, columns.title, columns.price,
+                    columns.currency, columns.inventory_count,
+                    columns.can_purchase]).order_by(columns.id)).fetchall()
+        n = len(rows)
+        with self.lock:
+            self._allocate(max(n, 1024))
+            if n:
+                ids, titles, price, currency, inventory, can_purchase = \
+                    zip(*rows)
+                currencies = dict((value, _currency_value(value))
+                                  for value in set(currency))
+                self.ids[:n] = ids
+                self.titles[:n] = titles
+                self.price[:n] = [value or 0 for value in price]
+                self.currency[:n] = [currencies[value] for value in currency]
+                self.inventory[:n] = [value or 0 for value in inventory]
+                self.can_purchase[:n] = [bool(value) for value in can_purchase]
+                self.live[:n] = True
+                self.size = n
+                self.rows = dict(zip(ids, range(n)))
+                self._index_titles()
+            self.loaded_at = time.time()
+
+    def _index_titles(self):
+        self.title_rows = {}
+        for row, title in enumerate(self.titles[:self.size].tolist()):
+            if self.live[row]:
+                self.title_rows.setdefault(title, set()).add(row)
+
+    def is_stale(self):
+        return self.loaded_at is None or \
+            time.time() - self.loaded_at > Config.CATALOG_INDEX_MAX_AGE
+
+    def _grow(self):
+        capacity = max(len(self.ids) * 2, 1024)
+        for name in self._columns():
+            old = getattr(self, name)
+            new = numpy.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def _put(self, id, title, price, currency, inventory_count,
+             can_purchase):
+        row = self.rows.get(id)
+        if row is None:
+            if self.size == len(self.ids):
+                self._grow()
+            row = self.size
+            self.size += 1
+            self.rows[id] = row
+        else:
+            self.title_rows[self.titles[row]].discard(row)
+        self.title_rows.setdefault(title, set()).add(row)
+        self.ids[row] = id
+        self.titles[row] = title
+        self.price[row] = price or 0
+        self.currency[row] = _currency_value(currency)
+        self.inventory[row] = inventory_count or 0
+        self.can_purchase[row] = bool(can_purchase)
+        self.live[row] = True
+
+    def upsert(self, *fields):
+        with self.lock:
+            self._put(*fields)
+
+    def remove(self, id):
+        with self.lock:
+            row = self.rows.pop(id, None)
+            if row is None:
+                return
+            self.live[row] = False
+            self.title_rows[self.titles[row]].discard(row)
+            self.dead += 1
+            if self.dead > self.size // 2:
+                self._compact()
+
+    def _compact(self):
+        keep = numpy.flatnonzero(self.live[:self.size])
+        for name in self._columns():
+            column = getattr(self, name)
+            column[:len(keep)] = column[keep]
+        self.size = len(keep)
+        self.dead = 0
+        self.live[self.size:] = False
+        self.rows = dict((id, row) for row, id in
+                         enumerate(self.ids[:self.size].tolist()))
+        self._index_titles()
+
+    def query(self, id=None, title=None, inventory_minimum=None,
+              can_purchase=None, price_minimum=None, price_maximum=None,
+              currency=None, sort=None, first=None, offset=None):
+        """Returns the ids of the matching products, in page order."""
+        with self.lock:
+            # Start from the narrowest candidate set, then filter it down
+            if id is not None:
+                try:
+                    row = self.rows.get(int(id))
+                except (TypeError, ValueError):
+                    # Not an integer key, so like SQL it matches nothing
+                    row = None
+                rows = [row] if row is not None else []
+            elif title is not None:
+                rows = sorted(self.title_rows.get(title, ()))
+            else:
+                rows = numpy.flatnonzero(self.live[:self.size])
+            rows = numpy.asarray(rows, dtype=numpy.int64)
+
+            if id is not None and title is not None:
+                rows = rows[self.titles[rows] == title]
+            if inventory_minimum is not None:
+                rows = rows[self.inventory[rows] >= inventory_minimum]
+            if can_purchase is not None:
+                rows = rows[self.can_purchase[rows] == can_purchase]
+            if price_minimum is not None:
+                rows = rows[self.price[rows] >= price_minimum]
+            if price_maximum is not None:
+                rows = rows[self.price[rows] <= price_maximum]
+            if currency is not None:
+                rows = rows[self.currency[rows] == _currency_value(currency)]
+
+            start = offset or 0
+            stop = start + first if first is not None else len(rows)
+            rows = rows[self._page_order(rows, sort, stop)[start:stop]]
+            return self.ids[rows].tolist()
+
+    def _page_order(self, rows, sort, stop):
+        """
+        Orders rows by the sort key, ties broken by id as ORDER BY <key>, id
+        would. Only the first `stop` positions are guaranteed to be sorted.
+        """
+        sort = ProductSort(sort) if sort is not None else ProductSort.ID
+        ids = self.ids[rows]
+        if sort == ProductSort.ID:
+            key = ids
+        else:
+            if sort in (ProductSort.PRICE, ProductSort.PRICE_DESC):
+                key = self.price[rows]
+            else:
+                key = self.inventory[rows]
+            if sort in (ProductSort.PRICE_DESC,
+                        ProductSort.INVENTORY_COUNT_DESC):
+                key = -key
+            if len(key) and (abs(key).max() >= 2 ** 31
+                             or ids.max() >= 2 ** 32):
+                # Too wide to pack into one int64: sort on both columns
+                return numpy.lexsort((ids, key))[:stop]
+            # Both fit in 32 bits, so one int64 orders by (key, id)
+            key = (key << 32) + ids
+        if stop < len(key):
+            top = numpy.argpartition(key, stop)[:stop]
+            return top[numpy.argsort(key[top])]
+        return numpy.argsort(key)
+
+
+catalog_index = None
+_catalog_lock = threading.Lock()
+# Lookups served by the loaded index (hits) and loads from the database
+index_stats = CacheStats()
+
+
+def get_catalog_index(session):
+    global catalog_index
+    with _catalog_lock:
+        if catalog_index is None:
+            catalog_index = CatalogIndex()
+        if catalog_index.is_stale():
+            catalog_index.load(session)
+            index_stats.miss()
+        else:
+            index_stats.hit()
+    return catalog_index
+
+
+def reset_catalog_index():
+    global catalog_index
+    catalog_index = None
+
+
+def hydrate_products(query, ids):
+    """Loads the products with the given ids, preserving the order of ids."""
+    products = {}
+    for start in range(0, len(ids), HYDRATE_CHUNK_SIZE):
+        chunk = ids[start:start + HYDRATE_CHUNK_SIZE]
+        for product in query.filter(Product.id.in_(chunk)):
+            products[product.id] = product
+    return [products[id] for id in ids if id in products]
+
+
+# Incremental maintenance: record product changes as they are flushed and
+# apply them to the index only once the transaction commits.
+
+def _record(session, change):
+    if catalog_index is not None:
+        session.info.setdefault('catalog_changes', []).append(change)
+
+
+@event.listens_for(Product, 'after_insert')
+@event.listens_for(Product, 'after_update')
+def _product_written(mapper, connection, target):
+    _record(object_session(target),
+            ('upsert', (target.id, target.title, target.price,
+                        target.currency, target.inventory_count,
+                        target.can_purchase)))
+
+
+@event.listens_for(Product, 'after_delete')
+def _product_deleted(mapper, connection, target):
+    _record(object_session(target), ('remove', (target.id, )))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_catalog_changes(session):
+    changes = session.info.pop('catalog_changes', None)
+    index = catalog_index
+    if not changes or index is None:
+        return
+    for op, args in changes:
+        getattr(index, op)(*args)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_catalog_changes(session):
+    session.info.pop('catalog_changes', None)
@@ -0,0 +1,140 @@
+"""
+Change data capture log.
+
+Every mutation appends a row to change_log for each row it creates, updates
+or deletes, in the same transaction as the change itself:
+
+    seq        increasing number of the change; a consumer keeps the seq of
+               the last change it applied as its cursor
+    entity     table name: product, cart, cartitem or order
+    entity_id  repository key of the row (the id in its global ID)
+    operation  create, update or delete
+    fields     JSON object of the fields set; {} for deletes
+
+Consumers read the changes after their cursor in batches, oldest first,
+with Repository.changes(), follow() (which polls for more) or the
+`changes(after:, first:)` query, and should apply creates and updates as
+upserts. Compaction (compact(), `flask compact-changes`) keeps the log from
+growing forever: each row's changes older than
+Config.CHANGE_LOG_COMPACT_AFTER are folded into the latest of them, which
+then holds every field set since its create, and the rest are deleted. A
+consumer that falls behind ends up with the same state, from fewer changes.
+
+SQLite serializes writes, so changes commit in seq order and a consumer
+never skips past one committed late. With sharding the log lives in the
+catalog database and commits separately from the cart shards; a cart item
+moved to another shard keeps its key, so its changes stay under one key.
+"""
+import json
+import time
+
+from sqlalchemy import and_, func, or_, select
+
+from storeify.config import Config
+from storeify.models import Change, unix_time
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+
+
+def encode_fields(fields):
+    return json.dumps(fields or {}, sort_keys=True, default=str)
+
+
+def change_row(entity, entity_id, operation, fields=None):
+    return dict(entity=entity, entity_id=str(entity_id), operation=operation,
+                fields=encode_fields(fields), created_at=unix_time())
+
+
+def fold(changes):
+    """
+    Folds the changes of each row into the latest of them, rewriting it in
+    place. Returns the changes folded away, which are to be deleted.
+    """
+    histories = {}
+    for change in sorted(changes, key=lambda change: change.seq):
+        histories.setdefault((change.entity, change.entity_id),
+                             []).append(change)
+
+    folded = []
+    for history in histories.values():
+        if len(history) < 2:
+            continue
+        latest = history[-1]
+        if latest.operation != DELETE:
+            fields = {}
+            created = False
+            for change in history:
+                if change.operation == DELETE:
+                    fields, created = {}, False
+                elif change.operation == CREATE:
+                    fields, created = json.loads(change.fields), True
+                else:
+                    fields.update(json.loads(change.fields))
+            latest.operation = CREATE if created else UPDATE
+            latest.fields = encode_fields(fields)
+        folded.extend(history[:-1])
+    return folded
+
+
+def insert_changes(db_session, rows):
+    """
+    Appends changes (change_row() dicts) to the log in the caller's
+    transaction, with one statement however many there are.
+    """
+    if rows:
+        db_session.execute(Change.__table__.insert(), rows)
+
+
+def changes_after(db_session, after, limit):
+    return db_session.query(Change).filter(Change.seq > after) \
+        .order_by(Change.seq).limit(limit).all()
+
+
+def compact(db_session, before, batch_size=None):
+    """
+    Folds the changes made before the unix time `before`, committing after
+    every batch_size rows. Returns the number of changes deleted.
+    """
+    batch_size = batch_size or Config.CHANGE_LOG_COMPACT_BATCH_SIZE
+    table = Change.__table__
+    rows = db_session.execute(
+        select([table.c.entity, table.c.entity_id])
+        .where(table.c.created_at < before)
+        .group_by(table.c.entity, table.c.entity_id)
+        .having(func.count() > 1)).fetchall()
+
+    deleted = 0
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        changes = db_session.query(Change).filter(
+            Change.created_at < before,
+            or_(*[and_(Change.entity == entity, Change.entity_id == id)
+                  for entity, id in batch])).all()
+        for change in fold(changes):
+            db_session.delete(change)
+            deleted += 1
+        db_session.commit()
+    return deleted
+
+
+def follow(after=0, batch_size=None, poll_interval=1.0):
+    """
+    Yields the changes after the cursor `after` in batches, as they are
+    committed, forever.
+    """
+    from storeify.repository import get_repository
+
+    batch_size = batch_size or Config.CHANGE_LOG_PAGE_SIZE
+    while True:
+        repository = get_repository()
+        try:
+            batch = repository.changes(after, batch_size)
+        finally:
+            repository.close()
+        if batch:
+            after = batch[-1].seq
+            yield batch
+        else:
+            time.sleep(poll_interval)
@@ -0,0 +1,83 @@
+"""
+Optimistic concurrency for mutations.
+
+Product, Cart and CartItem carry a version column that SQLAlchemy checks and
+bumps in the WHERE clause of every UPDATE, so a mutation that read a row
+another transaction has since changed fails its flush with StaleDataError
+instead of silently overwriting the other write. Mutations decorated with
+retry_on_conflict are then rolled back and run again from the start, up to
+Config.CONFLICT_MAX_RETRIES times with jittered exponential backoff.
+"""
+import functools
+import random
+import threading
+import time
+
+from graphql import GraphQLError
+from sqlalchemy.orm.exc import StaleDataError
+
+from storeify.config import Config
+
+
+class ConflictStats(object):
+    """Per-mutation counts of attempts, conflicts and exhausted retries."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, mutation, name):
+        with self.lock:
+            counts = self.counts.setdefault(
+                mutation, dict(attempts=0, conflicts=0, failures=0))
+            counts[name] += 1
+
+    def as_dict(self):
+        with self.lock:
+            return dict((mutation, dict(counts, conflict_rate=(
+                float(counts['conflicts']) / counts['attempts']
+                if counts['attempts'] else 0.0)))
+                for mutation, counts in self.counts.items())
+
+
+stats = ConflictStats()
+
+
+def version_conflict(kind, id):
+    return GraphQLError(
+        '%s "%s" was modified concurrently. Reload it and retry.' % (kind, id))
+
+
+def check_version(instance, expected_version, kind, id):
+    """
+    Raises a conflict error if the client's expectedVersion is not the
+    version just loaded. The UPDATE is then guarded by the same version, so
+    a write that lands between this check and the flush is caught as well.
+    """
+    if expected_version is not None and instance.version != expected_version:
+        raise version_conflict(kind, id)
+
+
+def retry_on_conflict(mutate):
+    """Decorates a Mutation.mutate to be retried on StaleDataError."""
+    name = mutate.__qualname__.split('.')[0]
+
+    @functools.wraps(mutate)
+    def wrapper(root, info, **kwargs):
+        attempt = 0
+        while True:
+            stats.add(name, 'attempts')
+            try:
+                return mutate(root, info, **kwargs)
+            except StaleDataError:
+                # The repository transaction has already been rolled back
+                stats.add(name, 'conflicts')
+                if attempt >= Config.CONFLICT_MAX_RETRIES:
+                    stats.add(name, 'failures')
+                    raise GraphQLError(
+                        '%s conflicted with concurrent updates. '
+                        'Please retry.' % name)
+            attempt += 1
+            time.sleep(random.uniform(
+                0, Config.CONFLICT_BACKOFF * 2 ** attempt))
+    return wrapper
@@ -1,2 +1,138 @@
 class Config(object):
     DATABASE_URI = 'sqlite:///database.sqlite3'
+
+    # Parsed and validated GraphQL documents kept by storeify.backend
+    DOCUMENT_CACHE_SIZE = 512
+    # Operations parsed and validated by storeify.view.warm_up before a
+    # worker starts accepting requests
+    WARMUP_OPERATIONS = []
+    # Most operations accepted in one batched /graphql request
+    GRAPHQL_MAX_BATCH_SIZE = 10
+    # List items sent per part of a response streamed with @stream
+    # (storeify.incremental)
+    GRAPHQL_STREAM_BATCH_SIZE = 20
+
+    # Admission control for /graphql (storeify.admission): requests with a
+    # mutation and all others each have a pool whose concurrency limit adapts
+    # between ADMISSION_MIN_LIMIT and its maximum, starting from its limit
+    ADMISSION_CONTROL = True
+    ADMISSION_READ_LIMIT = 16
+    ADMISSION_READ_MAX_LIMIT = 64
+    ADMISSION_WRITE_LIMIT = 4
+    ADMISSION_WRITE_MAX_LIMIT = 16
+    ADMISSION_MIN_LIMIT = 1
+    # Requests waiting for a slot; more are answered 429 at once, and those
+    # waiting longer than the timeout (in seconds) 503
+    ADMISSION_READ_QUEUE_SIZE = 64
+    ADMISSION_WRITE_QUEUE_SIZE = 32
+    ADMISSION_QUEUE_TIMEOUT = 2.0
+    # A pool's limit is multiplied by ADMISSION_BACKOFF when its latency
+    # grows past this many times the lowest it has seen
+    ADMISSION_LATENCY_TOLERANCE = 2.0
+    ADMISSION_BACKOFF = 0.9
+
+    # Serve Prometheus metrics at /metrics (storeify.metrics)
+    METRICS_ENABLED = True
+    # Distinct operation names given their own request metrics
+    METRICS_MAX_OPERATIONS = 100
+
+    # On-demand profiling of /graphql requests (storeify.profiling): requests
+    # with an X-Profile header equal to PROFILING_TOKEN, and this fraction of
+    # all requests, are profiled with cProfile. None turns the header off.
+    PROFILING_TOKEN = None
+    PROFILING_SAMPLE_RATE = 0.0
+    # Also take a tracemalloc snapshot of every profiled request, which
+    # slows it down several times over
+    PROFILING_ALLOCATIONS = False
+    # Directory keeping the latest PROFILING_MAX_PROFILES profiles
+    PROFILING_DIR = 'profiles'
+    PROFILING_MAX_PROFILES = 50
+
+    # Log SQL statements taking this many seconds or more, with their GraphQL
+    # operation and field and, once per statement shape, their query plan
+    # (storeify.slow_queries). None turns statement timing off.
+    SLOW_QUERY_THRESHOLD = None
+    # Statement shapes aggregated per process
+    SLOW_QUERY_MAX_STATEMENTS = 200
+
+    # Response encoding (storeify.encoding): 'auto' picks the fastest of
+    # orjson, ujson and json that is installed
+    JSON_SERIALIZER = 'auto'
+    COMPRESSION_MIN_SIZE = 1024
+    COMPRESSION_GZIP_LEVEL = 6
+    COMPRESSION_BROTLI_QUALITY = 5
+
+    # Multi-process server (storeify.serve)
+    SERVER_WORKERS = 4
+    # Requests each worker handles at once, in threads of its own
+    SERVER_THREADS = 1
+    SERVER_BACKLOG = 2048
+    SERVER_GRACEFUL_TIMEOUT = 30
+    SERVER_ACCESS_LOG = False
+
+    # GraphQL subscriptions over WebSocket (storeify.subscriptions): changes
+    # to a product within this many seconds are delivered as one
+    SUBSCRIPTION_COALESCE_WINDOW = 0.5
+    SUBSCRIPTION_MAX_PER_CONNECTION = 20
+    # Open WebSocket connections per worker; further upgrades get a 503
+    SUBSCRIPTION_MAX_CONNECTIONS = 1000
+    # Largest client message accepted, in bytes
+    SUBSCRIPTION_MAX_MESSAGE_SIZE = 64 * 1024
+
+    # Serve the `products` query from the NumPy column store in
+    # storeify.catalog (ignored when NumPy is not installed)
+    CATALOG_INDEX = False
+    CATALOG_INDEX_MAX_AGE = 60
+
+    # Products rewritten per UPDATE when exchange rates change
+    PRICE_REFRESH_CHUNK_SIZE = 1000
+
+    # orders(userid:) page sizes
+    ORDERS_PAGE_SIZE = 20
+    ORDERS_MAX_PAGE_SIZE = 100
+
+    # Change data capture log (storeify.changelog): changes(after:) page
+    # sizes, the age (in seconds) past which `flask compact-changes` folds
+    # each row's changes into one, and the rows folded per transaction
+    CHANGE_LOG_PAGE_SIZE = 100
+    CHANGE_LOG_MAX_PAGE_SIZE = 1000
+    CHANGE_LOG_COMPACT_AFTER = 24 * 60 * 60
+    CHANGE_LOG_COMPACT_BATCH_SIZE = 500
+
+    # Idempotency keys (storeify.idempotency): results of mutations sent with
+    # one are kept this long (in seconds), up to IDEMPOTENCY_MAX_KEYS of them,
+    # and duplicates wait this long for the first to finish
+    IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+    IDEMPOTENCY_MAX_KEYS = 100000
+    IDEMPOTENCY_WAIT_TIMEOUT = 30
+
+    # Background sweeper (storeify.sweeper): cart items never added to a cart
+    # and carts never purchased are deleted once untouched for this long
+    SWEEPER_CART_ITEM_MAX_AGE = 24 * 60 * 60
+    SWEEPER_CART_MAX_AGE = 30 * 24 * 60 * 60
+    # Rows deleted per transaction, and the pause between transactions so
+    # the sweeper never holds the write lock for long
+    SWEEPER_BATCH_SIZE = 500
+    SWEEPER_BATCH_DELAY = 0.05
+    # Seconds between sweeps when running in the background
+    SWEEPER_INTERVAL = 10 * 60
+
+    # Mutations that hit a concurrent update (storeify.concurrency) are
+    # retried this many times, sleeping a random fraction of an exponentially
+    # growing backoff (in seconds) before each retry
+    CONFLICT_MAX_RETRIES = 3
+    CONFLICT_BACKOFF = 0.01
+
+    # Where the API keeps its data (storeify.repository): 'sqlalchemy' for
+    # the database at DATABASE_URI, or 'memory' for storeify.memory, which
+    # only suits a single server process
+    STORAGE_BACKEND = 'sqlalchemy'
+    # JSON file the memory backend is loaded from and saved to at exit
+    MEMORY_SNAPSHOT_PATH = None
+
+    # Horizontal sharding (storeify.sharding): carts and cart items are spread
+    # over these databases by a hash of userid, while everything else stays
+    # in DATABASE_URI. Empty keeps every table in DATABASE_URI.
+    SHARD_URIS = []
+    # Threads running an admin query on every shard at once
+    SHARD_FANOUT_WORKERS = 8
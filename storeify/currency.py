@@ -7,19 +7,42 @@ class Currency(Enum):
     EUR = 2
 
 
+# Multiplier applied by convert("<base>/<quote>", amount). Also seeded into
+# the exchangerate table, which cart totals are computed from in SQL.
+RATES = {
+    ("USD", "CAD"): 1.33,
+    ("CAD", "USD"): 0.75,
+    ("USD", "EUR"): 0.88,
+    ("EUR", "USD"): 1.14,
+    ("CAD", "EUR"): 0.66,
+    ("EUR", "CAD"): 1.51,
+    ("USD", "USD"): 1.0,
+    ("CAD", "CAD"): 1.0,
+    ("EUR", "EUR"): 1.0,
+}
+
+
+def currency_code(value):
+    """
+    Returns the Currency for a stored currency value. Products loaded from CSV
+    store the code ("USD") while those created through the API store the enum
+    value ("0"), so both are accepted.
+    """
+    if isinstance(value, Currency):
+        return value
+    try:
+        return Currency(int(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return Currency[value]
+    except KeyError:
+        raise ValueError("Invalid currency.")
+
+
 def convert(pair, amount):
-    print(pair)
-    if pair == "USD/CAD":
-        return int(round(amount * 1.33))
-    elif pair == "CAD/USD":
-        return int(round(amount * 0.75))
-    elif pair == "USD/EUR":
-        return int(round(amount * 0.88))
-    elif pair == "EUR/USD":
-        return int(round(amount * 1.14))
-    elif pair == "CAD/EUR":
-        return int(round(amount * 0.66))
-    elif pair == "EUR/CAD":
-        return int(round(amount * 1.51))
-    else:
+    try:
+        rate = RATES[tuple(pair.split("/"))]
+    except KeyError:
         raise ValueError("Invalid currency pair.")
+    return int(round(amount * rate))
@@ -9,15 +9,50 @@ from storeify.config import Config
 Base = declarative_base()
 Session = sessionmaker(autocommit=False, autoflush=False)
 db_session = None
+db_engine = None
+
+
+class LazyQueryProperty(object):
+    """
+    Model.query, resolved against the current session registry on access
+    rather than when the module is imported.
+    """
+
+    def __get__(self, instance, owner):
+        return get_db_session().query_property().__get__(instance, owner)
+
+
+Base.query = LazyQueryProperty()
+
+
+def _register_model_hooks():
+    from storeify.pricing import register_price_hooks
+    register_price_hooks()
 
 
 def init_db_engine():
-    engine = create_engine(Config.DATABASE_URI, convert_unicode=True)
-    Session.configure(bind=engine)
+    _register_model_hooks()
+    global db_engine
+    db_engine = create_engine(Config.DATABASE_URI, convert_unicode=True)
 
     global db_session
-    db_session = scoped_session(Session)
-    Base.query = db_session.query_property()
+    if Config.SHARD_URIS:
+        from storeify.sharding import sharded_session_factory
+        db_session = scoped_session(sharded_session_factory(db_engine))
+    else:
+        Session.configure(bind=db_engine)
+        db_session = scoped_session(Session)
+
+
+def init_db_session(session_factory):
+    """
+    Points the session registry at session_factory rather than at an engine
+    built from Config.DATABASE_URI. Used by the test harness to run every
+    test inside a transaction on a shared connection.
+    """
+    _register_model_hooks()
+    global db_session
+    db_session = scoped_session(session_factory)
 
 
 def get_db_session():
@@ -28,11 +63,49 @@ def get_db_session():
         return db_session
 
 
-def create_db():
-    engine = create_engine(Config.DATABASE_URI, convert_unicode=True)
-    Base.metadata.create_all(bind=engine)
+def dispose_db_engine():
+    """
+    Drops the engine and session registry so that the next call to
+    get_db_session() builds fresh ones. Called in forked worker processes,
+    which must not reuse database connections opened by their parent.
+    """
+    global db_engine, db_session
+    if db_session is not None:
+        db_session.remove()
+    if db_engine is not None:
+        db_engine.dispose()
+    if Config.SHARD_URIS:
+        from storeify.sharding import dispose_shard_engines
+        dispose_shard_engines()
+    db_engine = None
+    db_session = None
+
+
+def create_db(engine=None):
+    from storeify.currency import RATES
+    from storeify.models import ExchangeRate
+
+    tables = None
+    if engine is None:
+        engine = create_engine(Config.DATABASE_URI, convert_unicode=True)
+        if Config.SHARD_URIS:
+            from storeify.sharding import catalog_tables, create_shards
+            create_shards()
+            tables = catalog_tables()
+    Base.metadata.create_all(bind=engine, tables=tables)
+    if engine.execute(ExchangeRate.__table__.select().limit(1)).first() \
+            is None:
+        engine.execute(ExchangeRate.__table__.insert(), [
+            dict(base=base, quote=quote, rate=rate)
+            for (base, quote), rate in RATES.items()])
 
 
 def reset_db():
+    import storeify.models  # noqa: registers the tables on Base.metadata
+
     engine = create_engine(Config.DATABASE_URI, convert_unicode=True)
     Base.metadata.drop_all(bind=engine)
+    if Config.SHARD_URIS:
+        from storeify.sharding import get_shard_engines
+        for shard_engine in get_shard_engines().values():
+            Base.metadata.drop_all(bind=shard_engine)
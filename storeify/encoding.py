@@ -0,0 +1,92 @@
+"""
+Serialization and compression of /graphql responses.
+
+Execution results are encoded with the fastest JSON library available
+(orjson, then ujson, then the standard library), selectable through
+Config.JSON_SERIALIZER. Responses of at least Config.COMPRESSION_MIN_SIZE
+bytes are compressed with brotli (when installed) or gzip, whichever the
+client prefers in Accept-Encoding.
+"""
+import gzip
+import json
+
+from flask import request
+
+from storeify.config import Config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _stdlib_dumps(data):
+    return json.dumps(data, separators=(',', ':'))
+
+
+SERIALIZERS = {'json': _stdlib_dumps}
+if ujson is not None:
+    SERIALIZERS['ujson'] = lambda data: ujson.dumps(data, ensure_ascii=False)
+if orjson is not None:
+    SERIALIZERS['orjson'] = orjson.dumps
+
+
+def get_serializer(name=None):
+    name = name or Config.JSON_SERIALIZER
+    if name == 'auto':
+        for name in ('orjson', 'ujson', 'json'):
+            if name in SERIALIZERS:
+                break
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError('JSON serializer "%s" is not available.' % name)
+
+
+def json_encode(data, pretty=False):
+    # Pretty output is only used by GraphiQL and for ?pretty, where speed
+    # does not matter and a str is expected.
+    if pretty:
+        return json.dumps(data, indent=2, separators=(',', ': '))
+    return get_serializer()(data)
+
+
+COMPRESSORS = {'gzip': lambda body: gzip.compress(
+    body, Config.COMPRESSION_GZIP_LEVEL)}
+if brotli is not None:
+    COMPRESSORS['br'] = lambda body: brotli.compress(
+        body, quality=Config.COMPRESSION_BROTLI_QUALITY)
+
+
+def compress_response(response):
+    """after_request hook compressing large responses."""
+    if response.direct_passthrough or response.is_streamed or \
+            'Content-Encoding' in response.headers or \
+            response.status_code < 200 or response.status_code >= 300:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and \
+            response.content_length < Config.COMPRESSION_MIN_SIZE:
+        return response
+    encoding = request.accept_encodings.best_match(
+        [name for name in ('br', 'gzip') if name in COMPRESSORS])
+    if encoding is None:
+        return response
+
+    body = response.get_data()
+    if len(body) < Config.COMPRESSION_MIN_SIZE:
+        return response
+    response.set_data(COMPRESSORS[encoding](body))
+    response.headers['Content-Encoding'] = encoding
+    return response
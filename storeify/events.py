@@ -0,0 +1,183 @@
+"""
+In-process event bus feeding the GraphQL subscriptions in storeify.schema.
+
+Mutations publish an event once their transaction has committed:
+
+    INVENTORY_CHANGED  {'product_id', 'inventory_count', 'deleted'}
+                       from ProductUpdate (when it sets inventoryCount),
+                       ProductDelete and CartPurchase (per product bought)
+    PRODUCT_UPDATED    {'product_id'} from ProductUpdate
+
+product_id is the product's repository key. Events only reach subscribers
+in the process that published them, so behind storeify.serve a subscription
+sees the changes made through its own worker.
+
+observe() turns a topic into an Observable for a subscription resolver.
+Each subscriber coalesces rapid changes: once an event arrives it waits
+Config.SUBSCRIPTION_COALESCE_WINDOW seconds and then delivers only the
+latest event per product, so a burst of purchases of one product reaches
+the client as a single update. One delivery thread per process flushes
+every subscriber when its window is up, so subscribers cost no thread of
+their own; a subscriber that is slow to take its events holds up the rest.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from rx import Observable
+
+from storeify.config import Config
+
+INVENTORY_CHANGED = 'inventory_changed'
+PRODUCT_UPDATED = 'product_updated'
+
+log = logging.getLogger(__name__)
+
+
+class EventBus(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def subscribe(self, topic, callback):
+        """
+        Calls callback(event) for every event on topic and returns a
+        function that unsubscribes it. Callbacks run in the publishing
+        thread, so they should only hand the event on.
+        """
+        with self.lock:
+            self.subscribers.setdefault(topic, []).append(callback)
+
+        def unsubscribe():
+            with self.lock:
+                callbacks = self.subscribers.get(topic, [])
+                if callback in callbacks:
+                    callbacks.remove(callback)
+        return unsubscribe
+
+    def publish(self, topic, event):
+        with self.lock:
+            callbacks = list(self.subscribers.get(topic, ()))
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception:
+                log.exception('Delivering a %s event failed', topic)
+
+
+bus = EventBus()
+
+
+def publish(topic, **event):
+    bus.publish(topic, event)
+
+
+class Coalescer(object):
+    """Delivers the latest event per key to on_next, at most once a window."""
+
+    def __init__(self, on_next, window, delivery):
+        self.on_next = on_next
+        self.window = window
+        self.delivery = delivery
+        self.pending = OrderedDict()
+        self.scheduled = False
+        self.closed = False
+
+    def add(self, key, event):
+        with self.delivery.condition:
+            if self.closed:
+                return
+            self.pending[key] = event
+            if not self.scheduled:
+                # Let the changes that follow close behind be folded in
+                self.scheduled = True
+                self.delivery.schedule(self, time.monotonic() + self.window)
+
+    def close(self):
+        with self.delivery.condition:
+            self.closed = True
+            self.pending.clear()
+
+    def take(self):
+        """The events to deliver now. Called with the delivery's lock held."""
+        self.scheduled = False
+        events = list(self.pending.values())
+        self.pending.clear()
+        return events
+
+
+class Delivery(threading.Thread):
+    """The thread flushing every Coalescer of the process when it is due."""
+
+    def __init__(self):
+        super(Delivery, self).__init__(name='storeify-subscriptions',
+                                       daemon=True)
+        self.condition = threading.Condition()
+        self.due = []
+        self.order = itertools.count()
+
+    def schedule(self, coalescer, at):
+        """Flushes coalescer at monotonic time at. Called with the lock held."""
+        heapq.heappush(self.due, (at, next(self.order), coalescer))
+        self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.due or self.due[0][0] > time.monotonic():
+                    self.condition.wait(
+                        self.due[0][0] - time.monotonic() if self.due
+                        else None)
+                _, _, coalescer = heapq.heappop(self.due)
+                events = coalescer.take()
+            for event in events:
+                try:
+                    coalescer.on_next(event)
+                except Exception:
+                    log.exception('Delivering a subscription event failed')
+
+
+_delivery = None
+_delivery_lock = threading.Lock()
+
+
+def get_delivery():
+    """The process's Delivery thread, started on first use."""
+    global _delivery
+    with _delivery_lock:
+        # Threads do not survive a fork; a worker starts its own
+        if _delivery is None or not _delivery.is_alive():
+            _delivery = Delivery()
+            _delivery.start()
+        return _delivery
+
+
+def observe(topic, product_ids=None, window=None):
+    """
+    An Observable of the events on topic, of the given products only if
+    product_ids is given, coalesced per product over window seconds
+    (Config.SUBSCRIPTION_COALESCE_WINDOW by default).
+    """
+    if window is None:
+        window = Config.SUBSCRIPTION_COALESCE_WINDOW
+    if product_ids is not None:
+        product_ids = set(product_ids)
+
+    def subscribe(observer):
+        coalescer = Coalescer(observer.on_next, window, get_delivery())
+
+        def receive(event):
+            if product_ids is None or event['product_id'] in product_ids:
+                coalescer.add(event['product_id'], event)
+
+        unsubscribe = bus.subscribe(topic, receive)
+
+        def dispose():
+            unsubscribe()
+            coalescer.close()
+        return dispose
+
+    return Observable.create(subscribe)
@@ -0,0 +1,240 @@
+"""
+Idempotency keys for mutations.
+
+Clients that retry a mutation after a timeout send it with an
+Idempotency-Key header, or an idempotencyKey argument (which wins over the
+header). The first request with a key runs the mutation and stores its
+payload under (key, mutation field) in the same transaction as its writes;
+retries with the same key are answered from the store without running the
+mutation again, so a retried cartPurchase never takes inventory twice and a
+retried cartItemCreate never creates a second item.
+
+    client: cartPurchase(cartID: ..., idempotencyKey: "k1")  runs, stores
+    client: cartPurchase(cartID: ..., idempotencyKey: "k1")  replayed
+    client: cartPurchase(cartID: ...other, idempotencyKey: "k1")  error
+
+A digest of the mutation's arguments is stored with the payload, and a key
+sent again with other arguments is an error rather than a replay. The header
+covers every idempotent field of the request, so it is stored per field's
+alias too: `a: cartItemCreate(...) b: cartItemCreate(...)` creates two items
+once each. Fields with the same alias in different operations of a batch
+cannot share the header and are rejected.
+
+The payload is stored as the keys of the rows it returns, which a replay
+loads again, so a replay shows them as they are now (a row deleted since
+comes back as null). A mutation that fails stores nothing and runs again on
+retry. A duplicate arriving while the first is still running waits for it
+in the same process (up to Config.IDEMPOTENCY_WAIT_TIMEOUT seconds); one
+handled by another process at the same time loses on the primary key when
+it commits, is rolled back and replays the winner's result.
+
+Keys are kept for Config.IDEMPOTENCY_KEY_TTL seconds. The sweeper deletes
+expired ones and, past Config.IDEMPOTENCY_MAX_KEYS, the oldest; the memory
+backend evicts them as it stores new ones and does not snapshot them.
+"""
+import functools
+import hashlib
+import json
+import threading
+
+from graphql import GraphQLError
+from sqlalchemy import and_, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from storeify.config import Config
+from storeify.models import IdempotencyKey, unix_time
+from storeify.repository import IN_CHUNK_SIZE, get_repository
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+_current = threading.local()
+_lock = threading.Lock()
+_running = {}
+
+
+def request_key(info, idempotency_key=None):
+    """The idempotency key a mutation was sent with, or None."""
+    if idempotency_key is None:
+        context = info.context
+        request = context.get('request') if isinstance(context, dict) \
+            else None
+        if request is not None:
+            idempotency_key = request.headers.get(HEADER)
+    if idempotency_key is not None and \
+            not 0 < len(idempotency_key) <= MAX_KEY_LENGTH:
+        raise GraphQLError('Idempotency keys must have 1 to %d characters.' %
+                           MAX_KEY_LENGTH)
+    return idempotency_key
+
+
+def _operation(info, from_header):
+    """What a key is stored under for the mutation field being resolved."""
+    alias = info.path[-1]
+    if from_header and alias != info.field_name:
+        return '%s:%s' % (info.field_name, alias)
+    return info.field_name
+
+
+def _claim_header(info, operation):
+    # A batch runs its operations with one context, and so one header; a
+    # retry on conflict resolves the same field again with the same info
+    claimed = info.context.setdefault('idempotency_operations', {})
+    if claimed.setdefault(operation, info) is not info:
+        raise GraphQLError('The %s header covers one %s field per request; '
+                           'alias the others or send idempotencyKey '
+                           'arguments.' % (HEADER, operation))
+
+
+def fingerprint(arguments):
+    """Digest of a mutation's arguments, stored with its payload."""
+    return hashlib.sha256(json.dumps(
+        arguments, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# Payloads
+
+def encode_result(repository, payload, arguments):
+    """
+    JSON of a payload's fields, with model instances as their keys, and of
+    the fingerprint of the arguments it was made from.
+    """
+    fields = {}
+    for name, value in payload.items():
+        if hasattr(value, '__tablename__'):
+            value = {'entity': value.__tablename__,
+                     'key': repository.key(value)}
+        fields[name] = value
+    return json.dumps({'arguments': arguments, 'payload': fields},
+                      sort_keys=True)
+
+
+def decode_result(repository, result, arguments):
+    """The payload's fields, if stored for the same arguments."""
+    result = json.loads(result)
+    if result.get('arguments') != arguments:
+        raise GraphQLError('The idempotency key was already used with other '
+                           'arguments.')
+    getters = {'product': repository.get_product,
+               'cart': repository.get_cart,
+               'cartitem': repository.get_cart_item,
+               'order': repository.get_order}
+    fields = {}
+    for name, value in result['payload'].items():
+        if isinstance(value, dict):
+            value = getters[value['entity']](value['key'])
+        fields[name] = value
+    return fields
+
+
+def remember(repository, **payload):
+    """
+    Stores the payload of the mutation being run, if it was sent with an
+    idempotency key. Called inside the mutation's transaction.
+    """
+    pending = getattr(_current, 'pending', None)
+    if pending is not None:
+        key, operation, arguments = pending
+        repository.store_result(key, operation,
+                                encode_result(repository, payload, arguments))
+
+
+# Execution
+
+def _wait_turn(running):
+    with _lock:
+        done = _running.get(running)
+        if done is None:
+            _running[running] = threading.Event()
+            return True
+    if not done.wait(Config.IDEMPOTENCY_WAIT_TIMEOUT):
+        raise GraphQLError('A request with the same idempotency key is still '
+                           'in progress. Please retry.')
+    return False
+
+
+def _finish_turn(running):
+    with _lock:
+        done = _running.pop(running)
+    done.set()
+
+
+def idempotent(mutate):
+    """
+    Decorates a Mutation.mutate (which calls remember() in its transaction)
+    to be answered from the store when its idempotency key was seen before.
+    """
+    @functools.wraps(mutate)
+    def wrapper(root, info, idempotency_key=None, **kwargs):
+        key = request_key(info, idempotency_key)
+        if key is None:
+            return mutate(root, info, **kwargs)
+        operation = _operation(info, idempotency_key is None)
+        if idempotency_key is None:
+            _claim_header(info, operation)
+        arguments = fingerprint(kwargs)
+
+        running = (key, operation)
+        # Duplicates in this process wait for the one running, then replay
+        while not _wait_turn(running):
+            pass
+        try:
+            repository = get_repository()
+            payload_type = info.return_type.graphene_type
+            result = repository.stored_result(key, operation)
+            if result is not None:
+                return payload_type(**decode_result(repository, result,
+                                                    arguments))
+            _current.pending = running + (arguments, )
+            try:
+                return mutate(root, info, **kwargs)
+            except IntegrityError:
+                # Another process stored a result under the key first
+                result = repository.stored_result(key, operation)
+                if result is None:
+                    raise
+                return payload_type(**decode_result(repository, result,
+                                                    arguments))
+            finally:
+                _current.pending = None
+        finally:
+            _finish_turn(running)
+    return wrapper
+
+
+# Expiry
+
+def expire(db_session, now=None, batch_size=None):
+    """
+    Deletes expired keys, and the oldest ones past
+    Config.IDEMPOTENCY_MAX_KEYS, batch_size at a time, committing after each
+    batch. Returns the number of keys deleted.
+    """
+    batch_size = batch_size or Config.SWEEPER_BATCH_SIZE
+    table = IdempotencyKey.__table__
+    now = now if now is not None else unix_time()
+    cutoff = now - Config.IDEMPOTENCY_KEY_TTL
+    newest_dropped = db_session.execute(
+        select([table.c.created_at]).order_by(table.c.created_at.desc())
+        .offset(Config.IDEMPOTENCY_MAX_KEYS).limit(1)).scalar()
+    if newest_dropped is not None:
+        cutoff = max(cutoff, newest_dropped + 1)
+
+    deleted = 0
+    while True:
+        keys = db_session.execute(
+            select([table.c.key, table.c.operation])
+            .where(table.c.created_at < cutoff).limit(batch_size)).fetchall()
+        if not keys:
+            return deleted
+        # Two parameters per key, so IN_CHUNK_SIZE // 2 keys per statement
+        # keeps within SQLite's limit on bound parameters
+        step = IN_CHUNK_SIZE // 2
+        for start in range(0, len(keys), step):
+            db_session.execute(table.delete().where(or_(*[
+                and_(table.c.key == key, table.c.operation == operation)
+                for key, operation in keys[start:start + step]])))
+        db_session.commit()
+        deleted += len(keys)
+        if len(keys) < batch_size:
+            return deleted
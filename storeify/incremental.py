@@ -0,0 +1,430 @@
+"""
+Incremental delivery of /graphql results with @defer and @stream.
+
+graphql-core 2 executes an operation to completion, so a query asking for
+something expensive (a cart total, every product) answers nothing until
+all of it is ready. Clients that send `Accept: multipart/mixed` can mark
+parts of a query to be sent later:
+
+    query {
+        cart(id: "...") {
+            cartItems @stream(initialCount: 5) { product { title } }
+            ... @defer(label: "total") { total }
+        }
+    }
+
+The operation is first run with the deferred fragments cut out and
+streamed lists cut down to initialCount items. That result is sent as the
+first part of a multipart/mixed response, then every deferred fragment
+and every Config.GRAPHQL_STREAM_BATCH_SIZE further list items follow as
+their own parts, in the incremental delivery format of the GraphQL
+working group:
+
+    {"data": {...}, "hasNext": true}
+    {"incremental": [{"data": {...}, "path": [...], "label": ...}],
+     "hasNext": true}
+    {"incremental": [{"items": [...], "path": [..., 5]}], "hasNext": false}
+
+Each part is encoded and sent as soon as it is resolved, so only one
+batch of a long list is held at a time. Requests that don't accept
+multipart/mixed, and batches, get the whole result at once: the
+directives are then ignored, as the spec allows. A @defer directly inside
+another deferred fragment is sent with it.
+"""
+import copy
+from collections import deque, namedtuple
+from itertools import islice
+
+from graphql.execution.executor import complete_value_catching_error, \
+    execute, execute_fields
+from graphql.execution.executors.sync import SyncExecutor
+from graphql.execution.middleware import MiddlewareManager
+from graphql.execution.utils import ExecutionContext, \
+    get_operation_root_type
+from graphql.execution.values import get_argument_values
+from graphql.language import ast
+from graphql.type import GraphQLArgument, GraphQLBoolean, GraphQLInt, \
+    GraphQLList, GraphQLNonNull, GraphQLString
+from graphql.type.directives import DirectiveLocation, GraphQLDirective
+from promise import Promise, is_thenable
+
+from storeify.config import Config
+
+DeferDirective = GraphQLDirective(
+    name='defer',
+    description='Sends the fragment in a later part of a multipart/mixed '
+    'response.',
+    args={
+        'label': GraphQLArgument(GraphQLString),
+        'if': GraphQLArgument(GraphQLBoolean, default_value=True),
+    },
+    locations=[DirectiveLocation.FRAGMENT_SPREAD,
+               DirectiveLocation.INLINE_FRAGMENT])
+
+StreamDirective = GraphQLDirective(
+    name='stream',
+    description='Sends the list items after the first initialCount in '
+    'later parts of a multipart/mixed response.',
+    args={
+        'label': GraphQLArgument(GraphQLString),
+        'initialCount': GraphQLArgument(GraphQLInt, default_value=0),
+        'if': GraphQLArgument(GraphQLBoolean, default_value=True),
+    },
+    locations=[DirectiveLocation.FIELD])
+
+MULTIPART_CONTENT_TYPE = 'multipart/mixed; boundary="-"; deferSpec=20220824'
+_PART_HEADER = b'\r\n---\r\nContent-Type: application/json; charset=utf-8' \
+    b'\r\n\r\n'
+_END = b'\r\n-----\r\n'
+
+
+def accepts_multipart(accept_mimetypes):
+    return any(value.split(';')[0].strip() == 'multipart/mixed' and quality
+               for value, quality in accept_mimetypes)
+
+
+def may_defer(query):
+    """Quick test, before parsing, that a query could use the directives."""
+    return '@defer' in query or '@stream' in query
+
+
+# What to do with the value a field of the executed document resolves to:
+# stream it (the @stream arguments, or None) and/or send deferred fragments
+# on it later ([(label, field AST selecting just the fragment)])
+_FieldPlan = namedtuple('_FieldPlan', 'stream defers')
+
+
+class IncrementalExecution(object):
+    """
+    Runs one operation with its @defer and @stream directives applied.
+    execute() returns the initial result; subsequent_payloads() then yields
+    the later parts.
+    """
+
+    def __init__(self, schema, document_ast, root_value=None,
+                 context_value=None, variable_values=None,
+                 operation_name=None, middleware=None):
+        # Coerces the variables, raising GraphQLError if they are invalid
+        original = ExecutionContext(schema, document_ast, root_value,
+                                    context_value, variable_values,
+                                    operation_name, SyncExecutor(), None,
+                                    False)
+        self.schema = schema
+        self.root_value = root_value
+        self.context_value = context_value
+        self.raw_variable_values = variable_values
+        self.variable_values = original.variable_values
+        self.operation_name = operation_name
+        self.fragments = original.fragments
+        self.plans = {}
+        self.pending = deque()
+        middleware = list(middleware or []) + [self]
+        self.middleware = MiddlewareManager(*middleware,
+                                            wrap_in_promise=False)
+
+        operation = copy.copy(original.operation)
+        # Mutations run one after another; none is deferred
+        root_defers = [] if operation.operation != 'mutation' else None
+        operation.selection_set = self._strip_selections(
+            operation.selection_set, root_defers)
+        self.operation = operation
+        self.operation_type = original.operation.operation
+        self.root_defers = root_defers or []
+        self.document_ast = ast.Document(definitions=[operation])
+        self.exe_context = None
+
+    @property
+    def deferring(self):
+        """Whether any @defer or @stream applies."""
+        return bool(self.plans or self.root_defers)
+
+    # Rewriting the document
+
+    def _directive_args(self, node, directive):
+        for directive_ast in node.directives or ():
+            if directive_ast.name.value == directive.name:
+                args = get_argument_values(directive.args,
+                                           directive_ast.arguments,
+                                           self.variable_values)
+                return None if args.get('if') is False else args
+        return None
+
+    def _without(self, directives, directive):
+        return [directive_ast for directive_ast in directives or ()
+                if directive_ast.name.value != directive.name]
+
+    def _strip_selections(self, selection_set, defers):
+        """
+        Copies selection_set without the fragments it defers, which are
+        appended to defers as (label, InlineFragment). With defers None, the
+        fragments are kept in place instead. Fragment spreads are copied
+        inline, as a fragment can be deferred in one place and not another.
+        """
+        selections = []
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.Field):
+                selections.append(self._strip_field(selection))
+                continue
+
+            if isinstance(selection, ast.FragmentSpread):
+                definition = self.fragments[selection.name.value]
+                fragment = ast.InlineFragment(
+                    type_condition=definition.type_condition,
+                    selection_set=definition.selection_set,
+                    directives=selection.directives,
+                    loc=selection.loc)
+            else:
+                fragment = selection
+            defer = None
+            if defers is not None:
+                defer = self._directive_args(fragment, DeferDirective)
+
+            stripped = copy.copy(fragment)
+            stripped.directives = self._without(fragment.directives,
+                                                DeferDirective)
+            if defer is not None:
+                stripped.selection_set = self._strip_selections(
+                    fragment.selection_set, None)
+                defers.append((defer.get('label'), stripped))
+            else:
+                stripped.selection_set = self._strip_selections(
+                    fragment.selection_set, defers)
+                selections.append(stripped)
+        return ast.SelectionSet(selections=selections,
+                                loc=selection_set.loc)
+
+    def _strip_field(self, field):
+        stripped = copy.copy(field)
+        stripped.directives = self._without(field.directives,
+                                            StreamDirective)
+        defers = []
+        if field.selection_set is not None:
+            stripped.selection_set = self._strip_selections(
+                field.selection_set, defers)
+        stream = self._directive_args(field, StreamDirective)
+        if stream is not None or defers:
+            self.plans[id(stripped)] = _FieldPlan(
+                stream, [(label, self._fragment_field(stripped, fragment))
+                         for label, fragment in defers])
+        return stripped
+
+    def _fragment_field(self, field, fragment):
+        # The field again, selecting only the deferred fragment; completing
+        # the field's value with it resolves just the fragment's fields
+        only_fragment = copy.copy(field)
+        only_fragment.selection_set = ast.SelectionSet(selections=[fragment])
+        return only_fragment
+
+    # Executing
+
+    def resolve(self, next, root, info, **args):
+        """Middleware noting the values that parts are sent later for."""
+        result = next(root, info, **args)
+        plans = [self.plans[id(field_ast)] for field_ast in info.field_asts
+                 if id(field_ast) in self.plans]
+        if not plans:
+            return result
+        if is_thenable(result):
+            return Promise.resolve(result).then(
+                lambda value: self._schedule(plans, info, value))
+        return self._schedule(plans, info, result)
+
+    def _schedule(self, plans, info, value):
+        if value is None or isinstance(value, Exception):
+            return value
+        path = list(info.path)
+        defers = [defer for plan in plans for defer in plan.defers]
+        stream = next((plan.stream for plan in plans
+                       if plan.stream is not None), None)
+        return_type = info.return_type
+        if isinstance(return_type, GraphQLNonNull):
+            return_type = return_type.of_type
+
+        if not isinstance(return_type, GraphQLList):
+            for label, field_ast in defers:
+                self.pending.append(_Defer(label, [(path, value)],
+                                           info.return_type, [field_ast],
+                                           info))
+            return value
+
+        if stream is not None:
+            items = iter(value)
+            value = list(islice(items, max(stream.get('initialCount') or 0,
+                                           0)))
+            self.pending.append(_Stream(stream.get('label'), path, items,
+                                        len(value), info, defers))
+        # A fragment deferred on a list is sent for every item, in one part
+        targets = [(path + [index], item) for index, item in enumerate(value)]
+        for label, field_ast in defers:
+            self.pending.append(_Defer(label, targets, return_type.of_type,
+                                       [field_ast], info))
+        return value
+
+    def execute(self):
+        """The initial result, with deferred and streamed parts left out."""
+        result = execute(self.schema, self.document_ast, self.root_value,
+                         self.context_value, self.raw_variable_values,
+                         self.operation_name, middleware=self.middleware)
+        if result.data is None:
+            self.pending.clear()
+            return result
+
+        self.exe_context = ExecutionContext(
+            self.schema, self.document_ast, self.root_value,
+            self.context_value, self.raw_variable_values,
+            self.operation_name, SyncExecutor(), self.middleware, False)
+        root_type = get_operation_root_type(self.schema, self.operation)
+        for label, fragment in self.root_defers:
+            self.pending.appendleft(_RootDefer(
+                label, [([], self.root_value)], root_type,
+                [ast.Field(name=ast.Name(value='__root'),
+                           selection_set=ast.SelectionSet(
+                               selections=[fragment]))],
+                None))
+        return result
+
+    def subsequent_payloads(self, format_error):
+        """
+        Yields the parts after the initial result, each as a dict in the
+        incremental delivery format.
+        """
+        while self.pending:
+            work = self.pending.popleft()
+            incremental = work.run(self)
+            errors = self.exe_context.errors
+            if errors:
+                self.exe_context.errors = []
+                if not incremental:
+                    incremental = [{'data': None, 'path': work.path}]
+                incremental[0]['errors'] = [format_error(error)
+                                            for error in errors]
+            if incremental:
+                yield {'incremental': incremental,
+                       'hasNext': bool(self.pending)}
+            elif not self.pending:
+                yield {'hasNext': False}
+
+    def payloads(self, format_error):
+        """The initial result and every later part."""
+        initial = self.execute().to_dict(format_error=format_error)
+        initial['hasNext'] = bool(self.pending)
+        yield initial
+        for payload in self.subsequent_payloads(format_error):
+            yield payload
+
+
+def _resolved(value):
+    return value.get() if is_thenable(value) else value
+
+
+class _Defer(object):
+    """A deferred fragment on one or more values, as [(path, value)]."""
+
+    def __init__(self, label, targets, return_type, field_asts, info):
+        self.label = label
+        self.targets = targets
+        self.path = targets[0][0] if targets else []
+        self.return_type = return_type
+        self.field_asts = field_asts
+        self.info = info
+
+    def run(self, execution):
+        exe_context = execution.exe_context
+        completed = []
+        for path, value in self.targets:
+            try:
+                completed.append(self.complete(exe_context, path, value))
+            except Exception as e:
+                exe_context.errors.append(e)
+                completed.append(None)
+        # Resolved together so that data loaders batch across the values
+        try:
+            completed = _resolved(Promise.all(completed))
+        except Exception as e:
+            exe_context.errors.append(e)
+            return []
+
+        entries = []
+        for (path, _), data in zip(self.targets, completed):
+            if data is not None:
+                entry = {'data': data, 'path': path}
+                if self.label is not None:
+                    entry['label'] = self.label
+                entries.append(entry)
+        return entries
+
+    def complete(self, exe_context, path, value):
+        return complete_value_catching_error(
+            exe_context, self.return_type, self.field_asts, self.info, path,
+            value)
+
+
+class _RootDefer(_Defer):
+    """A fragment deferred on the operation itself."""
+
+    def complete(self, exe_context, path, value):
+        # Executed like the operation, as the root value may be None
+        return execute_fields(
+            exe_context, self.return_type, value,
+            exe_context.get_sub_fields(self.return_type, self.field_asts),
+            path, None)
+
+
+class _Stream(object):
+    _end = object()
+
+    def __init__(self, label, path, items, index, info, defers):
+        self.label = label
+        self.path = path
+        self.items = items
+        self.index = index
+        self.info = info
+        self.defers = defers
+        self.next_item = next(items, self._end)
+        return_type = info.return_type
+        if isinstance(return_type, GraphQLNonNull):
+            return_type = return_type.of_type
+        self.item_type = return_type.of_type
+
+    def run(self, execution):
+        if self.next_item is self._end:
+            return []
+        batch = [self.next_item] + list(
+            islice(self.items, Config.GRAPHQL_STREAM_BATCH_SIZE - 1))
+        self.next_item = next(self.items, self._end)
+        start = self.index
+        self.index += len(batch)
+
+        exe_context = execution.exe_context
+        completed = [complete_value_catching_error(
+            exe_context, self.item_type, self.info.field_asts, self.info,
+            self.path + [start + offset], item)
+            for offset, item in enumerate(batch)]
+        try:
+            items = _resolved(Promise.all(completed))
+        except Exception as e:
+            exe_context.errors.append(e)
+            items = [None] * len(batch)
+
+        targets = [(self.path + [start + offset], item)
+                   for offset, item in enumerate(batch)]
+        for label, field_ast in self.defers:
+            execution.pending.append(_Defer(label, targets, self.item_type,
+                                            [field_ast], self.info))
+        if self.next_item is not self._end:
+            execution.pending.append(self)
+
+        entry = {'items': items, 'path': self.path + [start]}
+        if self.label is not None:
+            entry['label'] = self.label
+        return [entry]
+
+
+def multipart(payloads, encode):
+    """The body of a multipart/mixed response, one part per payload."""
+    for payload in payloads:
+        body = encode(payload)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        yield _PART_HEADER + body
+    yield _END
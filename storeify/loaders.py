@@ -0,0 +1,30 @@
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from storeify.repository import get_repository
+
+
+class CartTotalLoader(DataLoader):
+    # Totals change with every cart or product mutation, so they are
+    # batched but never cached.
+    cache = False
+
+    def batch_load_fn(self, cart_keys):
+        totals = get_repository().cart_totals(cart_keys)
+        return Promise.resolve([totals[key] for key in cart_keys])
+
+
+class Loaders(object):
+    """The DataLoaders used while executing a single request."""
+
+    def __init__(self):
+        self.cart_total = CartTotalLoader()
+
+
+def get_loaders(info):
+    # The Flask view puts one Loaders on the context of every request; other
+    # callers (e.g. graphene.test.Client) get unshared loaders.
+    context = info.context
+    if isinstance(context, dict) and 'loaders' in context:
+        return context['loaders']
+    return Loaders()
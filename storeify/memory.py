@@ -0,0 +1,478 @@
+"""
+In-memory storage backend (Config.STORAGE_BACKEND = 'memory').
+
+Products, carts, cart items and orders are kept as model instances that
+never touch a session, in dicts keyed by id. When NumPy is installed the
+`products` filters and sorts run on a storeify.catalog.CatalogIndex kept up
+to date with every write; otherwise they scan the products dict. Converted
+prices are computed from currency.RATES and the sales rollups are kept in
+dicts, mirroring what storeify.pricing and storeify.rollups do in SQL.
+
+Writes are serialized by one lock, held for the whole transaction. Nothing
+is rolled back, so mutations validate everything before their first write.
+
+The store lives in one process: use it with a single server process. If
+Config.MEMORY_SNAPSHOT_PATH is set, the store is loaded from that file on
+start and written back to it by snapshot() and at exit.
+"""
+import atexit
+import bisect
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from storeify.catalog import CatalogIndex, ProductSort, numpy
+from storeify.changelog import change_row, fold
+from storeify.config import Config
+from storeify.currency import Currency, RATES, currency_code
+from storeify.models import Cart, CartItem, Change, Order, OrderLine, \
+    Product, unix_time
+from storeify.orders import order_lines
+from storeify.pricing import price_column
+from storeify.repository import Repository
+from storeify.rollups import order_day
+
+SNAPSHOT_MODELS = (('products', Product), ('carts', Cart),
+                   ('cart_items', CartItem), ('orders', Order),
+                   ('order_lines', OrderLine), ('changes', Change))
+
+
+def _columns(model):
+    return model.__table__.columns
+
+
+def _coerce(model, fields):
+    """Converts values as the database column types would on a round trip."""
+    columns = _columns(model)
+    coerced = {}
+    for name, value in fields.items():
+        if value is not None and name in columns:
+            value = columns[name].type.python_type(value)
+        coerced[name] = value
+    return coerced
+
+
+def _key(id):
+    # Primary keys arrive as strings decoded from global IDs; ones that are
+    # not integers match nothing, as they would in SQL
+    try:
+        return int(id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _row(instance):
+    return dict((column.key, getattr(instance, column.key))
+                for column in _columns(type(instance)))
+
+
+def _set_converted_prices(product):
+    try:
+        quote = currency_code(product.currency).name
+    except ValueError:
+        quote = None
+    for currency in Currency:
+        rate = RATES.get((currency.name, quote))
+        converted = None
+        if rate is not None and product.price is not None:
+            converted = int(round(int(product.price) * rate))
+        setattr(product, price_column(currency).key, converted)
+
+
+class MemoryRepository(Repository):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.snapshot_path = None
+        self._clear()
+
+    def _clear(self):
+        self.products = {}
+        self.carts = {}
+        self.cart_items = {}
+        self.orders = {}
+        self.product_sales = {}
+        self.currency_revenue = {}
+        self.change_log = []
+        # (key, operation): (result, created_at), oldest first
+        self.idempotency_keys = OrderedDict()
+        self.last_ids = dict((name, 0) for name, _ in SNAPSHOT_MODELS)
+        self.index = CatalogIndex() if numpy is not None else None
+
+    @classmethod
+    def from_config(cls):
+        repository = cls()
+        path = Config.MEMORY_SNAPSHOT_PATH
+        if path:
+            if os.path.exists(path):
+                repository.restore(path)
+            repository.snapshot_path = path
+            atexit.register(repository.snapshot)
+        return repository
+
+    def _next_id(self, name):
+        self.last_ids[name] += 1
+        return self.last_ids[name]
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            yield
+
+    # Products
+
+    def get_product(self, id):
+        return self.products.get(_key(id))
+
+    def _index(self, product):
+        if self.index is not None:
+            self.index.upsert(product.id, product.title, product.price,
+                              product.currency, product.inventory_count,
+                              product.can_purchase)
+
+    def find_products(self, **filters):
+        with self.lock:
+            if self.index is not None:
+                return [self.products[id] for id in self.index.query(
+                    **filters)]
+            return self._scan_products(**filters)
+
+    def _scan_products(self, id=None, title=None, inventory_minimum=None,
+                       can_purchase=None, price_minimum=None,
+                       price_maximum=None, currency=None, sort=None,
+                       first=None, offset=None):
+        if id is not None:
+            products = [self.products[_key(id)]] \
+                if _key(id) in self.products else []
+        else:
+            products = list(self.products.values())
+        if currency is not None:
+            currency = Currency(currency)
+
+        def matches(product):
+            try:
+                code = currency_code(product.currency)
+            except ValueError:
+                code = None
+            return (title is None or product.title == title) and \
+                (inventory_minimum is None or
+                 (product.inventory_count or 0) >= inventory_minimum) and \
+                (can_purchase is None or
+                 product.can_purchase == can_purchase) and \
+                (price_minimum is None or
+                 (product.price or 0) >= price_minimum) and \
+                (price_maximum is None or
+                 (product.price or 0) <= price_maximum) and \
+                (currency is None or code == currency)
+
+        products = [product for product in products if matches(product)]
+        sort = ProductSort(sort) if sort is not None else ProductSort.ID
+        if sort == ProductSort.ID:
+            products.sort(key=lambda product: product.id)
+        elif sort in (ProductSort.PRICE, ProductSort.PRICE_DESC):
+            sign = -1 if sort == ProductSort.PRICE_DESC else 1
+            products.sort(key=lambda product: (
+                sign * (product.price or 0), product.id))
+        else:
+            sign = -1 if sort == ProductSort.INVENTORY_COUNT_DESC else 1
+            products.sort(key=lambda product: (
+                sign * (product.inventory_count or 0), product.id))
+        start = offset or 0
+        stop = start + first if first is not None else None
+        return products[start:stop]
+
+    def get_products(self, ids):
+        return dict((id, self.products[id]) for id in ids
+                    if id in self.products)
+
+    def create_product(self, **fields):
+        product = Product(**_coerce(Product, fields))
+        product.id = self._next_id('products')
+        product.version = 1
+        _set_converted_prices(product)
+        self.products[product.id] = product
+        self._index(product)
+        return product
+
+    def update_product(self, product, **fields):
+        for name, value in _coerce(Product, fields).items():
+            setattr(product, name, value)
+        product.version += 1
+        _set_converted_prices(product)
+        self._index(product)
+        return product
+
+    def delete_product(self, product):
+        del self.products[product.id]
+        if self.index is not None:
+            self.index.remove(product.id)
+
+    # Cart items
+
+    def get_cart_item(self, id):
+        return self.cart_items.get(_key(id))
+
+    def get_cart_items(self, keys):
+        return [self.cart_items[_key(key)] for key in keys
+                if _key(key) in self.cart_items]
+
+    def cart_items_in(self, cart):
+        return list(cart.cart_items)
+
+    def create_cart_item(self, product, quantity, userid=None):
+        now = unix_time()
+        cart_item = CartItem(id=self._next_id('cart_items'), product=product,
+                             product_id=product.id, quantity=int(quantity),
+                             userid=userid, created_at=now, updated_at=now,
+                             version=1)
+        self.cart_items[cart_item.id] = cart_item
+        return cart_item
+
+    def update_cart_item(self, cart_item, **fields):
+        for name, value in _coerce(CartItem, fields).items():
+            setattr(cart_item, name, value)
+        if 'product' in fields:
+            product = fields['product']
+            cart_item.product_id = product.id if product is not None else None
+        self._touch(cart_item)
+        return cart_item
+
+    def _touch(self, instance):
+        instance.updated_at = unix_time()
+        instance.version += 1
+
+    # Carts
+
+    def get_cart(self, id):
+        return self.carts.get(_key(id))
+
+    def carts_for_user(self, userid):
+        with self.lock:
+            return [cart for cart in self.carts.values()
+                    if cart.userid == userid]
+
+    def create_cart(self, userid, currency):
+        now = unix_time()
+        cart = Cart(id=self._next_id('carts'), userid=int(userid),
+                    currency=str(currency), created_at=now, updated_at=now,
+                    version=1)
+        self.carts[cart.id] = cart
+        return cart
+
+    def delete_cart(self, cart):
+        del self.carts[cart.id]
+        for cart_item in cart.cart_items:
+            cart_item.cart_id = None
+            self._touch(cart_item)
+
+    def add_cart_items(self, cart, cart_items):
+        for cart_item in cart_items:
+            if cart_item.cart_id is not None and \
+                    cart_item.cart_id != cart.id and \
+                    cart_item.cart_id in self.carts:
+                self.carts[cart_item.cart_id].cart_items.remove(cart_item)
+            if cart_item.cart_id != cart.id:
+                cart.cart_items.append(cart_item)
+            cart_item.cart_id = cart.id
+            cart_item.userid = cart.userid
+            self._touch(cart_item)
+        self._touch(cart)
+
+    def remove_cart_items(self, cart, cart_items):
+        for cart_item in cart_items:
+            cart.cart_items.remove(cart_item)
+            cart_item.cart_id = None
+            self._touch(cart_item)
+        self._touch(cart)
+
+    def cart_totals(self, cart_keys):
+        totals = {}
+        for key in cart_keys:
+            cart = self.carts.get(_key(key))
+            total = 0
+            if cart is not None and cart.cart_items:
+                column = price_column(currency_code(cart.currency)).key
+                for cart_item in cart.cart_items:
+                    unit_price = getattr(cart_item.product, column)
+                    if unit_price is None:
+                        raise ValueError("Invalid currency pair.")
+                    total += unit_price * cart_item.quantity
+            totals[key] = total
+        return totals
+
+    def purchase_cart(self, cart):
+        currency, lines = order_lines(cart)
+        for cart_item in cart.cart_items:
+            product = cart_item.product
+            product.inventory_count -= cart_item.quantity
+            product.version += 1
+            self._index(product)
+        order = self._add_order(dict(
+            userid=cart.userid, cart_id=self.key(cart),
+            currency=currency.name,
+            total=sum(line['total'] for line in lines),
+            created_at=unix_time()), lines)
+        cart.purchased_at = order.created_at
+        self._touch(cart)
+        return order
+
+    def _add_order(self, fields, lines):
+        order = Order(**fields)
+        if order.id is None:
+            order.id = self._next_id('orders')
+        self.last_ids['orders'] = max(self.last_ids['orders'], order.id)
+        for line in lines:
+            line = OrderLine(**dict(line, order_id=order.id))
+            if line.id is None:
+                line.id = self._next_id('order_lines')
+            self.last_ids['order_lines'] = max(self.last_ids['order_lines'],
+                                               line.id)
+            order.lines.append(line)
+        self.orders[order.id] = order
+        self._apply_order(order)
+        return order
+
+    # Orders and sales
+
+    def _apply_order(self, order):
+        day = order_day(order)
+        for line in order.lines:
+            key = (line.product_id, day, order.currency)
+            units, revenue = self.product_sales.get(key, (0, 0))
+            self.product_sales[key] = (units + line.quantity,
+                                       revenue + line.total)
+        key = (order.currency, day)
+        orders, revenue = self.currency_revenue.get(key, (0, 0))
+        self.currency_revenue[key] = (orders + 1, revenue + order.total)
+
+    def get_order(self, id):
+        return self.orders.get(_key(id))
+
+    def orders_page(self, userid, first, after=None):
+        with self.lock:
+            orders = [order for order in self.orders.values()
+                      if order.userid == userid and
+                      (after is None or order.id < after)]
+        orders.sort(key=lambda order: order.id, reverse=True)
+        return orders[:first]
+
+    def top_products(self, since=None, limit=10):
+        units = {}
+        with self.lock:
+            for (product_id, day, _), (sold, _) in \
+                    self.product_sales.items():
+                if since is None or day >= since:
+                    units[product_id] = units.get(product_id, 0) + sold
+        ranked = sorted(units.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit]
+
+    def revenue(self, currency, since=None):
+        with self.lock:
+            return sum(revenue for (code, day), (_, revenue) in
+                       self.currency_revenue.items()
+                       if code == currency and
+                       (since is None or day >= since))
+
+    def rebuild_rollups(self):
+        with self.lock:
+            self.product_sales = {}
+            self.currency_revenue = {}
+            for id in sorted(self.orders):
+                self._apply_order(self.orders[id])
+
+    # Change log
+
+    def record_change(self, instance, operation, fields=None):
+        change = Change(**change_row(instance.__tablename__,
+                                     self.key(instance), operation, fields))
+        change.seq = self._next_id('changes')
+        self.change_log.append(change)
+
+    def changes(self, after, limit):
+        with self.lock:
+            # Appended in seq order
+            start = bisect.bisect_right(
+                [change.seq for change in self.change_log], after)
+            return self.change_log[start:start + limit]
+
+    def compact_changes(self, before):
+        with self.lock:
+            folded = set(id(change) for change in fold(
+                [change for change in self.change_log
+                 if change.created_at < before]))
+            self.change_log = [change for change in self.change_log
+                                if id(change) not in folded]
+        return len(folded)
+
+    def stored_result(self, key, operation):
+        with self.lock:
+            result, created_at = self.idempotency_keys.get(
+                (key, operation), (None, None))
+        if result is None or \
+                created_at < unix_time() - Config.IDEMPOTENCY_KEY_TTL:
+            return None
+        return result
+
+    def store_result(self, key, operation, result):
+        keys = self.idempotency_keys
+        keys.pop((key, operation), None)
+        keys[(key, operation)] = (result, unix_time())
+        expired = unix_time() - Config.IDEMPOTENCY_KEY_TTL
+        while keys and (len(keys) > Config.IDEMPOTENCY_MAX_KEYS or
+                        next(iter(keys.values()))[1] < expired):
+            keys.popitem(last=False)
+
+    # Snapshots
+
+    def snapshot(self, path=None):
+        """Writes the whole store to path as JSON, atomically."""
+        path = path or self.snapshot_path
+        with self.lock:
+            data = {
+                'products': [_row(p) for p in self.products.values()],
+                'carts': [_row(c) for c in self.carts.values()],
+                'cart_items': [_row(i) for i in self.cart_items.values()],
+                'orders': [_row(o) for o in self.orders.values()],
+                'order_lines': [_row(line) for o in self.orders.values()
+                                for line in o.lines],
+                'changes': [_row(change) for change in self.change_log],
+                'last_ids': self.last_ids,
+            }
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as snapshot:
+            json.dump(data, snapshot)
+        os.replace(temporary, path)
+
+    def restore(self, path):
+        """Replaces the contents of the store with a snapshot."""
+        with open(path) as snapshot:
+            data = json.load(snapshot)
+        with self.lock:
+            self._clear()
+            for row in data['products']:
+                product = Product(**row)
+                self.products[product.id] = product
+                self._index(product)
+            for row in data['carts']:
+                cart = Cart(**row)
+                self.carts[cart.id] = cart
+            for row in sorted(data['cart_items'], key=lambda row: row['id']):
+                cart_item = CartItem(**row)
+                cart_item.product = self.products.get(cart_item.product_id)
+                self.cart_items[cart_item.id] = cart_item
+                if cart_item.cart_id in self.carts:
+                    self.carts[cart_item.cart_id].cart_items.append(cart_item)
+            lines = {}
+            for row in data['order_lines']:
+                lines.setdefault(row['order_id'], []).append(row)
+            for row in sorted(data['orders'], key=lambda row: row['id']):
+                self._add_order(row, sorted(lines.get(row['id'], []),
+                                            key=lambda line: line['id']))
+            # Snapshots taken before the change log existed have none
+            self.change_log = [Change(**row) for row in
+                                sorted(data.get('changes', []),
+                                       key=lambda row: row['seq'])]
+            self.last_ids.update(data['last_ids'])
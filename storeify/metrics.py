@@ -0,0 +1,304 @@
+"""
+Operational metrics, served at /metrics in the Prometheus text format.
+
+Requests, commits and session sizes are counted as they happen, with a
+lock and a couple of integer additions each. Everything else (connection
+pools, admission pools, caches, the sweeper and conflict counters) is only
+read when /metrics is scraped. Metrics are per process: behind
+storeify.serve every worker keeps its own, so scrape each worker (e.g. with
+reuse_port off and one port each) or expect a different worker's numbers on
+every scrape.
+
+    storeify_graphql_requests_total{operation,status}
+    storeify_graphql_request_duration_seconds{operation}   histogram
+    storeify_db_commit_duration_seconds                    histogram
+    storeify_db_session_identity_map_size                  histogram
+    storeify_db_pool_{size,checked_in,checked_out,overflow}{engine}
+    storeify_admission_{limit,in_flight,waiting}{pool}
+    storeify_admission_rejected_total{pool,reason}
+    storeify_cache_{hits,misses}_total{cache}, storeify_cache_hit_ratio
+    storeify_sweeper_*, storeify_mutation_*_total{mutation}
+
+Operations are labelled with their name (operationName, or the name in the
+query), "anonymous", or "batch" for batched requests. Past
+Config.METRICS_MAX_OPERATIONS distinct names, new ones count as "other".
+"""
+import bisect
+import re
+import threading
+
+from storeify.config import Config
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_operation_name = re.compile(r'\s*(?:query|mutation|subscription)\s+(\w+)')
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """Cumulative [(upper bound, count)], ending with +Inf, and the sum."""
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'), ), counts):
+            running += count
+            cumulative.append((bound, running))
+        return cumulative, total
+
+
+class CacheStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.request_seconds = {}
+        self.commit_seconds = Histogram(DURATION_BUCKETS)
+        self.identity_map_sizes = Histogram(SIZE_BUCKETS)
+
+    def _operation(self, operation):
+        # Caller holds the lock
+        if operation not in self.request_seconds and \
+                len(self.request_seconds) >= Config.METRICS_MAX_OPERATIONS:
+            operation = 'other'
+        histogram = self.request_seconds.get(operation)
+        if histogram is None:
+            histogram = self.request_seconds[operation] = Histogram(
+                DURATION_BUCKETS)
+        return operation, histogram
+
+    def observe_request(self, operation, status, seconds):
+        with self.lock:
+            operation, histogram = self._operation(operation)
+            key = (operation, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+        histogram.observe(seconds)
+
+    def observe_commit(self, seconds):
+        self.commit_seconds.observe(seconds)
+
+    def observe_identity_map(self, size):
+        self.identity_map_sizes.observe(size)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            requests = sorted(self.requests.items())
+            request_seconds = sorted(self.request_seconds.items())
+
+        _header(lines, 'storeify_graphql_requests_total', 'counter',
+                '/graphql requests by operation and HTTP status.')
+        for (operation, status), count in requests:
+            _sample(lines, 'storeify_graphql_requests_total',
+                    dict(operation=operation, status=status), count)
+        _header(lines, 'storeify_graphql_request_duration_seconds',
+                'histogram', 'Time to answer a /graphql request (to the '
+                'first part, for incremental responses).')
+        for operation, histogram in request_seconds:
+            _histogram(lines, 'storeify_graphql_request_duration_seconds',
+                       dict(operation=operation), histogram)
+
+        _header(lines, 'storeify_db_commit_duration_seconds', 'histogram',
+                'Time to commit a mutation\'s transaction.')
+        _histogram(lines, 'storeify_db_commit_duration_seconds', {},
+                   self.commit_seconds)
+        _header(lines, 'storeify_db_session_identity_map_size', 'histogram',
+                'Objects in a request\'s session when it ends.')
+        _histogram(lines, 'storeify_db_session_identity_map_size', {},
+                   self.identity_map_sizes)
+
+        _pools(lines)
+        _admission(lines)
+        _caches(lines)
+        _sweeper(lines)
+        _conflicts(lines)
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _header(lines, name, kind, help):
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s %s' % (name, kind))
+
+
+def _sample(lines, name, labels, value):
+    if labels:
+        name = '%s{%s}' % (name, ','.join(
+            '%s="%s"' % (label, _escape(labels[label]))
+            for label in sorted(labels)))
+    lines.append('%s %s' % (name, _format(value)))
+
+
+def _histogram(lines, name, labels, histogram):
+    cumulative, total = histogram.snapshot()
+    for bound, count in cumulative:
+        _sample(lines, name + '_bucket', dict(labels, le=_format(bound)),
+                count)
+    _sample(lines, name + '_sum', labels, total)
+    _sample(lines, name + '_count', labels, cumulative[-1][1])
+
+
+def _engines():
+    from storeify import db, sharding
+    engines = []
+    if db.db_engine is not None:
+        engines.append(('default', db.db_engine))
+    engines.extend(sorted((sharding.shard_engines or {}).items()))
+    return engines
+
+
+def _pools(lines):
+    gauges = (('size', 'size', 'Connections the pool keeps.'),
+              ('checked_in', 'checkedin', 'Idle connections in the pool.'),
+              ('checked_out', 'checkedout', 'Connections in use.'),
+              ('overflow', 'overflow',
+               'Connections opened beyond the pool size.'))
+    samples = dict((gauge, []) for gauge, _, _ in gauges)
+    for name, engine in _engines():
+        # QueuePool has all of these; SQLite's pools have few or none
+        for gauge, method, _ in gauges:
+            method = getattr(engine.pool, method, None)
+            if callable(method):
+                samples[gauge].append((name, method()))
+    for gauge, _, help in gauges:
+        if samples[gauge]:
+            _header(lines, 'storeify_db_pool_' + gauge, 'gauge', help)
+            for name, value in samples[gauge]:
+                _sample(lines, 'storeify_db_pool_' + gauge,
+                        dict(engine=name), value)
+
+
+def _admission(lines):
+    from storeify import admission
+    stats = sorted((name, pool.as_dict())
+                   for name, pool in list(admission.pools.items()))
+    for gauge, help in (('limit', 'Requests a pool currently lets run at '
+                         'once.'),
+                        ('in_flight', 'Requests running.'),
+                        ('waiting', 'Requests queued for a slot.')):
+        _header(lines, 'storeify_admission_' + gauge, 'gauge', help)
+        for name, pool in stats:
+            _sample(lines, 'storeify_admission_' + gauge, dict(pool=name),
+                    pool[gauge])
+    _header(lines, 'storeify_admission_rejected_total', 'counter',
+            'Requests turned away, because the queue was full (429) or '
+            'their wait timed out (503).')
+    for name, pool in stats:
+        for reason, count in sorted(pool['rejected'].items()):
+            _sample(lines, 'storeify_admission_rejected_total',
+                    dict(pool=name, reason=reason), count)
+
+
+def _caches(lines):
+    from storeify.backend import document_backend
+    from storeify.catalog import index_stats
+
+    caches = (('document', document_backend.stats),
+              ('catalog_index', index_stats))
+    counts = []
+    for name, stats in caches:
+        with stats.lock:
+            counts.append((name, stats.hits, stats.misses))
+    _header(lines, 'storeify_cache_hits_total', 'counter', 'Cache hits.')
+    for name, hits, _ in counts:
+        _sample(lines, 'storeify_cache_hits_total', dict(cache=name), hits)
+    _header(lines, 'storeify_cache_misses_total', 'counter',
+            'Cache misses (for the catalog index, loads from the database).')
+    for name, _, misses in counts:
+        _sample(lines, 'storeify_cache_misses_total', dict(cache=name),
+                misses)
+    _header(lines, 'storeify_cache_hit_ratio', 'gauge',
+            'Hits over lookups since the process started.')
+    for name, hits, misses in counts:
+        _sample(lines, 'storeify_cache_hit_ratio', dict(cache=name),
+                float(hits) / (hits + misses) if hits + misses else 0.0)
+
+
+def _sweeper(lines):
+    from storeify import sweeper
+    stats = sweeper.stats.as_dict()
+    for name in ('runs', 'batches', 'cart_items_deleted', 'carts_deleted',
+                 'idempotency_keys_deleted', 'errors'):
+        _header(lines, 'storeify_sweeper_%s_total' % name, 'counter',
+                'Sweeper %s.' % name.replace('_', ' '))
+        _sample(lines, 'storeify_sweeper_%s_total' % name, {}, stats[name])
+    if stats['last_run_at'] is not None:
+        _header(lines, 'storeify_sweeper_last_run_timestamp_seconds',
+                'gauge', 'When the last sweep ran.')
+        _sample(lines, 'storeify_sweeper_last_run_timestamp_seconds', {},
+                stats['last_run_at'])
+        _header(lines, 'storeify_sweeper_last_run_duration_seconds',
+                'gauge', 'How long the last sweep took.')
+        _sample(lines, 'storeify_sweeper_last_run_duration_seconds', {},
+                stats['last_run_seconds'])
+
+
+def _conflicts(lines):
+    from storeify import concurrency
+    stats = sorted(concurrency.stats.as_dict().items())
+    for name, help in (('attempts', 'Mutation attempts, retries included.'),
+                       ('conflicts', 'Attempts failed by a version '
+                        'conflict.'),
+                       ('failures', 'Mutations that ran out of retries.')):
+        _header(lines, 'storeify_mutation_%s_total' % name, 'counter', help)
+        for mutation, counts in stats:
+            _sample(lines, 'storeify_mutation_%s_total' % name,
+                    dict(mutation=mutation), counts[name])
+
+
+def operation_label(data):
+    """The operation label of a parsed /graphql request body."""
+    if isinstance(data, list):
+        return 'batch'
+    if not isinstance(data, dict):
+        return 'anonymous'
+    name = data.get('operationName')
+    if name:
+        return name
+    match = _operation_name.match(data.get('query') or '')
+    return match.group(1) if match else 'anonymous'
+
+
+metrics = Metrics()
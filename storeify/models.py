@@ -1,28 +1,61 @@
+import time
+
 from flask import current_app
 
-from sqlalchemy import create_engine, Column, Integer, Boolean, String, ForeignKey
+from sqlalchemy import create_engine, Column, Date, Index, Integer, Boolean, Float, String, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, scoped_session
 
 from storeify.db import Base
 
 
+def unix_time():
+    return int(time.time())
+
+
 class Cart(Base):
     __tablename__ = "cart"
     id = Column(Integer, primary_key=True)
-    userid = Column(Integer)
+    userid = Column(Integer, index=True)
     cart_items = relationship("CartItem")
     currency = Column(String)
     total = Column(Integer)
+    # Unix times; carts that are never purchased are eventually removed by
+    # storeify.sweeper based on updated_at
+    created_at = Column(Integer, default=unix_time)
+    updated_at = Column(Integer, default=unix_time, onupdate=unix_time)
+    purchased_at = Column(Integer)
+    # Bumped by every UPDATE; a flush of a stale row raises StaleDataError
+    # (see storeify.concurrency)
+    version = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index('ix_cart_purchased_at_updated_at', 'purchased_at', 'updated_at'),
+    )
+    __mapper_args__ = {'version_id_col': version}
 
 
 class CartItem(Base):
     __tablename__ = "cartitem"
     id = Column(Integer, primary_key=True)
-    cart_id = Column(Integer, ForeignKey('cart.id'))
+    cart_id = Column(Integer, ForeignKey('cart.id'), index=True)
     product = relationship("Product")
     product_id = Column(Integer, ForeignKey('product.id'))
     quantity = Column(Integer, nullable=False)
+    # The user the item was created for, or that of its cart; decides the
+    # shard the item lives on (see storeify.sharding)
+    userid = Column(Integer)
+    created_at = Column(Integer, default=unix_time)
+    updated_at = Column(Integer, default=unix_time, onupdate=unix_time)
+    version = Column(Integer, nullable=False)
+    # The key the item was created under, once it has been moved to another
+    # shard; it keeps that key (see storeify.sharding)
+    moved_from = Column(String, index=True)
+
+    # AUTOINCREMENT so that SQLite never hands out the id of an item moved
+    # off a shard again, which would give two items the same key
+    __table_args__ = {'sqlite_autoincrement': True}
+    __mapper_args__ = {'version_id_col': version}
 
 
 class Product(Base):
@@ -34,7 +67,117 @@ class Product(Base):
     currency = Column(String)
     inventory_count = Column(Integer)
     can_purchase = Column(Boolean)
+    # The price converted into each Currency, maintained by storeify.pricing
+    price_usd = Column(Integer)
+    price_cad = Column(Integer)
+    price_eur = Column(Integer)
+    version = Column(Integer, nullable=False)
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return "<Product(title=%s price=%d inventory_count=%d" % (
             self.title, self.price, self.inventory_count)
+
+
+class ExchangeRate(Base):
+    __tablename__ = "exchangerate"
+    # Multiplier applied by convert("<base>/<quote>", amount)
+    base = Column(String, primary_key=True)
+    quote = Column(String, primary_key=True)
+    rate = Column(Float, nullable=False)
+
+
+# Order history ledger. Rows are only ever inserted (see storeify.orders), so
+# the tables carry no foreign keys to the mutable catalog and only the
+# indexes the ledger queries need.
+
+class Order(Base):
+    __tablename__ = "order"
+    id = Column(Integer, primary_key=True)
+    userid = Column(Integer, nullable=False)
+    # Repository key of the cart, which carries its shard when sharding
+    cart_id = Column(String, nullable=False)
+    currency = Column(String(3), nullable=False)
+    # Sum of the line totals, in the order currency
+    total = Column(Integer, nullable=False)
+    # Unix time of the purchase
+    created_at = Column(Integer, nullable=False)
+    lines = relationship("OrderLine", order_by="OrderLine.id")
+
+    __table_args__ = (Index('ix_order_userid_id', 'userid', 'id'), )
+
+
+class OrderLine(Base):
+    __tablename__ = "order_line"
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey('order.id'), nullable=False,
+                      index=True)
+    product_id = Column(Integer, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    # Product price and currency at the time of sale
+    unit_price = Column(Integer, nullable=False)
+    currency = Column(String(3), nullable=False)
+    # quantity * unit price converted into the order currency
+    total = Column(Integer, nullable=False)
+
+
+# Sales rollups, maintained incrementally from the order ledger by
+# storeify.rollups. Days are UTC.
+
+class ProductSalesDaily(Base):
+    __tablename__ = "product_sales_daily"
+    product_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    currency = Column(String(3), primary_key=True)
+    units = Column(Integer, nullable=False)
+    # In `currency`, the currency of the orders
+    revenue = Column(Integer, nullable=False)
+
+    __table_args__ = (Index('ix_product_sales_daily_day', 'day'), )
+
+
+class CurrencyRevenueDaily(Base):
+    __tablename__ = "currency_revenue_daily"
+    currency = Column(String(3), primary_key=True)
+    day = Column(Date, primary_key=True)
+    orders = Column(Integer, nullable=False)
+    revenue = Column(Integer, nullable=False)
+
+
+# Change data capture log, appended to by every mutation in its own
+# transaction and folded by compaction (see storeify.changelog).
+
+class Change(Base):
+    __tablename__ = "change_log"
+    # AUTOINCREMENT so that SQLite never hands out a seq again once the
+    # newest changes are compacted away
+    seq = Column(Integer, primary_key=True)
+    # Table name and repository key of the changed row
+    entity = Column(String, nullable=False)
+    entity_id = Column(String, nullable=False)
+    # create, update or delete
+    operation = Column(String(6), nullable=False)
+    # JSON object of the fields set
+    fields = Column(String, nullable=False)
+    # Unix time of the change
+    created_at = Column(Integer, nullable=False)
+
+    __table_args__ = (Index('ix_change_log_created_at', 'created_at'),
+                      {'sqlite_autoincrement': True})
+
+
+# Results of mutations sent with an idempotency key, written in the
+# mutation's transaction and expired by the sweeper (see storeify.idempotency).
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_key"
+    # The client's key, and the mutation field it was sent to
+    key = Column(String(255), primary_key=True)
+    operation = Column(String, primary_key=True)
+    # JSON object of the mutation's payload
+    result = Column(String, nullable=False)
+    # Unix time the mutation committed
+    created_at = Column(Integer, nullable=False)
+
+    __table_args__ = (Index('ix_idempotency_key_created_at', 'created_at'), )
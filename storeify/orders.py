@@ -0,0 +1,72 @@
+from sqlalchemy import event
+from sqlalchemy.orm import selectinload
+
+from storeify.currency import currency_code
+from storeify.models import Order, OrderLine, unix_time
+from storeify.pricing import price_column
+from storeify.rollups import apply_order
+
+
+def order_lines(cart):
+    """
+    The currency and lines (dicts) of the order for a cart being purchased.
+    Lines capture each product's price and currency as sold, and their total
+    converted into the cart currency.
+    """
+    currency = currency_code(cart.currency)
+    lines = []
+    for cartItem in cart.cart_items:
+        product = cartItem.product
+        unit_price = getattr(product, price_column(currency).key)
+        if unit_price is None:
+            raise ValueError("Invalid currency pair.")
+        lines.append(dict(product_id=product.id,
+                          quantity=cartItem.quantity,
+                          unit_price=product.price,
+                          currency=currency_code(product.currency).name,
+                          total=unit_price * cartItem.quantity))
+    return currency, lines
+
+
+def record_order(db_session, cart, cart_key):
+    """
+    Appends the order for a cart being purchased, whose repository key is
+    cart_key, to the ledger, and adds it to the sales rollups, in the
+    caller's transaction.
+    """
+    currency, lines = order_lines(cart)
+    order = Order(userid=cart.userid,
+                  cart_id=cart_key,
+                  currency=currency.name,
+                  total=sum(line['total'] for line in lines),
+                  created_at=unix_time())
+    db_session.add(order)
+    db_session.flush()
+    for line in lines:
+        line['order_id'] = order.id
+    # A core executemany rather than bulk_insert_mappings, which a sharded
+    # session can't route
+    db_session.execute(OrderLine.__table__.insert(), lines)
+    apply_order(db_session, order, lines)
+    return order
+
+
+def orders_page(db_session, userid, first, after=None):
+    """
+    A user's orders, newest first. Pages are keyset paginated: `after` is the
+    id of the last order of the previous page.
+    """
+    query = db_session.query(Order) \
+        .options(selectinload(Order.lines)) \
+        .filter(Order.userid == userid)
+    if after is not None:
+        query = query.filter(Order.id < after)
+    return query.order_by(Order.id.desc()).limit(first).all()
+
+
+@event.listens_for(Order, 'before_update')
+@event.listens_for(Order, 'before_delete')
+@event.listens_for(OrderLine, 'before_update')
+@event.listens_for(OrderLine, 'before_delete')
+def _append_only(mapper, connection, target):
+    raise ValueError('The order ledger is append-only.')
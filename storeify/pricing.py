@@ -0,0 +1,156 @@
+from sqlalchemy import Integer, and_, case, cast, event, func, inspect, select
+
+from storeify.changelog import UPDATE, change_row, insert_changes
+from storeify.config import Config
+from storeify.currency import Currency, currency_code
+from storeify.models import Cart, CartItem, ExchangeRate, Product
+
+
+def price_column(currency):
+    """The Product column holding prices converted into currency."""
+    return getattr(Product, 'price_' + currency.name.lower())
+
+
+def currency_code_expr(column):
+    """SQL counterpart of currency_code(): maps "0"/"USD" alike to "USD"."""
+    return case([(column == str(currency.value), currency.name)
+                  for currency in Currency], else_=column)
+
+
+def round_half_even_expr(value):
+    """
+    SQL counterpart of int(round(value)) for non-negative values. Python rounds
+    halves to even while SQLite's ROUND() rounds them away from zero.
+    """
+    whole = cast(value, Integer)
+    fraction = value - whole
+    return case([(fraction > 0.5, whole + 1), (fraction < 0.5, whole)],
+                else_=whole + whole % 2)
+
+
+def cart_totals(session, cart_ids):
+    """
+    Returns {cart id: total in the cart currency} for the given carts in a
+    single statement, summing the precomputed product price in each cart's
+    currency times quantity. Carts without items total 0. Raises ValueError
+    if a product has no price in the cart currency.
+    """
+    cart_currency = currency_code_expr(Cart.currency)
+    unit_price = case([(cart_currency == currency.name, price_column(currency))
+                       for currency in Currency])
+    missing_price = case([(unit_price.is_(None), 1)], else_=0)
+
+    rows = session.query(Cart.id,
+                         func.sum(unit_price * CartItem.quantity),
+                         func.sum(missing_price)) \
+        .join(CartItem, CartItem.cart_id == Cart.id) \
+        .join(Product, Product.id == CartItem.product_id) \
+        .filter(Cart.id.in_(cart_ids)) \
+        .group_by(Cart.id)
+
+    totals = dict((id, 0) for id in cart_ids)
+    for id, total, missing in rows:
+        if missing:
+            raise ValueError("Invalid currency pair.")
+        totals[id] = int(total or 0)
+    return totals
+
+
+# Converted prices are written alongside the product whenever its price or
+# currency changes, using the rates currently in the exchangerate table.
+
+def _set_converted_prices(mapper, connection, target):
+    state = inspect(target)
+    if state.persistent and not (
+            state.attrs.price.history.has_changes() or
+            state.attrs.currency.history.has_changes()):
+        return
+
+    try:
+        quote = currency_code(target.currency).name
+    except ValueError:
+        quote = None
+    rates = dict(connection.execute(
+        select([ExchangeRate.base, ExchangeRate.rate])
+        .where(ExchangeRate.quote == quote)).fetchall())
+    for currency in Currency:
+        rate = rates.get(currency.name)
+        converted = None
+        if rate is not None and target.price is not None:
+            converted = int(round(int(target.price) * rate))
+        setattr(target, price_column(currency).key, converted)
+
+
+def register_price_hooks():
+    """
+    Keeps the converted prices of products written through the ORM up to
+    date. Called by storeify.db whenever it sets up a session; idempotent.
+    """
+    for name in ('before_insert', 'before_update'):
+        if not event.contains(Product, name, _set_converted_prices):
+            event.listen(Product, name, _set_converted_prices)
+
+
+def refresh_product_prices(session, currencies=None, chunk_size=None):
+    """
+    Recomputes the converted prices of every product priced in one of
+    currencies (all of them by default) from the exchangerate table. Rows are
+    rewritten by id range, chunk_size ids per UPDATE and transaction, so
+    writers are never blocked for long, and their new prices are logged to
+    the change log in the same transaction. Returns the number of rows
+    updated.
+    """
+    chunk_size = chunk_size or Config.PRICE_REFRESH_CHUNK_SIZE
+    product_currency = currency_code_expr(Product.currency)
+
+    values = {}
+    for currency in Currency:
+        rate = select([ExchangeRate.rate]).where(and_(
+            ExchangeRate.base == currency.name,
+            ExchangeRate.quote == product_currency)).as_scalar()
+        values[price_column(currency)] = round_half_even_expr(
+            Product.price * rate)
+    # So that a concurrent update that read the old prices conflicts
+    values[Product.version] = Product.version + 1
+
+    updated = 0
+    last_id = session.query(func.max(Product.id)).scalar() or 0
+    for start in range(0, last_id, chunk_size):
+        query = session.query(Product).filter(
+            Product.id > start, Product.id <= start + chunk_size)
+        if currencies is not None:
+            query = query.filter(product_currency.in_(
+                [currency_code(c).name for c in currencies]))
+        updated += query.update(values, synchronize_session=False)
+        columns = [price_column(currency) for currency in Currency]
+        insert_changes(session, [
+            change_row(Product.__tablename__, row[0], UPDATE, dict(
+                (column.key, price) for column, price in zip(columns,
+                                                             row[1:])))
+            for row in query.with_entities(Product.id, *columns)])
+        session.commit()
+    return updated
+
+
+def update_exchange_rates(session, rates, chunk_size=None):
+    """
+    Stores new rates ({(base, quote): rate}) and rewrites the converted prices
+    of the products priced in any quote currency whose rates changed.
+    Returns the number of products updated.
+    """
+    changed = set()
+    for (base, quote), rate in rates.items():
+        row = session.query(ExchangeRate).get((base, quote))
+        if row is None:
+            session.add(ExchangeRate(base=base, quote=quote, rate=rate))
+        elif row.rate != rate:
+            row.rate = rate
+        else:
+            continue
+        changed.add(quote)
+    session.commit()
+
+    if not changed:
+        return 0
+    return refresh_product_prices(session, currencies=changed,
+                                  chunk_size=chunk_size)
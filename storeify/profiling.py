@@ -0,0 +1,188 @@
+"""
+On-demand profiling of /graphql requests.
+
+A request is profiled when it carries an X-Profile header equal to
+Config.PROFILING_TOKEN, or when it is picked at random with probability
+Config.PROFILING_SAMPLE_RATE. Its execution is recorded with cProfile and,
+with Config.PROFILING_ALLOCATIONS or an X-Profile-Allocations header on a
+request sent with the token, a tracemalloc snapshot of what it left
+allocated. Profiles are saved to Config.PROFILING_DIR, which keeps the latest
+Config.PROFILING_MAX_PROFILES of them:
+
+    <unix ms>-<pid>-<n>-<operation>.prof          pstats.Stats(path)
+    <unix ms>-<pid>-<n>-<operation>.tracemalloc   tracemalloc.Snapshot.load(path)
+
+The X-Profile-Id header of a profiled response names its files. GET /profiles
+lists them, newest first (?operation= picks one operation's), and
+/profiles/<file> downloads one; both need the X-Profile header too.
+
+A process profiles one request at a time: a request picked while another is
+being profiled is served without. For incremental (@defer/@stream) responses
+only the initial part is profiled.
+"""
+import cProfile
+import hmac
+import itertools
+import logging
+import os
+import random
+import re
+import threading
+import time
+import tracemalloc
+
+from storeify.config import Config
+
+HEADER = 'X-Profile'
+ALLOCATIONS_HEADER = 'X-Profile-Allocations'
+ID_HEADER = 'X-Profile-Id'
+EXTENSIONS = ('.prof', '.tracemalloc')
+# Stack frames kept per allocation by tracemalloc
+TRACEMALLOC_FRAMES = 10
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_sequence = itertools.count()
+
+
+def authorized(request):
+    """Whether the request carries the profiling token."""
+    token = Config.PROFILING_TOKEN
+    supplied = request.headers.get(HEADER)
+    return bool(token) and supplied is not None and \
+        hmac.compare_digest(supplied.encode(), token.encode())
+
+
+class Profile(object):
+    def __init__(self, allocations):
+        self.profiler = cProfile.Profile()
+        self.allocations = allocations
+        # Whether tracemalloc was started for this profile, and so is
+        # stopped after it
+        self.tracing = False
+
+    def start(self):
+        if self.allocations and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.tracing = True
+        self.profiler.enable()
+
+    def _stop(self):
+        self.profiler.disable()
+        snapshot = None
+        if self.allocations:
+            snapshot = tracemalloc.take_snapshot()
+        if self.tracing:
+            tracemalloc.stop()
+        return snapshot
+
+    def cancel(self):
+        try:
+            self._stop()
+        finally:
+            _lock.release()
+
+    def finish(self, operation):
+        """Saves the profile; returns its id, or None if it was not saved."""
+        try:
+            snapshot = self._stop()
+            return save(self.profiler, snapshot, operation)
+        except Exception:
+            log.exception('Saving a profile of %s failed', operation)
+            return None
+        finally:
+            _lock.release()
+
+
+def start_profile(request):
+    """A started Profile if the request is to be profiled, else None."""
+    requested = authorized(request)
+    if not requested and not (Config.PROFILING_SAMPLE_RATE and
+                              random.random() < Config.PROFILING_SAMPLE_RATE):
+        return None
+    if not _lock.acquire(False):
+        return None
+    profile = Profile(Config.PROFILING_ALLOCATIONS or (
+        requested and request.headers.get(ALLOCATIONS_HEADER) is not None))
+    try:
+        profile.start()
+    except ValueError:
+        # Another profiler is active in this process
+        _lock.release()
+        return None
+    return profile
+
+
+def _directory():
+    return os.path.abspath(Config.PROFILING_DIR)
+
+
+def _write(path, dump):
+    dump(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def _file_name(operation):
+    return re.sub(r'[^A-Za-z0-9_]', '_', operation)[:64]
+
+
+def save(profiler, snapshot, operation):
+    directory = _directory()
+    os.makedirs(directory, exist_ok=True)
+    profile_id = '%013d-%d-%d-%s' % (
+        time.time() * 1000, os.getpid(), next(_sequence),
+        _file_name(operation))
+    path = os.path.join(directory, profile_id)
+    _write(path + '.prof', profiler.dump_stats)
+    if snapshot is not None:
+        _write(path + '.tracemalloc', snapshot.dump)
+    prune()
+    return profile_id
+
+
+def _profile_ids():
+    try:
+        names = os.listdir(_directory())
+    except FileNotFoundError:
+        return []
+    return sorted(name[:-len('.prof')] for name in names
+                  if name.endswith('.prof'))
+
+
+def prune():
+    """Deletes all but the latest Config.PROFILING_MAX_PROFILES profiles."""
+    ids = _profile_ids()
+    for profile_id in ids[:max(len(ids) - Config.PROFILING_MAX_PROFILES, 0)]:
+        for extension in EXTENSIONS:
+            try:
+                os.remove(os.path.join(_directory(), profile_id + extension))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles(operation=None):
+    """The saved profiles, newest first, optionally of one operation."""
+    directory = _directory()
+    profiles = []
+    for profile_id in reversed(_profile_ids()):
+        milliseconds, _, _, name = profile_id.split('-', 3)
+        if operation is not None and name != _file_name(operation):
+            continue
+        profiles.append({
+            'id': profile_id,
+            'operation': name,
+            'createdAt': int(milliseconds) / 1000.0,
+            'files': [profile_id + extension for extension in EXTENSIONS
+                      if os.path.exists(os.path.join(
+                          directory, profile_id + extension))],
+        })
+    return profiles
+
+
+def profile_path(name):
+    """The path of a profile file, or None if there is no such file."""
+    if os.path.basename(name) != name or not name.endswith(EXTENSIONS):
+        return None
+    path = os.path.join(_directory(), name)
+    return path if os.path.isfile(path) else None
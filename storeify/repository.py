@@ -0,0 +1,473 @@
+"""
+Data access for the resolvers and mutations in storeify.schema.
+
+Everything the API reads or writes goes through a Repository, chosen by
+Config.STORAGE_BACKEND: 'sqlalchemy' (the database at Config.DATABASE_URI)
+or 'memory' (storeify.memory, dicts in the process). Both hand out instances
+of the storeify.models classes, so the GraphQL types are the same for
+either.
+
+Writes happen inside `with repository.transaction():`, which commits when
+the block exits and rolls back if it raises. Methods take and return model
+instances, and keys: the string form of a row's identity that global IDs
+are made of (see key()).
+"""
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import and_
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.orm.exc import StaleDataError
+
+from storeify import changelog, rollups
+from storeify.catalog import ProductSort, catalog_index_enabled, \
+    get_catalog_index, hydrate_products
+from storeify.config import Config
+from storeify.currency import Currency
+from storeify.db import get_db_session
+from storeify.metrics import metrics
+from storeify.models import Cart, CartItem, IdempotencyKey, Order, Product, \
+    unix_time
+from storeify.orders import orders_page, record_order
+from storeify.pricing import cart_totals
+
+
+class Repository(object):
+    """The operations storeify.schema needs from a storage backend."""
+
+    @contextmanager
+    def transaction(self):
+        raise NotImplementedError
+
+    def close(self):
+        """Releases per-request resources at the end of a request."""
+
+    def ping(self):
+        """Opens (and releases) whatever connection the backend needs."""
+
+    def key(self, instance):
+        """The key of a model instance, as accepted by the get_ methods."""
+        return str(instance.id)
+
+    def shard_of(self, instance):
+        """The shard a cart or cart item lives on, or None if unsharded."""
+        return None
+
+    # Products
+
+    def get_product(self, id):
+        raise NotImplementedError
+
+    def find_products(self, id=None, title=None, inventory_minimum=None,
+                      can_purchase=None, price_minimum=None,
+                      price_maximum=None, currency=None, sort=None,
+                      first=None, offset=None):
+        raise NotImplementedError
+
+    def get_products(self, ids):
+        """{id: Product} of those of the given products that exist."""
+        raise NotImplementedError
+
+    def create_product(self, **fields):
+        raise NotImplementedError
+
+    def update_product(self, product, **fields):
+        raise NotImplementedError
+
+    def delete_product(self, product):
+        raise NotImplementedError
+
+    # Cart items
+
+    def get_cart_item(self, id):
+        raise NotImplementedError
+
+    def get_cart_items(self, keys):
+        """Those of the given cart items that exist, with their products."""
+        raise NotImplementedError
+
+    def cart_items_in(self, cart):
+        raise NotImplementedError
+
+    def create_cart_item(self, product, quantity, userid=None):
+        raise NotImplementedError
+
+    def update_cart_item(self, cart_item, **fields):
+        raise NotImplementedError
+
+    # Carts
+
+    def get_cart(self, id):
+        raise NotImplementedError
+
+    def carts_for_user(self, userid):
+        raise NotImplementedError
+
+    def create_cart(self, userid, currency):
+        raise NotImplementedError
+
+    def delete_cart(self, cart):
+        raise NotImplementedError
+
+    def add_cart_items(self, cart, cart_items):
+        raise NotImplementedError
+
+    def remove_cart_items(self, cart, cart_items):
+        raise NotImplementedError
+
+    def cart_totals(self, cart_keys):
+        """{cart key: total in the cart currency}, as pricing.cart_totals."""
+        raise NotImplementedError
+
+    def purchase_cart(self, cart):
+        """
+        Takes the cart's items out of inventory, records the order and marks
+        the cart purchased. Returns the Order.
+        """
+        raise NotImplementedError
+
+    # Orders and sales
+
+    def get_order(self, id):
+        raise NotImplementedError
+
+    def orders_page(self, userid, first, after=None):
+        raise NotImplementedError
+
+    def top_products(self, since=None, limit=10):
+        raise NotImplementedError
+
+    def revenue(self, currency, since=None):
+        raise NotImplementedError
+
+    def rebuild_rollups(self):
+        raise NotImplementedError
+
+    # Change log
+
+    def record_change(self, instance, operation, fields=None):
+        """
+        Logs a change to a model instance (see storeify.changelog), in the
+        current transaction.
+        """
+        raise NotImplementedError
+
+    def changes(self, after, limit):
+        """Up to limit changes with a seq above after, oldest first."""
+        raise NotImplementedError
+
+    def compact_changes(self, before):
+        """
+        Folds the changes made before the unix time `before`; returns the
+        number of changes deleted.
+        """
+        raise NotImplementedError
+
+    # Idempotency keys
+
+    def stored_result(self, key, operation):
+        """
+        The result stored under an unexpired idempotency key (see
+        storeify.idempotency), or None.
+        """
+        raise NotImplementedError
+
+    def store_result(self, key, operation, result):
+        """Stores a mutation's result in the current transaction."""
+        raise NotImplementedError
+
+
+PRODUCT_SORT_ORDER = {
+    ProductSort.ID: (Product.id, ),
+    ProductSort.PRICE: (Product.price, Product.id),
+    ProductSort.PRICE_DESC: (Product.price.desc(), Product.id),
+    ProductSort.INVENTORY_COUNT: (Product.inventory_count, Product.id),
+    ProductSort.INVENTORY_COUNT_DESC: (Product.inventory_count.desc(),
+                                       Product.id),
+}
+
+
+# Most ids bound in one IN list, well under SQLite's default limit of 999
+# parameters per statement
+IN_CHUNK_SIZE = 500
+
+
+def set_cart_items_cart(executor, cartItems, cart_id, **values):
+    """
+    Moves the given cart items into cart_id (or out, if None), setting any
+    other column values given, through executor (a session or connection).
+    Items loaded at the same version are updated together, with one
+    `id IN (...) AND version = v` UPDATE per IN_CHUNK_SIZE of them, which for
+    items that were never changed is a single statement. Each row is only
+    updated if still at the version it was loaded with; raises
+    StaleDataError otherwise.
+    """
+    by_version = {}
+    for cartItem in cartItems:
+        by_version.setdefault(cartItem.version, set()).add(cartItem.id)
+    if not by_version:
+        return
+    table = CartItem.__table__
+    values.update(cart_id=cart_id, version=table.c.version + 1)
+    expected = updated = 0
+    for version, ids in sorted(by_version.items()):
+        ids = sorted(ids)
+        for start in range(0, len(ids), IN_CHUNK_SIZE):
+            chunk = ids[start:start + IN_CHUNK_SIZE]
+            expected += len(chunk)
+            updated += executor.execute(
+                table.update()
+                .where(and_(table.c.id.in_(chunk),
+                            table.c.version == version))
+                .values(**values)).rowcount
+    if updated != expected:
+        raise StaleDataError(
+            'Cart items were modified concurrently; expected %d rows to be '
+            'updated, got %d.' % (expected, updated))
+
+
+# Session.info key of the changes logged in the current transaction
+PENDING_CHANGES = 'storeify.pending_changes'
+
+# Compiled primary key lookups, one per model. Query.get builds and compiles
+# its SELECT again on every call; a baked query does it once.
+bakery = baked.bakery()
+
+
+def get_by_key(session, model, ident):
+    """session.query(model).get(ident), from a baked query."""
+    return bakery(lambda session: session.query(model), model)(session) \
+        .get(ident)
+
+
+class SQLAlchemyRepository(Repository):
+    """Reads and writes through the scoped session of storeify.db."""
+
+    @property
+    def session(self):
+        return get_db_session()
+
+    @contextmanager
+    def transaction(self):
+        session = self.session
+        try:
+            yield
+            changelog.insert_changes(session,
+                                     session.info.pop(PENDING_CHANGES, None))
+            started = time.perf_counter()
+            session.commit()
+            metrics.observe_commit(time.perf_counter() - started)
+        except BaseException:
+            session.info.pop(PENDING_CHANGES, None)
+            session.rollback()
+            raise
+
+    def close(self):
+        session = self.session
+        if session.registry.has():
+            metrics.observe_identity_map(len(session().identity_map))
+        session.remove()
+
+    def ping(self):
+        session = self.session
+        session.execute('SELECT 1')
+        session.remove()
+
+    def get_product(self, id):
+        return get_by_key(self.session(), Product, id)
+
+    def find_products(self, **filters):
+        query = self.session.query(Product)
+        if catalog_index_enabled():
+            index = get_catalog_index(self.session)
+            return hydrate_products(query, index.query(**filters))
+
+        if filters.get('id') is not None:
+            query = query.filter_by(id=filters['id'])
+        if filters.get('title') is not None:
+            query = query.filter_by(title=filters['title'])
+        if filters.get('inventory_minimum') is not None:
+            query = query.filter(
+                Product.inventory_count >= filters['inventory_minimum'])
+        if filters.get('can_purchase') is not None:
+            query = query.filter_by(can_purchase=filters['can_purchase'])
+        if filters.get('price_minimum') is not None:
+            query = query.filter(Product.price >= filters['price_minimum'])
+        if filters.get('price_maximum') is not None:
+            query = query.filter(Product.price <= filters['price_maximum'])
+        if filters.get('currency') is not None:
+            currency = Currency(filters['currency'])
+            query = query.filter(Product.currency.in_(
+                [currency.name, str(currency.value)]))
+        if filters.get('sort') is not None:
+            query = query.order_by(
+                *PRODUCT_SORT_ORDER[ProductSort(filters['sort'])])
+        if filters.get('offset') is not None:
+            query = query.offset(filters['offset'])
+        if filters.get('first') is not None:
+            query = query.limit(filters['first'])
+        return query.all()
+
+    def get_products(self, ids):
+        return dict((product.id, product) for product in
+                    self.session.query(Product).filter(Product.id.in_(ids)))
+
+    def create_product(self, **fields):
+        product = Product(**fields)
+        self.session.add(product)
+        return product
+
+    def update_product(self, product, **fields):
+        for name, value in fields.items():
+            setattr(product, name, value)
+        return product
+
+    def delete_product(self, product):
+        self.session.delete(product)
+
+    def get_cart_item(self, id):
+        return get_by_key(self.session(), CartItem, id)
+
+    def get_cart_items(self, keys):
+        if not keys:
+            return []
+        return self.session.query(CartItem) \
+            .options(joinedload(CartItem.product)) \
+            .filter(CartItem.id.in_(keys)).all()
+
+    def cart_items_in(self, cart):
+        return self.session.query(CartItem).filter_by(cart_id=cart.id).all()
+
+    def create_cart_item(self, product, quantity, userid=None):
+        cart_item = CartItem(product=product, quantity=quantity,
+                             userid=userid)
+        self.session.add(cart_item)
+        return cart_item
+
+    def update_cart_item(self, cart_item, **fields):
+        for name, value in fields.items():
+            setattr(cart_item, name, value)
+        return cart_item
+
+    def get_cart(self, id):
+        return get_by_key(self.session(), Cart, id)
+
+    def carts_for_user(self, userid):
+        return self.session.query(Cart).filter_by(userid=userid).all()
+
+    def create_cart(self, userid, currency):
+        cart = Cart(userid=userid, currency=currency)
+        self.session.add(cart)
+        self.session.flush()
+        return cart
+
+    def delete_cart(self, cart):
+        self.session.delete(cart)
+
+    def _touch(self, cart):
+        # Always written, even within the same second, so that the cart's
+        # version moves whenever its items change
+        cart.updated_at = unix_time()
+        flag_modified(cart, 'updated_at')
+
+    def add_cart_items(self, cart, cart_items):
+        set_cart_items_cart(self.session, cart_items, cart.id,
+                            userid=cart.userid)
+        self._touch(cart)
+
+    def remove_cart_items(self, cart, cart_items):
+        set_cart_items_cart(self.session, cart_items, None)
+        self._touch(cart)
+
+    def cart_totals(self, cart_keys):
+        totals = cart_totals(self.session, [int(key) for key in cart_keys])
+        return dict((key, totals[int(key)]) for key in cart_keys)
+
+    def purchase_cart(self, cart):
+        for cartItem in cart.cart_items:
+            cartItem.product.inventory_count -= cartItem.quantity
+        # Recorded in the same transaction as the inventory change
+        order = record_order(self.session, cart, self.key(cart))
+        cart.purchased_at = order.created_at
+        return order
+
+    def get_order(self, id):
+        return get_by_key(self.session(), Order, id)
+
+    def orders_page(self, userid, first, after=None):
+        return orders_page(self.session, userid, first, after)
+
+    def top_products(self, since=None, limit=10):
+        return rollups.top_products(self.session, since, limit)
+
+    def revenue(self, currency, since=None):
+        return rollups.revenue(self.session, currency, since)
+
+    def rebuild_rollups(self):
+        rollups.rebuild_rollups(self.session)
+
+    def record_change(self, instance, operation, fields=None):
+        if instance in self.session.new:
+            # Keys are only known once the row is inserted
+            self.session.flush()
+        # Inserted all at once when the transaction commits
+        self.session.info.setdefault(PENDING_CHANGES, []).append(
+            changelog.change_row(instance.__tablename__, self.key(instance),
+                                 operation, fields))
+
+    def changes(self, after, limit):
+        return changelog.changes_after(self.session, after, limit)
+
+    def compact_changes(self, before):
+        return changelog.compact(self.session, before)
+
+    def stored_result(self, key, operation):
+        record = get_by_key(self.session(), IdempotencyKey,
+                            (key, operation))
+        if record is None or \
+                record.created_at < unix_time() - Config.IDEMPOTENCY_KEY_TTL:
+            return None
+        return record.result
+
+    def store_result(self, key, operation, result):
+        # An expired record is replaced; a concurrent one fails the commit
+        record = get_by_key(self.session(), IdempotencyKey,
+                            (key, operation))
+        if record is None:
+            self.session.add(IdempotencyKey(
+                key=key, operation=operation, result=result,
+                created_at=unix_time()))
+        else:
+            record.result = result
+            record.created_at = unix_time()
+
+
+repository = None
+
+
+def init_repository(instance=None):
+    """
+    Replaces the repository returned by get_repository(). With no argument,
+    the next call builds one for Config.STORAGE_BACKEND again.
+    """
+    global repository
+    repository = instance
+
+
+def get_repository():
+    global repository
+    if repository is None:
+        if Config.STORAGE_BACKEND == 'memory':
+            from storeify.memory import MemoryRepository
+            repository = MemoryRepository.from_config()
+        elif Config.STORAGE_BACKEND == 'sqlalchemy' and Config.SHARD_URIS:
+            from storeify.sharding import ShardedRepository
+            repository = ShardedRepository()
+        elif Config.STORAGE_BACKEND == 'sqlalchemy':
+            repository = SQLAlchemyRepository()
+        else:
+            raise ValueError('Unknown storage backend "%s".' %
+                             Config.STORAGE_BACKEND)
+    return repository
@@ -0,0 +1,89 @@
+from datetime import datetime
+
+from sqlalchemy import and_, func, select
+
+from storeify.models import (CurrencyRevenueDaily, Order, OrderLine,
+                             ProductSalesDaily)
+
+
+def order_day(order):
+    return datetime.utcfromtimestamp(order.created_at).date()
+
+
+def _increment(db_session, table, key, values):
+    """
+    Adds values to the rollup row identified by key, creating it if needed.
+    Both statements run in the caller's transaction.
+    """
+    condition = and_(*[table.c[column] == value
+                       for column, value in key.items()])
+    updated = db_session.execute(
+        table.update().where(condition).values(dict(
+            (column, table.c[column] + amount)
+            for column, amount in values.items())))
+    if updated.rowcount == 0:
+        row = dict(key)
+        row.update(values)
+        db_session.execute(table.insert().values(row))
+
+
+def apply_order(db_session, order, lines):
+    """Adds a newly recorded order and its lines (dicts) to the rollups."""
+    day = order_day(order)
+    products = {}
+    for line in lines:
+        units, revenue = products.get(line['product_id'], (0, 0))
+        products[line['product_id']] = (units + line['quantity'],
+                                        revenue + line['total'])
+    for product_id, (units, revenue) in sorted(products.items()):
+        _increment(db_session, ProductSalesDaily.__table__,
+                   dict(product_id=product_id, day=day,
+                        currency=order.currency),
+                   dict(units=units, revenue=revenue))
+    _increment(db_session, CurrencyRevenueDaily.__table__,
+               dict(currency=order.currency, day=day),
+               dict(orders=1, revenue=order.total))
+
+
+def rebuild_rollups(db_session):
+    """
+    Recomputes every rollup from the order ledger, e.g. to backfill orders
+    recorded before the rollups existed. Runs in one transaction.
+    """
+    day = func.date(Order.created_at, 'unixepoch')
+    db_session.execute(ProductSalesDaily.__table__.delete())
+    db_session.execute(CurrencyRevenueDaily.__table__.delete())
+    db_session.execute(ProductSalesDaily.__table__.insert().from_select(
+        ['product_id', 'day', 'currency', 'units', 'revenue'],
+        select([OrderLine.product_id, day, Order.currency,
+                func.sum(OrderLine.quantity), func.sum(OrderLine.total)])
+        .select_from(OrderLine.__table__.join(
+            Order.__table__, OrderLine.order_id == Order.id))
+        .group_by(OrderLine.product_id, day, Order.currency)))
+    db_session.execute(CurrencyRevenueDaily.__table__.insert().from_select(
+        ['currency', 'day', 'orders', 'revenue'],
+        select([Order.currency, day, func.count(Order.id),
+                func.sum(Order.total)])
+        .group_by(Order.currency, day)))
+    db_session.commit()
+
+
+def top_products(db_session, since=None, limit=10):
+    """[(product id, units sold)] of the best sellers since a date."""
+    query = db_session.query(ProductSalesDaily.product_id,
+                             func.sum(ProductSalesDaily.units))
+    if since is not None:
+        query = query.filter(ProductSalesDaily.day >= since)
+    units = func.sum(ProductSalesDaily.units)
+    return query.group_by(ProductSalesDaily.product_id) \
+        .order_by(units.desc(), ProductSalesDaily.product_id) \
+        .limit(limit).all()
+
+
+def revenue(db_session, currency, since=None):
+    """Revenue of orders placed in currency since a date."""
+    query = db_session.query(func.sum(CurrencyRevenueDaily.revenue)) \
+        .filter(CurrencyRevenueDaily.currency == currency)
+    if since is not None:
+        query = query.filter(CurrencyRevenueDaily.day >= since)
+    return query.scalar() or 0
@@ -5,17 +5,27 @@ from graphene import relay
 from graphene_sqlalchemy import SQLAlchemyObjectType, SQLAlchemyConnectionField
 
 from graphql import GraphQLError
-
-from sqlalchemy.orm import scoped_session
+from graphql.type.directives import GraphQLIncludeDirective, \
+    GraphQLSkipDirective
 
 from storeify.models import Product as ProductModel, Cart as CartModel, CartItem as CartItemModel
-from storeify.db import get_db_session
+from storeify.models import Order as OrderModel, OrderLine as OrderLineModel
+from storeify.models import Change as ChangeModel
+from storeify.catalog import ProductSort as ProductSortClass
+from storeify.concurrency import check_version, retry_on_conflict
+from storeify import events
+from storeify.changelog import CREATE, DELETE, UPDATE
+from storeify.config import Config
 from storeify.currency import Currency as CurrencyClass
-from storeify.currency import convert as convert_currency
+from storeify.idempotency import idempotent, remember
+from storeify.incremental import DeferDirective, StreamDirective
+from storeify.loaders import get_loaders
+from storeify.pricing import price_column
+from storeify.repository import get_repository
 
 
-db_session = get_db_session()
 Currency = graphene.Enum.from_enum(CurrencyClass)
+ProductSort = graphene.Enum.from_enum(ProductSortClass)
 
 
 def decode_id(id):
@@ -52,6 +62,19 @@ def validate_cart_item(cartItem, cartItemID):
                            ' units left.')
 
 
+def load_cart_items(repository, cartItemIDs):
+    """
+    Fetches the cart items with the given global IDs, along with their
+    products, at once. Returns {global ID: CartItem or None}.
+    """
+    keys = dict((cartItemID, decode_id(cartItemID))
+                for cartItemID in cartItemIDs)
+    found = dict((repository.key(cartItem), cartItem) for cartItem in
+                 repository.get_cart_items(set(keys.values())))
+    return dict((cartItemID, found.get(key))
+                for cartItemID, key in keys.items())
+
+
 class Cart(SQLAlchemyObjectType):
     class Meta:
         model = CartModel
@@ -61,19 +84,20 @@ class Cart(SQLAlchemyObjectType):
     total = graphene.Int()
     currency = graphene.String()
 
+    @classmethod
+    def get_node(cls, info, id):
+        return get_repository().get_cart(id)
+
+    def resolve_id(self, info):
+        return get_repository().key(self)
+
     def resolve_cartItems(self, info):
-        query = CartItem.get_query(info)
-        return query.filter_by(cart_id=self.id)
+        return get_repository().cart_items_in(self)
 
     def resolve_total(self, info):
-        # Convert the price of each cart item into the cart currency
-        total = 0
-        for cartItem in self.cart_items:
-            curpair = str(CurrencyClass(int(self.currency))
-                          )[-3:] + '/' + cartItem.product.currency
-            total += (convert_currency(curpair,
-                                       cartItem.product.price) * cartItem.quantity)
-        return total
+        # Batched with the totals of the other carts resolved in the same
+        # request
+        return get_loaders(info).cart_total.load(get_repository().key(self))
 
     def resolve_currency(self, info):
         return str(CurrencyClass(int(self.currency)))[-3:]
@@ -84,11 +108,63 @@ class CartItem(SQLAlchemyObjectType):
         model = CartItemModel
         interfaces = (relay.Node, )
 
+    @classmethod
+    def get_node(cls, info, id):
+        return get_repository().get_cart_item(id)
+
+    def resolve_id(self, info):
+        return get_repository().key(self)
+
 
 class Product(SQLAlchemyObjectType):
     class Meta:
         model = ProductModel
         interfaces = (relay.Node, )
+        exclude_fields = ('price_usd', 'price_cad', 'price_eur')
+
+    price = graphene.Int(currency=graphene.Argument(Currency))
+
+    @classmethod
+    def get_node(cls, info, id):
+        return get_repository().get_product(id)
+
+    def resolve_price(self, info, currency=None):
+        # Converted prices are precomputed; see storeify.pricing
+        if currency is None:
+            return self.price
+        return getattr(self, price_column(CurrencyClass(currency)).key)
+
+
+class OrderLine(SQLAlchemyObjectType):
+    class Meta:
+        model = OrderLineModel
+        interfaces = (relay.Node, )
+        exclude_fields = ('order_id', )
+
+
+class Order(SQLAlchemyObjectType):
+    class Meta:
+        model = OrderModel
+        interfaces = (relay.Node, )
+
+    lines = graphene.List(lambda: OrderLine)
+
+    def resolve_lines(self, info):
+        return self.lines
+
+
+class Change(SQLAlchemyObjectType):
+    class Meta:
+        model = ChangeModel
+
+    # An Int rather than an ID, as it is the cursor passed back as after
+    seq = graphene.Int()
+
+
+class TopProduct(graphene.ObjectType):
+    product_id = graphene.Int()
+    units = graphene.Int()
+    product = graphene.Field(Product)
 
 
 class Query(graphene.ObjectType):
@@ -98,41 +174,84 @@ class Query(graphene.ObjectType):
         id=graphene.ID(),
         title=graphene.String(),
         inventory_minimum=graphene.Int(),
-        can_purchase=graphene.Boolean())
+        can_purchase=graphene.Boolean(),
+        price_minimum=graphene.Int(),
+        price_maximum=graphene.Int(),
+        currency=graphene.Argument(Currency),
+        sort=graphene.Argument(ProductSort),
+        first=graphene.Int(),
+        offset=graphene.Int())
 
     product = graphene.Field(Product, id=graphene.ID(required=True))
     carts = graphene.Field(lambda: graphene.List(Cart), userid=graphene.Int())
     cart = graphene.Field(Cart, id=graphene.ID(required=True))
     cartItem = graphene.Field(CartItem, id=graphene.ID(required=True))
+    orders = graphene.List(
+        Order,
+        userid=graphene.Int(required=True),
+        first=graphene.Int(),
+        after=graphene.ID())
+    top_products = graphene.List(
+        TopProduct,
+        since=graphene.Date(),
+        limit=graphene.Int())
+    revenue = graphene.Int(
+        currency=graphene.Argument(Currency, required=True),
+        since=graphene.Date())
+    changes = graphene.List(
+        Change,
+        after=graphene.Int(),
+        first=graphene.Int())
 
     def resolve_products(self, info, **kwargs):
-        query = Product.get_query(info)
         if 'id' in kwargs:
-            query = query.filter_by(id=decode_id(kwargs.get('id')))
-        if 'title' in kwargs:
-            query = query.filter_by(title=kwargs.get('title'))
-        if 'inventory_minimum' in kwargs:
-            query = query.filter(
-                ProductModel.inventory_count >= kwargs.get('inventory_minimum'))
-        if 'can_purchase' in kwargs:
-            query = query.filter_by(can_purchase=kwargs.get('can_purchase'))
-        return query.all()
+            kwargs['id'] = decode_id(kwargs['id'])
+        return get_repository().find_products(**kwargs)
 
     def resolve_product(self, info, id):
-        query = Product.get_query(info)
-        return query.get(decode_id(id))
+        return get_repository().get_product(decode_id(id))
 
     def resolve_carts(self, info, userid):
-        query = Cart.get_query(info)
-        return query.filter_by(userid=userid).all()
+        return get_repository().carts_for_user(userid)
 
     def resolve_cart(self, info, id):
-        query = Cart.get_query(info)
-        return query.get(decode_id(id))
+        return get_repository().get_cart(decode_id(id))
 
     def resolve_cartItem(self, info, id):
-        query = CartItem.get_query(info)
-        return query.get(decode_id(id))
+        return get_repository().get_cart_item(decode_id(id))
+
+    def resolve_orders(self, info, userid, first=None, after=None):
+        # Newest first; pass the id of the last order seen as `after` to
+        # fetch the next page
+        first = min(first or Config.ORDERS_PAGE_SIZE, Config.ORDERS_MAX_PAGE_SIZE)
+        if after is not None:
+            after = int(decode_id(after))
+        return get_repository().orders_page(userid, first, after)
+
+    def resolve_top_products(self, info, since=None, limit=10):
+        # Read from the sales rollups only; see storeify.rollups
+        repository = get_repository()
+        ranked = repository.top_products(since, limit)
+        products = repository.get_products([id for id, _ in ranked])
+        return [TopProduct(product_id=id, units=units, product=products.get(id))
+                for id, units in ranked]
+
+    def resolve_revenue(self, info, currency, since=None):
+        return get_repository().revenue(CurrencyClass(currency).name, since)
+
+    def resolve_changes(self, info, after=None, first=None):
+        # Oldest first; pass the seq of the last change seen as `after` to
+        # fetch the next batch
+        first = min(first or Config.CHANGE_LOG_PAGE_SIZE,
+                    Config.CHANGE_LOG_MAX_PAGE_SIZE)
+        return get_repository().changes(after or 0, first)
+
+
+def record_cart_item_moves(repository, cartItems, cart):
+    """Logs the cart items' move into cart (or out of theirs, if None)."""
+    cart_id = repository.key(cart) if cart is not None else None
+    for cartItem in cartItems:
+        repository.record_change(cartItem, UPDATE, dict(cart_id=cart_id))
 
 
 class ProductCreate(graphene.Mutation):
@@ -142,19 +261,28 @@ class ProductCreate(graphene.Mutation):
         currency = graphene.NonNull(Currency)
         inventory_count = graphene.NonNull(graphene.Int)
         can_purchase = graphene.NonNull(graphene.Boolean)
+        # Retries with the same key get the first result back (see
+        # storeify.idempotency); the Idempotency-Key header works too
+        idempotency_key = graphene.String()
 
     ok = graphene.Boolean()
     product = graphene.Field(lambda: Product)
 
+    @idempotent
     def mutate(self, info, title, price,
                currency, inventory_count, can_purchase):
-        new_product = ProductModel(title=title,
-                                   price=price,
-                                   currency=currency,
-                                   inventory_count=inventory_count,
-                                   can_purchase=can_purchase)
-        db_session.add(new_product)
-        db_session.commit()
+        repository = get_repository()
+        with repository.transaction():
+            new_product = repository.create_product(
+                title=title,
+                price=price,
+                currency=currency,
+                inventory_count=inventory_count,
+                can_purchase=can_purchase)
+            repository.record_change(new_product, CREATE, dict(
+                title=title, price=price, currency=currency,
+                inventory_count=inventory_count, can_purchase=can_purchase))
+            remember(repository, ok=True, product=new_product)
 
         ok = True
         return ProductCreate(product=new_product, ok=ok)
@@ -168,10 +296,15 @@ class ProductDelete(graphene.Mutation):
     product = graphene.Field(lambda: Product)
 
     def mutate(self, info, id):
-        to_delete = db_session.query(ProductModel).get(decode_id(id))
-        db_session.delete(to_delete)
-        db_session.commit()
-
+        repository = get_repository()
+        with repository.transaction():
+            to_delete = repository.get_product(decode_id(id))
+            key = repository.key(to_delete)
+            repository.record_change(to_delete, DELETE)
+            repository.delete_product(to_delete)
+
+        events.publish(events.INVENTORY_CHANGED, product_id=key,
+                       inventory_count=0, deleted=True)
         ok = True
         return ProductDelete(ok=ok, product=to_delete)
 
@@ -184,24 +317,30 @@ class ProductUpdate(graphene.Mutation):
         currency = graphene.Argument(Currency)
         inventory_count = graphene.Int()
         can_purchase = graphene.Boolean()
+        expected_version = graphene.Int()
 
     ok = graphene.Boolean()
     product = graphene.Field(lambda: Product)
 
+    @retry_on_conflict
     def mutate(self, info, **kwargs):
-        to_edit = db_session.query(ProductModel).get(decode_id(kwargs['id']))
-        if 'title' in kwargs:
-            to_edit.title = kwargs['title']
-        if 'price' in kwargs:
-            to_edit.price = kwargs['price']
-        if 'currency' in kwargs:
-            to_edit.currency = kwargs['currency']
-        if 'inventory_count' in kwargs:
-            to_edit.inventory_count = kwargs['inventory_count']
-        if 'can_purchase' in kwargs:
-            to_edit.can_purchase = kwargs['can_purchase']
-        db_session.commit()
-
+        repository = get_repository()
+        with repository.transaction():
+            to_edit = repository.get_product(decode_id(kwargs['id']))
+            check_version(to_edit, kwargs.get('expected_version'),
+                          'Product', kwargs['id'])
+            fields = dict((name, kwargs[name]) for name in (
+                'title', 'price', 'currency', 'inventory_count',
+                'can_purchase') if name in kwargs)
+            repository.update_product(to_edit, **fields)
+            repository.record_change(to_edit, UPDATE, fields)
+
+        key = repository.key(to_edit)
+        if 'inventory_count' in fields:
+            events.publish(events.INVENTORY_CHANGED, product_id=key,
+                           inventory_count=to_edit.inventory_count,
+                           deleted=False)
+        events.publish(events.PRODUCT_UPDATED, product_id=key)
         ok = True
         return ProductUpdate(product=to_edit, ok=ok)
 
@@ -210,19 +349,28 @@ class CartItemCreate(graphene.Mutation):
     class Arguments:
         productID = graphene.NonNull(graphene.ID)
         quantity = graphene.NonNull(graphene.Int)
+        # Places the item with the user's carts when sharding
+        userid = graphene.Int()
+        idempotency_key = graphene.String()
 
     ok = graphene.Boolean()
     cartItem = graphene.Field(lambda: CartItem)
 
-    def mutate(self, info, productID, quantity):
+    @idempotent
+    def mutate(self, info, productID, quantity, userid=None):
+        repository = get_repository()
         if quantity <= 0:
             raise GraphQLError('Product quantity must be greater than zero.')
-        product = db_session.query(ProductModel).get(decode_id(productID))
-        if product is None:
-            raise GraphQLError('Product ID is invalid.')
-        new_cart_item = CartItemModel(product=product, quantity=quantity)
-        db_session.add(new_cart_item)
-        db_session.commit()
+        with repository.transaction():
+            product = repository.get_product(decode_id(productID))
+            if product is None:
+                raise GraphQLError('Product ID is invalid.')
+            new_cart_item = repository.create_cart_item(product, quantity,
+                                                        userid)
+            repository.record_change(new_cart_item, CREATE, dict(
+                product_id=repository.key(product), quantity=quantity,
+                userid=userid))
+            remember(repository, ok=True, cartItem=new_cart_item)
 
         ok = True
         return CartItemCreate(ok=ok, cartItem=new_cart_item)
@@ -233,19 +381,31 @@ class CartItemUpdate(graphene.Mutation):
         id = graphene.NonNull(graphene.ID)
         productID = graphene.ID()
         quantity = graphene.Int()
+        expected_version = graphene.Int()
 
     ok = graphene.Boolean()
     cartItem = graphene.Field(lambda: CartItem)
 
+    @retry_on_conflict
     def mutate(self, info, id, **kwargs):
-        to_edit = db_session.query(CartItemModel).get(decode_id(id))
-        if 'productID' in kwargs:
-            product = db_session.query(ProductModel).get(
-                decode_id(kwargs['productID']))
-            to_edit.product = product
-        if 'quantity' in kwargs:
-            to_edit.quantity = kwargs['quantity']
-        db_session.commit()
+        repository = get_repository()
+        with repository.transaction():
+            to_edit = repository.get_cart_item(decode_id(id))
+            check_version(to_edit, kwargs.get('expected_version'),
+                          'CartItem', id)
+            fields = {}
+            if 'productID' in kwargs:
+                fields['product'] = repository.get_product(
+                    decode_id(kwargs['productID']))
+            if 'quantity' in kwargs:
+                fields['quantity'] = kwargs['quantity']
+            repository.update_cart_item(to_edit, **fields)
+            changed = dict(fields)
+            if 'product' in changed:
+                product = changed.pop('product')
+                changed['product_id'] = repository.key(product) \
+                    if product is not None else None
+            repository.record_change(to_edit, UPDATE, changed)
 
         ok = True
         return CartItemUpdate(ok=ok, cartItem=to_edit)
@@ -263,22 +423,25 @@ class CartCreate(graphene.Mutation):
             graphene.List(
                 graphene.NonNull(
                     graphene.ID)))
+        idempotency_key = graphene.String()
 
     ok = graphene.Boolean()
     cart = graphene.Field(lambda: Cart)
 
+    @idempotent
     def mutate(self, info, userid, currency, **kwargs):
-        new_cart = CartModel(userid=userid, currency=currency)
-        new_cart.currency = currency
-        if 'cart_items' in kwargs:
-            for cartItemID in kwargs['cart_items']:
-                cartItem = db_session.query(
-                    CartItemModel).get(decode_id(cartItemID))
-                validate_cart_item(cartItem, cartItemID)
-                print(decode_id(cartItemID))
-                new_cart.cart_items.append(cartItem)
-        db_session.add(new_cart)
-        db_session.commit()
+        repository = get_repository()
+        cartItemIDs = kwargs.get('cart_items', [])
+        with repository.transaction():
+            cartItems = load_cart_items(repository, cartItemIDs)
+            for cartItemID in cartItemIDs:
+                validate_cart_item(cartItems[cartItemID], cartItemID)
+            new_cart = repository.create_cart(userid, currency)
+            repository.add_cart_items(new_cart, cartItems.values())
+            repository.record_change(new_cart, CREATE, dict(
+                userid=userid, currency=currency))
+            record_cart_item_moves(repository, cartItems.values(), new_cart)
+            remember(repository, ok=True, cart=new_cart)
 
         ok = True
         return CartCreate(ok=ok, cart=new_cart)
@@ -292,9 +455,13 @@ class CartDelete(graphene.Mutation):
     cart = graphene.Field(lambda: Cart)
 
     def mutate(self, info, id):
-        to_delete = db_session.query(CartModel).get(decode_id(id))
-        db_session.delete(to_delete)
-        db_session.commit()
+        repository = get_repository()
+        with repository.transaction():
+            to_delete = repository.get_cart(decode_id(id))
+            record_cart_item_moves(repository,
+                                   repository.cart_items_in(to_delete), None)
+            repository.record_change(to_delete, DELETE)
+            repository.delete_cart(to_delete)
 
         ok = True
         return CartDelete(ok=ok, cart=to_delete)
@@ -311,15 +478,16 @@ class CartAddItems(graphene.Mutation):
     ok = graphene.Boolean()
     cart = graphene.Field(lambda: Cart)
 
+    @retry_on_conflict
     def mutate(self, info, cartID, cartItems):
-        cart = db_session.query(CartModel).get(decode_id(cartID))
-        for cartItemID in cartItems:
-            cartItem = db_session.query(
-                CartItemModel).get(decode_id(cartItemID))
-            validate_cart_item(cartItem, cartItemID)
-
-            cart.cart_items.append(cartItem)
-        db_session.commit()
+        repository = get_repository()
+        with repository.transaction():
+            cart = repository.get_cart(decode_id(cartID))
+            found = load_cart_items(repository, cartItems)
+            for cartItemID in cartItems:
+                validate_cart_item(found[cartItemID], cartItemID)
+            repository.add_cart_items(cart, found.values())
+            record_cart_item_moves(repository, found.values(), cart)
 
         ok = True
         return CartAddItems(ok=ok, cart=cart)
@@ -336,13 +504,22 @@ class CartRemoveItems(graphene.Mutation):
     ok = graphene.Boolean()
     cart = graphene.Field(lambda: Cart)
 
+    @retry_on_conflict
     def mutate(self, info, cartID, cartItems):
-        cart = db_session.query(CartModel).get(decode_id(cartID))
-        for cartItemID in cartItems:
-            cartItem = db_session.query(
-                CartItemModel).get(decode_id(cartItemID))
-            cart.cart_items.remove(cartItem)
-        db_session.commit()
+        repository = get_repository()
+        with repository.transaction():
+            cart = repository.get_cart(decode_id(cartID))
+            found = load_cart_items(repository, cartItems)
+            for cartItemID in cartItems:
+                # Row ids repeat across shards, so the shard must match too
+                cartItem = found[cartItemID]
+                if cartItem is None or cartItem.cart_id != cart.id or \
+                        repository.shard_of(cartItem) != \
+                        repository.shard_of(cart):
+                    raise GraphQLError(
+                        'CartItem "' + cartItemID + '" is not in the cart.')
+            repository.remove_cart_items(cart, found.values())
+            record_cart_item_moves(repository, found.values(), None)
 
         ok = True
         return CartAddItems(ok=ok, cart=cart)
@@ -351,31 +528,98 @@ class CartRemoveItems(graphene.Mutation):
 class CartPurchase(graphene.Mutation):
     class Arguments:
         cartID = graphene.ID()
+        idempotency_key = graphene.String()
 
     ok = graphene.Boolean()
     cart = graphene.Field(lambda: Cart)
+    order = graphene.Field(lambda: Order)
 
+    # Each retry looks for a stored result first
+    @retry_on_conflict
+    @idempotent
     def mutate(self, info, cartID):
-        # Because the purchasability  of the product is checked
-        # when the product is initially added to the cart, the product may
-        # become out of stock or unpurchasable while the product is in cart.
-        # Thus, each product in the cart should be checked for purchasability
-        # before the purchase is completed.
-        cart = db_session.query(CartModel).get(decode_id(cartID))
-        if len(cart.cart_items) == 0:
-            raise GraphQLError('Cart cannot be purchased. It is empty.')
-        for cartItem in cart.cart_items:
-            # Verify that the cart item is both in stock and purchasable
-            cartItemID = encode_id(
-                CartItemModel.__tablename__, str(
-                    cartItem.id))
-            validate_cart_item(cartItem, cartItemID)
-        # Purchase the items
-        for cartItem in cart.cart_items:
-            cartItem.product.inventory_count -= cartItem.quantity
-        db_session.commit()
+        repository = get_repository()
+        with repository.transaction():
+            # Because the purchasability  of the product is checked
+            # when the product is initially added to the cart, the product may
+            # become out of stock or unpurchasable while the product is in
+            # cart. Thus, each product in the cart should be checked for
+            # purchasability before the purchase is completed.
+            cart = repository.get_cart(decode_id(cartID))
+            # Also stops a retried purchase from buying the cart a second time
+            if cart.purchased_at is not None:
+                raise GraphQLError('Cart has already been purchased.')
+            if len(cart.cart_items) == 0:
+                raise GraphQLError('Cart cannot be purchased. It is empty.')
+            for cartItem in cart.cart_items:
+                # Verify that the cart item is both in stock and purchasable
+                cartItemID = encode_id(
+                    CartItemModel.__tablename__,
+                    repository.key(cartItem))
+                validate_cart_item(cartItem, cartItemID)
+            # Purchase the items
+            order = repository.purchase_cart(cart)
+            for cartItem in cart.cart_items:
+                repository.record_change(cartItem.product, UPDATE, dict(
+                    inventory_count=cartItem.product.inventory_count))
+            repository.record_change(cart, UPDATE, dict(
+                purchased_at=cart.purchased_at))
+            repository.record_change(order, CREATE, dict(
+                userid=order.userid, cart_id=repository.key(cart),
+                currency=order.currency, total=order.total))
+            remember(repository, ok=True, cart=cart, order=order)
+
+        products = dict((repository.key(cartItem.product), cartItem.product)
+                        for cartItem in cart.cart_items)
+        for key, product in products.items():
+            events.publish(events.INVENTORY_CHANGED, product_id=key,
+                           inventory_count=product.inventory_count,
+                           deleted=False)
         ok = True
-        return CartPurchase(ok=ok, cart=cart)
+        return CartPurchase(ok=ok, cart=cart, order=order)
+
+
+class InventoryChange(graphene.ObjectType):
+    product_id = graphene.ID()
+    inventory_count = graphene.Int()
+    deleted = graphene.Boolean()
+    product = graphene.Field(lambda: Product)
+
+    def resolve_product_id(self, info):
+        return relay.Node.to_global_id(Product._meta.name, self.product_id)
+
+    def resolve_product(self, info):
+        if self.deleted:
+            return None
+        return get_repository().get_product(self.product_id)
+
+
+def subscribed_product_keys(productIds):
+    if productIds is None:
+        return None
+    return [decode_id(productId) for productId in productIds]
+
+
+class Subscription(graphene.ObjectType):
+    # Fed by storeify.events; changes to a product in quick succession are
+    # delivered as one
+    inventory_changed = graphene.Field(
+        InventoryChange,
+        productIds=graphene.List(graphene.NonNull(graphene.ID)))
+    product_updated = graphene.Field(
+        lambda: Product,
+        productIds=graphene.List(graphene.NonNull(graphene.ID)))
+
+    def resolve_inventory_changed(self, info, productIds=None):
+        return events.observe(
+            events.INVENTORY_CHANGED, subscribed_product_keys(productIds)) \
+            .map(lambda event: InventoryChange(**event))
+
+    def resolve_product_updated(self, info, productIds=None):
+        return events.observe(
+            events.PRODUCT_UPDATED, subscribed_product_keys(productIds)) \
+            .map(lambda event: get_repository().get_product(
+                event['product_id']))
 
 
 class Mutations(graphene.ObjectType):
@@ -393,4 +637,23 @@ class Mutations(graphene.ObjectType):
     cart_purchase = CartPurchase.Field()
 
 
-schema = graphene.Schema(query=Query, mutation=Mutations)
+_schema = None
+
+
+def get_schema():
+    # Building the schema walks every type and field, so it is deferred until
+    # the first request (or warm_up) rather than done at import time.
+    global _schema
+    if _schema is None:
+        _schema = graphene.Schema(
+            query=Query, mutation=Mutations, subscription=Subscription,
+            directives=[GraphQLIncludeDirective, GraphQLSkipDirective,
+                        DeferDirective, StreamDirective])
+    return _schema
+
+
+def __getattr__(name):
+    if name == 'schema':
+        return get_schema()
+    raise AttributeError(
+        "module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,327 @@
+"""
+Pre-forking multi-process server for the storeify app.
+
+The master process binds the listening socket and forks a fixed number of
+workers which accept connections from it (or, with reuse_port, each bind
+their own SO_REUSEPORT socket and let the kernel balance between them).
+Database engines are only ever created after the fork, so no SQLite handle
+is shared between processes.
+
+    $ python -m storeify.serve --workers 4 --port 5000
+
+Workers handle one request at a time, or with --threads up to that many at
+once, each in a thread of its own; admission control (storeify.admission)
+then turns requests away early when the database cannot keep up.
+
+Signals handled by the master:
+    SIGHUP          graceful rolling restart of every worker
+    SIGTERM/SIGINT  graceful shutdown
+"""
+import argparse
+import errno
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from socketserver import ThreadingMixIn
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from storeify import db, subscriptions
+from storeify.config import Config
+from storeify.view import warm_up
+
+
+def post_fork():
+    """
+    Runs in every worker right after it is forked. Any engine inherited from
+    the master is discarded so the worker opens its own connections, and the
+    schema and known operations are prepared before the first accept().
+    """
+    db.dispose_db_engine()
+    warm_up()
+
+
+def bind_socket(host, port, reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(Config.SERVER_BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+
+class RequestHandler(WSGIRequestHandler):
+    """
+    Hands WebSocket upgrades of /graphql to storeify.subscriptions, which
+    keep their connection in a thread of their own, and everything else to
+    the app.
+    """
+
+    def run_wsgi(self):
+        if self.path.split('?', 1)[0] != '/graphql' or \
+                not subscriptions.is_upgrade(self.headers):
+            return super(RequestHandler, self).run_wsgi()
+        response = subscriptions.handshake(self.headers)
+        if response is None:
+            self.send_error(400, 'Expected a WebSocket upgrade to %s' %
+                            subscriptions.PROTOCOL)
+            return
+        if not subscriptions.reserve_connection():
+            self.send_error(503, 'Too many WebSocket connections; retry '
+                            'later.')
+            return
+        self.log_request(101)
+        self.wfile.write(response)
+        self.server.detach(self.connection)
+        subscriptions.serve(self.connection)
+        self.close_connection = True
+
+
+class QuietRequestHandler(RequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class WorkerServer(BaseWSGIServer):
+    """A single-threaded server that can let go of a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super(WorkerServer, self).__init__(*args, **kwargs)
+        self.detached = set()
+
+    def detach(self, connection):
+        """Leaves the connection open once its request is handled."""
+        self.detached.add(connection)
+
+    def shutdown_request(self, request):
+        if request in self.detached:
+            self.detached.discard(request)
+            return
+        super(WorkerServer, self).shutdown_request(request)
+
+
+class ThreadedWorkerServer(ThreadingMixIn, WorkerServer):
+    """A WorkerServer handling up to `threads` requests at once."""
+
+    multithread = True
+    # Joined by server_close(), so a worker finishes its requests on exit
+    daemon_threads = False
+
+    def __init__(self, *args, **kwargs):
+        self.slots = threading.BoundedSemaphore(kwargs.pop('threads'))
+        super(ThreadedWorkerServer, self).__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        # With every thread busy, further connections wait in the listen
+        # backlog, where another worker may pick them up
+        self.slots.acquire()
+        try:
+            super(ThreadedWorkerServer, self).process_request(
+                request, client_address)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super(ThreadedWorkerServer, self).process_request_thread(
+                request, client_address)
+        finally:
+            self.slots.release()
+
+
+class Worker(object):
+    def __init__(self, app, host, port, sock=None, threads=1):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.sock = sock
+        self.threads = threads
+        self.alive = True
+
+    def handle_exit(self, signum, frame):
+        self.alive = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_exit)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        post_fork()
+
+        if self.sock is None:
+            self.sock = bind_socket(self.host, self.port, reuse_port=True)
+        handler = RequestHandler if Config.SERVER_ACCESS_LOG \
+            else QuietRequestHandler
+        if self.threads > 1:
+            server = ThreadedWorkerServer(self.host, self.port, self.app,
+                                          handler, fd=self.sock.fileno(),
+                                          threads=self.threads)
+        else:
+            server = WorkerServer(self.host, self.port, self.app, handler,
+                                  fd=self.sock.fileno())
+        # Poll so a SIGTERM is noticed between requests; the request being
+        # handled when the signal arrives is always finished first.
+        server.timeout = 0.5
+        while self.alive:
+            try:
+                server.handle_request()
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        subscriptions.close_all()
+        server.server_close()
+
+
+class Arbiter(object):
+    """Supervises the worker processes of a single server."""
+
+    def __init__(self, app, host='127.0.0.1', port=5000, workers=None,
+                 reuse_port=False, threads=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = workers or Config.SERVER_WORKERS
+        self.threads = threads or Config.SERVER_THREADS
+        self.reuse_port = reuse_port
+        self.sock = None
+        self.workers = {}
+        self.stopping = False
+        self.restart_requested = False
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid != 0:
+            self.workers[pid] = time.time()
+            return pid
+
+        # Worker process
+        code = 0
+        try:
+            Worker(self.app, self.host, self.port, self.sock,
+                   self.threads).run()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def kill_worker(self, pid, sig=signal.SIGTERM):
+        try:
+            os.kill(pid, sig)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                self.workers.pop(pid, None)
+            else:
+                raise
+
+    def reap_workers(self, block=False):
+        reaped = []
+        while self.workers:
+            try:
+                pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    self.workers.clear()
+                    break
+                raise
+            if pid == 0:
+                break
+            self.workers.pop(pid, None)
+            reaped.append(pid)
+            if block:
+                break
+        return reaped
+
+    def wait_for(self, pid, timeout):
+        deadline = time.time() + timeout
+        while pid in self.workers and time.time() < deadline:
+            self.reap_workers()
+            time.sleep(0.05)
+        if pid in self.workers:
+            self.kill_worker(pid, signal.SIGKILL)
+            self.reap_workers(block=True)
+
+    def restart(self):
+        """Replaces the workers one at a time so capacity never drops to 0."""
+        for old_pid in list(self.workers):
+            self.spawn_worker()
+            self.kill_worker(old_pid)
+            self.wait_for(old_pid, Config.SERVER_GRACEFUL_TIMEOUT)
+
+    def stop(self):
+        for pid in list(self.workers):
+            self.kill_worker(pid)
+        deadline = time.time() + Config.SERVER_GRACEFUL_TIMEOUT
+        while self.workers and time.time() < deadline:
+            self.reap_workers()
+            time.sleep(0.05)
+        for pid in list(self.workers):
+            self.kill_worker(pid, signal.SIGKILL)
+        while self.workers:
+            self.reap_workers(block=True)
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_hup(self, signum, frame):
+        self.restart_requested = True
+
+    def run(self):
+        # The master never talks to the database; make sure an engine
+        # created while importing the app is not inherited by the workers.
+        db.dispose_db_engine()
+        if not self.reuse_port:
+            self.sock = bind_socket(self.host, self.port)
+
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_hup)
+
+        for _ in range(self.num_workers):
+            self.spawn_worker()
+
+        try:
+            while not self.stopping:
+                if self.restart_requested:
+                    self.restart_requested = False
+                    self.restart()
+                self.reap_workers()
+                # Replace workers that died unexpectedly
+                while len(self.workers) < self.num_workers and not self.stopping:
+                    self.spawn_worker()
+                time.sleep(0.1)
+        finally:
+            self.stop()
+            if self.sock is not None:
+                self.sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run storeify with multiple worker processes.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=Config.SERVER_WORKERS)
+    parser.add_argument('--threads', type=int, default=Config.SERVER_THREADS,
+                        help='Requests each worker handles at once.')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='Give each worker its own SO_REUSEPORT socket.')
+    args = parser.parse_args(argv)
+
+    from storeify.app import create_app
+    app = create_app(debug=False)
+    Arbiter(app, args.host, args.port, args.workers,
+            reuse_port=args.reuse_port, threads=args.threads).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+"""
+Horizontal sharding of carts and cart items by userid.
+
+With Config.SHARD_URIS set, the cart and cartitem tables live in those
+databases instead of Config.DATABASE_URI, which keeps the catalog: products,
+exchange rates, the order ledger and the sales rollups. A user's carts, and
+the cart items created for them (CartItemCreate's userid) or added to their
+carts, live on shard_for_userid(userid). Items created without a userid stay
+on the first shard until added to a cart.
+
+One SQLAlchemy ShardedSession spans the catalog and every shard, so ORM code
+keeps working across them: rows are written to the shard their userid hashes
+to, and relationships (a cart's items, an item's product) load from the
+right database. Row ids are only unique within a shard, so cart and cart
+item keys, and the global IDs made of them, carry the shard:
+"<shard>.<id>". Adding an item to a cart on another shard moves it there
+under a new row id; it keeps its key, which the copy records in moved_from,
+and a lookup that misses on the shard in a key looks for an item moved from
+it on the others.
+
+Committing a session that wrote to several databases commits each of them
+in turn; a purchase updates the cart on its shard and the inventory and
+order ledger in the catalog, so a failure in between can leave them out of
+step. Admin queries over every shard run in parallel through fan_out().
+"""
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, func, inspect, select
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql.util import find_tables
+
+from storeify.config import Config
+from storeify.currency import currency_code
+from storeify.models import Cart, CartItem, Product
+from storeify.pricing import price_column
+from storeify.repository import SQLAlchemyRepository, bakery, \
+    set_cart_items_cart
+
+CATALOG = 'catalog'
+SHARDED_TABLES = (Cart.__table__, CartItem.__table__)
+_sharded_table_names = set(table.name for table in SHARDED_TABLES)
+
+shard_engines = None
+_engines_lock = threading.Lock()
+
+
+def sharding_enabled():
+    return bool(Config.SHARD_URIS)
+
+
+def shard_ids():
+    return ['shard%d' % number for number in range(len(Config.SHARD_URIS))]
+
+
+def shard_for_userid(userid):
+    if userid is None:
+        return shard_ids()[0]
+    # crc32 rather than hash(), which differs between processes
+    number = zlib.crc32(str(userid).encode()) % len(Config.SHARD_URIS)
+    return 'shard%d' % number
+
+
+def get_shard_engines():
+    global shard_engines
+    with _engines_lock:
+        if shard_engines is None:
+            shard_engines = dict(
+                (shard_id, create_engine(uri, convert_unicode=True))
+                for shard_id, uri in zip(shard_ids(), Config.SHARD_URIS))
+    return shard_engines
+
+
+def dispose_shard_engines():
+    global shard_engines
+    with _engines_lock:
+        for engine in (shard_engines or {}).values():
+            engine.dispose()
+        shard_engines = None
+
+
+def create_shards():
+    """Creates the cart tables in every shard."""
+    from storeify.db import Base
+    for engine in get_shard_engines().values():
+        Base.metadata.create_all(bind=engine, tables=SHARDED_TABLES)
+
+
+def catalog_tables():
+    from storeify.db import Base
+    return [table for table in Base.metadata.sorted_tables
+            if table.name not in _sharded_table_names]
+
+
+# Routing for ShardedSession
+
+def _is_sharded(mapper):
+    return mapper is not None and \
+        mapper.local_table.name in _sharded_table_names
+
+
+def _shard_of(state):
+    return state.key[2] if state.key else state.identity_token
+
+
+def _choose_shard(mapper, instance, clause=None):
+    if _is_sharded(mapper):
+        if instance is None:
+            raise ValueError('Statements on %s need an explicit shard.' %
+                             mapper.local_table.name)
+        return shard_for_userid(instance.userid)
+    if mapper is None and clause is not None:
+        for table in find_tables(clause, include_crud=True):
+            if table.name in _sharded_table_names:
+                raise ValueError('Statements on %s need an explicit shard.' %
+                                 table.name)
+    return CATALOG
+
+
+def _choose_query_shards(query):
+    if not _is_sharded(query._mapper_zero()):
+        return [CATALOG]
+    if query.lazy_loaded_from is not None:
+        return [_shard_of(query.lazy_loaded_from)]
+    return shard_ids()
+
+
+def _choose_id_shards(query, ident):
+    return _choose_query_shards(query)
+
+
+def sharded_session_factory(catalog_engine):
+    shards = {CATALOG: catalog_engine}
+    shards.update(get_shard_engines())
+    return sessionmaker(class_=ShardedSession,
+                        shard_chooser=_choose_shard,
+                        id_chooser=_choose_id_shards,
+                        query_chooser=_choose_query_shards,
+                        shards=shards,
+                        autocommit=False,
+                        autoflush=False)
+
+
+def encode_key(shard_id, id):
+    return '%s.%d' % (shard_id, id)
+
+
+def decode_key(key):
+    """(shard id, row id) of a key, or (None, None) if it is not one."""
+    shard_id, _, id = str(key).partition('.')
+    if shard_id not in shard_ids() or not id.isdigit():
+        return None, None
+    return shard_id, int(id)
+
+
+def fan_out(fn, shards=None):
+    """
+    Calls fn(shard id, session) for every shard in parallel, each with its
+    own Session bound to the shard's engine. Returns {shard id: result}.
+    """
+    engines = get_shard_engines()
+    shards = shards or shard_ids()
+
+    def run(shard_id):
+        session = Session(bind=engines[shard_id])
+        try:
+            return fn(shard_id, session)
+        finally:
+            session.close()
+
+    if not shards:
+        return {}
+    with ThreadPoolExecutor(
+            max_workers=min(len(shards), Config.SHARD_FANOUT_WORKERS)) \
+            as pool:
+        return dict(zip(shards, pool.map(run, shards)))
+
+
+def shard_stats():
+    """{shard id: row counts} of the cart tables of every shard."""
+    def count(shard_id, session):
+        carts = Cart.__table__
+        items = CartItem.__table__
+        return {
+            'carts': session.execute(
+                select([func.count()]).select_from(carts)).scalar(),
+            'cart_items': session.execute(
+                select([func.count()]).select_from(items)).scalar(),
+            'orphan_cart_items': session.execute(
+                select([func.count()]).select_from(items)
+                .where(items.c.cart_id.is_(None))).scalar(),
+        }
+    return fan_out(count)
+
+
+class ShardedRepository(SQLAlchemyRepository):
+    """SQLAlchemyRepository over a ShardedSession (see storeify.db)."""
+
+    def key(self, instance):
+        if getattr(instance, 'moved_from', None) is not None:
+            return instance.moved_from
+        if instance.__table__ in SHARDED_TABLES:
+            return encode_key(self.shard_of(instance), instance.id)
+        return str(instance.id)
+
+    def _get(self, model, key):
+        shard_id, id = decode_key(key)
+        if shard_id is None:
+            return None
+        # Baked per model and shard, as get_by_key() bakes per model
+        return bakery(
+            lambda session: session.query(model).set_shard(shard_id),
+            model, shard_id)(self.session()).get(id)
+
+    def _load_products(self, cart_items):
+        # Items can't be joined to products in another database; loading
+        # the products up front lets item.product come from the identity map
+        product_ids = set(item.product_id for item in cart_items)
+        if product_ids:
+            self.session.query(Product) \
+                .filter(Product.id.in_(product_ids)).all()
+        return cart_items
+
+    def _moved_cart_items(self, keys):
+        """The cart items moved to another shard since given these keys."""
+        found = []
+        for shard_id in shard_ids():
+            found.extend(self.session.query(CartItem).set_shard(shard_id)
+                         .filter(CartItem.moved_from.in_(keys)))
+        return found
+
+    def get_cart_item(self, key):
+        cart_item = self._get(CartItem, key)
+        if cart_item is None:
+            if decode_key(key)[0] is None:
+                return None
+            moved = self._moved_cart_items([key])
+            return moved[0] if moved else None
+        # The row id of a moved item is not its key
+        return cart_item if self.key(cart_item) == key else None
+
+    def get_cart_items(self, keys):
+        ids = {}
+        for key in keys:
+            shard_id, id = decode_key(key)
+            if shard_id is not None:
+                ids.setdefault(shard_id, set()).add(id)
+        found = []
+        for shard_id, ids_in_shard in sorted(ids.items()):
+            found.extend(self.session.query(CartItem).set_shard(shard_id)
+                         .filter(CartItem.id.in_(ids_in_shard)))
+        found = [cart_item for cart_item in found
+                 if cart_item.moved_from is None]
+        missing = set(key for key in keys if decode_key(key)[0] is not None) \
+            - set(self.key(cart_item) for cart_item in found)
+        if missing:
+            found.extend(self._moved_cart_items(missing))
+        return self._load_products(found)
+
+    def cart_items_in(self, cart):
+        return self._load_products(
+            self.session.query(CartItem).set_shard(self.shard_of(cart))
+            .filter_by(cart_id=cart.id).all())
+
+    def shard_of(self, instance):
+        return _shard_of(inspect(instance))
+
+    def get_cart(self, key):
+        return self._get(Cart, key)
+
+    def carts_for_user(self, userid):
+        return self.session.query(Cart) \
+            .set_shard(shard_for_userid(userid)) \
+            .filter_by(userid=userid).all()
+
+    def add_cart_items(self, cart, cart_items):
+        shard_id = self.shard_of(cart)
+        local = []
+        for cart_item in cart_items:
+            if self.shard_of(cart_item) == shard_id:
+                local.append(cart_item)
+                continue
+            # Copied into the cart's shard under the same key; the version
+            # check on deleting the original catches concurrent changes to it
+            self.session.add(CartItem(
+                cart_id=cart.id, userid=cart.userid,
+                product_id=cart_item.product_id, quantity=cart_item.quantity,
+                created_at=cart_item.created_at,
+                moved_from=self.key(cart_item)))
+            self.session.delete(cart_item)
+        set_cart_items_cart(self.session.connection(shard_id=shard_id),
+                            local, cart.id, userid=cart.userid)
+        self._touch(cart)
+
+    def remove_cart_items(self, cart, cart_items):
+        set_cart_items_cart(
+            self.session.connection(shard_id=self.shard_of(cart)),
+            cart_items, None)
+        self._touch(cart)
+
+    def cart_totals(self, cart_keys):
+        carts = {}
+        for key in cart_keys:
+            shard_id, id = decode_key(key)
+            carts.setdefault(shard_id, []).append(id)
+
+        items = CartItem.__table__
+        cart_table = Cart.__table__
+        rows = []
+        for shard_id, ids in carts.items():
+            if shard_id is None:
+                continue
+            rows.extend((shard_id, ) + tuple(row) for row in
+                        self.session.connection(shard_id=shard_id).execute(
+                select([cart_table.c.id, cart_table.c.currency,
+                        items.c.product_id, items.c.quantity])
+                .select_from(cart_table.join(
+                    items, items.c.cart_id == cart_table.c.id))
+                .where(cart_table.c.id.in_(ids))))
+
+        prices = {}
+        product_ids = set(row[3] for row in rows)
+        if product_ids:
+            columns = Product.__table__.c
+            for row in self.session.execute(
+                    select([columns.id, columns.price_usd, columns.price_cad,
+                            columns.price_eur])
+                    .where(columns.id.in_(product_ids))):
+                prices[row[0]] = row
+
+        totals = dict((key, 0) for key in cart_keys)
+        for shard_id, id, currency, product_id, quantity in rows:
+            product = prices.get(product_id)
+            if product is None:
+                # As the inner join in pricing.cart_totals
+                continue
+            unit_price = product[price_column(currency_code(currency)).key]
+            if unit_price is None:
+                raise ValueError("Invalid currency pair.")
+            totals[encode_key(shard_id, id)] += unit_price * quantity
+        return totals
@@ -0,0 +1,181 @@
+"""
+Slow query log.
+
+With Config.SLOW_QUERY_THRESHOLD set, every SQL statement is timed through
+SQLAlchemy's cursor events, on every engine. One that takes the threshold
+(in seconds) or longer is logged to the storeify.slow_queries logger, with
+the GraphQL operation and the path of the field being resolved when it ran
+(None for statements run outside a resolver, such as batched loads and
+commits).
+
+Slow statements are aggregated by shape: the statement with literals and
+bound parameters replaced by "?" and IN lists collapsed, so that the same
+query for different ids counts once. The first time a shape is slow, its
+plan is captured by running it again under EXPLAIN QUERY PLAN (EXPLAIN on
+other databases than SQLite) and logged with it. Up to
+Config.SLOW_QUERY_MAX_STATEMENTS shapes are kept per process; report() lists
+them, and GET /slow-queries serves the list behind the X-Profile token of
+storeify.profiling.
+"""
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from storeify.config import Config
+
+log = logging.getLogger(__name__)
+
+_STARTED = 'storeify.slow_queries.started'
+_EXPLAINABLE = ('SELECT', 'WITH', 'UPDATE', 'DELETE')
+
+_parameters = re.compile(r'%\(\w+\)s|:\w+\b|\$\d+')
+_literals = re.compile(r"'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?\b")
+_in_lists = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_space = re.compile(r'\s+')
+
+_current = threading.local()
+_lock = threading.Lock()
+statements = {}
+
+
+def normalize(statement):
+    """The shape of a statement, which slow statements are grouped by."""
+    statement = _space.sub(' ', statement).strip()
+    statement = _parameters.sub('?', statement)
+    statement = _literals.sub('?', statement)
+    return _in_lists.sub('(?, ...)', statement)
+
+
+# Attribution
+
+@contextmanager
+def operation_context(operation):
+    """Attributes the statements run in the block to a GraphQL operation."""
+    previous = getattr(_current, 'operation', None)
+    _current.operation = operation
+    try:
+        yield
+    finally:
+        _current.operation = previous
+
+
+def track_path(next, root, info, **args):
+    """GraphQL middleware attributing statements to the resolving field."""
+    previous = getattr(_current, 'path', None)
+    _current.path = info.path
+    try:
+        return next(root, info, **args)
+    finally:
+        _current.path = previous
+
+
+def middleware():
+    """The GraphQL middleware to run requests with, if the log is on."""
+    if Config.SLOW_QUERY_THRESHOLD is None:
+        return None
+    return [track_path]
+
+
+# Timing
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if Config.SLOW_QUERY_THRESHOLD is not None:
+        conn.info.setdefault(_STARTED, []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info.get(_STARTED)
+    if not started:
+        return
+    seconds = time.perf_counter() - started.pop()
+    threshold = Config.SLOW_QUERY_THRESHOLD
+    if threshold is not None and seconds >= threshold:
+        record(conn, statement, parameters, executemany, seconds)
+
+
+def _handle_error(context):
+    started = context.connection is not None and \
+        context.connection.info.get(_STARTED)
+    if started:
+        started.pop()
+
+
+def install():
+    """Times the statements of every engine; idempotent."""
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+# Recording
+
+def explain(conn, statement, parameters):
+    """The plan of a statement, one line per step, or None."""
+    if not statement.lstrip().upper().startswith(_EXPLAINABLE):
+        return None
+    prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' \
+        else 'EXPLAIN '
+    # Straight on the DBAPI connection, so that it is not timed itself
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return [str(row[-1]) for row in cursor.fetchall()]
+    except Exception:
+        log.debug('Could not explain %s', statement, exc_info=True)
+        return None
+    finally:
+        cursor.close()
+
+
+def _format_path(path):
+    return '.'.join(str(key) for key in path) if path else None
+
+
+def record(conn, statement, parameters, executemany, seconds):
+    operation = getattr(_current, 'operation', None)
+    path = _format_path(getattr(_current, 'path', None))
+    shape = normalize(statement)
+    with _lock:
+        entry = statements.get(shape)
+        first = entry is None and \
+            len(statements) < Config.SLOW_QUERY_MAX_STATEMENTS
+        if first:
+            entry = statements[shape] = {
+                'statement': shape, 'count': 0, 'totalSeconds': 0.0,
+                'maxSeconds': 0.0, 'plan': None}
+        if entry is not None:
+            entry['count'] += 1
+            entry['totalSeconds'] += seconds
+            entry['maxSeconds'] = max(entry['maxSeconds'], seconds)
+            entry['operation'] = operation
+            entry['path'] = path
+
+    log.warning('Slow query (%.3fs) in %s at %s: %s', seconds, operation,
+                path, statement)
+    if first and not executemany:
+        plan = explain(conn, statement, parameters)
+        if plan is not None:
+            with _lock:
+                entry['plan'] = plan
+            log.warning('Plan of %s:\n    %s', shape, '\n    '.join(plan))
+
+
+def report():
+    """The slow statement shapes, by total time taken, slowest first."""
+    with _lock:
+        entries = [dict(entry) for entry in statements.values()]
+    return sorted(entries, key=lambda entry: -entry['totalSeconds'])
+
+
+def reset():
+    with _lock:
+        statements.clear()
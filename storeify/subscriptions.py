@@ -0,0 +1,373 @@
+"""
+GraphQL over WebSocket, for the subscriptions in storeify.schema.
+
+Speaks the graphql-transport-ws protocol (the one graphql-ws clients use) on
+/graphql, after a WebSocket handshake (RFC 6455) answered by the request
+handler of storeify.serve:
+
+    client: connection_init           server: connection_ack
+    client: subscribe {id, payload}   server: next {id, payload}... complete
+    client: complete {id}             (stops a subscription)
+    either: ping / pong
+
+payload is {"query", "variables", "operationName"}, as for /graphql.
+Only subscriptions are taken: queries and mutations are answered with an
+error, and go to /graphql, where admission control and idempotency keys
+apply to them. Subscription results come from storeify.events, coalesced
+per product, and are resolved in the process's delivery thread.
+
+Each connection gets a thread of its own, so it does not hold up the
+worker's other requests. A worker keeps at most
+Config.SUBSCRIPTION_MAX_CONNECTIONS connections open and answers further
+upgrades with 503. Connections are closed with 1001 when the worker stops.
+"""
+import base64
+import hashlib
+import json
+import logging
+import socket
+import struct
+import threading
+import weakref
+
+from graphql import GraphQLError, subscribe
+from graphql.error import format_error
+from graphql.utils.get_operation_ast import get_operation_ast
+from rx import Observable
+
+from storeify.backend import document_backend
+from storeify.config import Config
+from storeify.encoding import json_encode
+from storeify.loaders import Loaders
+from storeify.repository import get_repository
+
+PROTOCOL = 'graphql-transport-ws'
+_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+TEXT, BINARY, CLOSE, PING, PONG = 0x1, 0x2, 0x8, 0x9, 0xA
+CONTINUATION = 0x0
+
+log = logging.getLogger(__name__)
+
+connections = weakref.WeakSet()
+_open = 0
+_open_lock = threading.Lock()
+
+
+class WebSocketClosed(Exception):
+    pass
+
+
+def reserve_connection():
+    """
+    Takes one of the worker's Config.SUBSCRIPTION_MAX_CONNECTIONS
+    connections, which serve() gives back once the connection ends. Returns
+    False if they are all open.
+    """
+    global _open
+    with _open_lock:
+        if _open >= Config.SUBSCRIPTION_MAX_CONNECTIONS:
+            return False
+        _open += 1
+        return True
+
+
+def _release_connection():
+    global _open
+    with _open_lock:
+        _open -= 1
+
+
+def is_upgrade(headers):
+    return headers.get('Upgrade', '').lower() == 'websocket' and \
+        'upgrade' in headers.get('Connection', '').lower()
+
+
+def handshake(headers):
+    """
+    The 101 response accepting a WebSocket upgrade for PROTOCOL, or None if
+    the request does not ask for it.
+    """
+    key = headers.get('Sec-WebSocket-Key')
+    protocols = [protocol.strip() for protocol in
+                 headers.get('Sec-WebSocket-Protocol', '').split(',')]
+    if not is_upgrade(headers) or not key or PROTOCOL not in protocols or \
+            headers.get('Sec-WebSocket-Version') != '13':
+        return None
+    accept = base64.b64encode(
+        hashlib.sha1((key + _GUID).encode()).digest()).decode()
+    return ('HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: %s\r\n'
+            'Sec-WebSocket-Protocol: %s\r\n\r\n' % (accept, PROTOCOL)).encode()
+
+
+def _unmask(payload, mask):
+    length = len(payload)
+    key = int.from_bytes((mask * (length // 4 + 1))[:length], 'big')
+    return (int.from_bytes(payload, 'big') ^ key).to_bytes(length, 'big')
+
+
+class WebSocket(object):
+    """The server end of an RFC 6455 connection, after the handshake."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    def _receive_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise WebSocketClosed()
+            data += chunk
+        return data
+
+    def _send_frame(self, opcode, payload=b''):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self.send_lock:
+            if self.closed:
+                raise WebSocketClosed()
+            self.sock.sendall(header + payload)
+
+    def send(self, text):
+        # json_encode gives bytes with orjson and str otherwise
+        if isinstance(text, str):
+            text = text.encode()
+        self._send_frame(TEXT, text)
+
+    def receive(self):
+        """The next text message; raises WebSocketClosed once closed."""
+        fragments = []
+        while True:
+            first, second = self._receive_exactly(2)
+            fin, opcode = first & 0x80, first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length, = struct.unpack('!H', self._receive_exactly(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', self._receive_exactly(8))
+            if not second & 0x80:
+                # Clients must mask every frame
+                self.close(1002)
+                raise WebSocketClosed()
+            if length > Config.SUBSCRIPTION_MAX_MESSAGE_SIZE:
+                self.close(1009)
+                raise WebSocketClosed()
+            mask = self._receive_exactly(4)
+            payload = _unmask(self._receive_exactly(length), mask)
+
+            if opcode == CLOSE:
+                self.close()
+                raise WebSocketClosed()
+            elif opcode == PING:
+                self._send_frame(PONG, payload)
+            elif opcode in (TEXT, BINARY, CONTINUATION):
+                fragments.append(payload)
+                if fin:
+                    try:
+                        return b''.join(fragments).decode()
+                    except UnicodeDecodeError:
+                        self.close(1007)
+                        raise WebSocketClosed()
+
+    def close(self, code=1000, reason=''):
+        try:
+            self._send_frame(CLOSE, struct.pack('!H', code) +
+                             reason.encode()[:120])
+        except (WebSocketClosed, OSError):
+            pass
+        with self.send_lock:
+            self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class GraphQLWSConnection(object):
+    """One graphql-transport-ws connection and its subscriptions."""
+
+    def __init__(self, websocket, schema):
+        self.websocket = websocket
+        self.schema = schema
+        self.acknowledged = False
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+        self.context = {'repository': get_repository(), 'loaders': Loaders()}
+
+    def send(self, message):
+        try:
+            self.websocket.send(json_encode(message))
+        except (WebSocketClosed, OSError):
+            pass
+
+    def close(self, code=1000, reason=''):
+        self.websocket.close(code, reason)
+
+    def run(self):
+        connections.add(self)
+        try:
+            while True:
+                try:
+                    message = json.loads(self.websocket.receive())
+                except ValueError:
+                    message = None
+                if not isinstance(message, dict):
+                    return self.close(4400, 'Invalid message')
+                if not self.handle(message):
+                    return
+        except (WebSocketClosed, OSError):
+            pass
+        finally:
+            connections.discard(self)
+            self.stop_all()
+            if not self.websocket.closed:
+                self.close()
+
+    def handle(self, message):
+        """Acts on a client message; returns False to end the connection."""
+        kind = message.get('type')
+        if kind == 'connection_init':
+            if self.acknowledged:
+                self.close(4429, 'Too many initialisation requests')
+                return False
+            self.acknowledged = True
+            self.send({'type': 'connection_ack'})
+        elif kind == 'ping':
+            self.send({'type': 'pong'})
+        elif kind == 'pong':
+            pass
+        elif kind == 'subscribe':
+            if not self.acknowledged:
+                self.close(4401, 'Unauthorized')
+                return False
+            id = message.get('id')
+            payload = message.get('payload')
+            if not isinstance(id, str) or not isinstance(payload, dict):
+                self.close(4400, 'Invalid message')
+                return False
+            with self.lock:
+                if id in self.subscriptions:
+                    self.close(4409, 'Subscriber for %s already exists' % id)
+                    return False
+            self.start(id, payload)
+        elif kind == 'complete':
+            self.stop(message.get('id'))
+        else:
+            self.close(4400, 'Invalid message')
+            return False
+        return True
+
+    def send_errors(self, id, errors):
+        self.send({'type': 'error', 'id': id,
+                   'payload': [format_error(error) for error in errors]})
+
+    def start(self, id, payload):
+        query = payload.get('query')
+        if not isinstance(query, str):
+            return self.send_errors(id, [GraphQLError('Must provide query.')])
+        try:
+            document = document_backend.document_from_string(self.schema,
+                                                             query)
+        except GraphQLError as error:
+            return self.send_errors(id, [error])
+        if document.errors:
+            return self.send_errors(id, document.errors)
+
+        operation_name = payload.get('operationName')
+        operation = get_operation_ast(document.document_ast, operation_name)
+        if operation is None or operation.operation != 'subscription':
+            return self.send_errors(id, [GraphQLError(
+                'Only subscriptions are taken over WebSocket; send queries '
+                'and mutations to /graphql.')])
+        if len(self.subscriptions) >= Config.SUBSCRIPTION_MAX_PER_CONNECTION:
+            return self.send_errors(id, [GraphQLError(
+                'A connection can have at most %d subscriptions.' %
+                Config.SUBSCRIPTION_MAX_PER_CONNECTION)])
+
+        try:
+            result = subscribe(self.schema, document.document_ast,
+                               context_value=self.context,
+                               variable_values=payload.get('variables') or {},
+                               operation_name=operation_name)
+        except GraphQLError as error:
+            return self.send_errors(id, [error])
+
+        if not isinstance(result, Observable):
+            return self.send_errors(id, result.errors)
+
+        def on_completed():
+            if self.forget(id):
+                self.send({'type': 'complete', 'id': id})
+
+        def on_error(error):
+            if self.forget(id):
+                self.send_errors(id, [error])
+
+        with self.lock:
+            self.subscriptions[id] = result.subscribe(
+                lambda result: self.send_next(id, result), on_error,
+                on_completed)
+
+    def send_next(self, id, result):
+        try:
+            self.send({'type': 'next', 'id': id,
+                       'payload': result.to_dict(format_error=format_error)})
+        finally:
+            # Results are resolved in the delivery thread, with a session
+            # of its own
+            self.context['repository'].close()
+
+    def forget(self, id):
+        with self.lock:
+            return self.subscriptions.pop(id, None) is not None
+
+    def stop(self, id):
+        with self.lock:
+            subscription = self.subscriptions.pop(id, None)
+        if subscription is not None:
+            subscription.dispose()
+
+    def stop_all(self):
+        with self.lock:
+            subscriptions = list(self.subscriptions.values())
+            self.subscriptions.clear()
+        for subscription in subscriptions:
+            subscription.dispose()
+
+
+def serve(sock, schema=None):
+    """
+    Runs a connection, in a thread of its own, on an upgraded socket, for
+    which reserve_connection() was called.
+    """
+    if schema is None:
+        from storeify.schema import get_schema
+        schema = get_schema()
+    connection = GraphQLWSConnection(WebSocket(sock), schema)
+
+    def run():
+        try:
+            connection.run()
+        finally:
+            _release_connection()
+    thread = threading.Thread(target=run, name='storeify-websocket',
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def close_all(code=1001, reason='Server shutting down'):
+    for connection in list(connections):
+        connection.close(code, reason)
@@ -0,0 +1,218 @@
+"""
+Background deletion of orphan cart items and abandoned carts.
+
+CartItemCreate inserts cart items that belong to no cart until they are
+added to one, and carts that are never purchased are never removed. The
+sweeper deletes cart items with no cart and carts with no purchase once
+their updated_at is older than Config.SWEEPER_CART_ITEM_MAX_AGE and
+Config.SWEEPER_CART_MAX_AGE, and expired idempotency keys (see
+storeify.idempotency). Rows are deleted Config.SWEEPER_BATCH_SIZE at
+a time, one transaction per batch, pausing Config.SWEEPER_BATCH_DELAY
+seconds between batches. Each batch appends its deletes to the change log
+(see storeify.changelog) in its transaction; with sharding on, the log is
+in the catalog and is committed right after the shard. Rows written before the timestamps existed have
+a NULL updated_at and are left alone. Works on the database only, not on the
+memory storage backend; with sharding on, every shard is swept in parallel.
+"""
+import logging
+import threading
+import time
+
+from sqlalchemy import and_, select
+from sqlalchemy.orm import Session
+
+from storeify import db, idempotency
+from storeify.changelog import DELETE, change_row, insert_changes
+from storeify.config import Config
+from storeify.db import get_db_session
+from storeify.models import Cart, CartItem, unix_time
+
+log = logging.getLogger(__name__)
+
+
+class SweeperStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.batches = 0
+        self.cart_items_deleted = 0
+        self.carts_deleted = 0
+        self.idempotency_keys_deleted = 0
+        self.errors = 0
+        self.last_run_at = None
+        self.last_run_seconds = None
+
+    def add(self, **counts):
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def as_dict(self):
+        with self.lock:
+            return dict((name, value) for name, value in vars(self).items()
+                        if name != 'lock')
+
+
+stats = SweeperStats()
+
+
+def _ids(db_session, table, condition, limit):
+    return [row[0] for row in db_session.execute(
+        select([table.c.id]).where(condition)
+        .order_by(table.c.id).limit(limit))]
+
+
+def _sweep_batches(db_session, log_session, table, condition, delete_batch,
+                   batch_size, delay):
+    deleted = 0
+    while True:
+        ids = _ids(db_session, table, condition, batch_size)
+        if not ids:
+            return deleted
+        deleted += delete_batch(ids)
+        db_session.commit()
+        if log_session is not db_session:
+            log_session.commit()
+        stats.add(batches=1)
+        if len(ids) < batch_size:
+            return deleted
+        if delay:
+            time.sleep(delay)
+
+
+def _sweep_database(db_session, now, batch_size, delay, shard_id=None,
+                    log_session=None):
+    """
+    Sweeps one database. With sharding, shard_id names it and log_session
+    is a session on the catalog to log the deletes to.
+    """
+    items = CartItem.__table__
+    carts = Cart.__table__
+    log_session = log_session or db_session
+    orphan_items = and_(items.c.cart_id.is_(None), items.c.updated_at <
+                        now - Config.SWEEPER_CART_ITEM_MAX_AGE)
+    abandoned_carts = and_(carts.c.purchased_at.is_(None), carts.c.updated_at <
+                           now - Config.SWEEPER_CART_MAX_AGE)
+
+    def key(id, moved_from=None):
+        # As Repository.key() gives it for the backend
+        if moved_from is not None:
+            return moved_from
+        if shard_id is None:
+            return str(id)
+        from storeify.sharding import encode_key
+        return encode_key(shard_id, id)
+
+    def log_deletes(table, rows):
+        insert_changes(log_session, [
+            change_row(table.name, key(*row), DELETE) for row in rows])
+
+    # The DELETEs check the condition again, so that a row added to a cart,
+    # purchased or touched since it was selected is left alone; the counts
+    # are of the rows actually deleted
+
+    def delete_items(ids):
+        condition = and_(items.c.id.in_(ids), orphan_items)
+        log_deletes(items, db_session.execute(
+            select([items.c.id, items.c.moved_from]).where(condition)))
+        return db_session.execute(items.delete().where(condition)).rowcount
+
+    def delete_carts(ids):
+        condition = and_(carts.c.id.in_(ids), abandoned_carts)
+        # Items still in an abandoned cart go with it
+        in_carts = items.c.cart_id.in_(select([carts.c.id]).where(condition))
+        log_deletes(items, db_session.execute(
+            select([items.c.id, items.c.moved_from]).where(in_carts)))
+        db_session.execute(items.delete().where(in_carts))
+        log_deletes(carts, db_session.execute(
+            select([carts.c.id]).where(condition)))
+        return db_session.execute(carts.delete().where(condition)).rowcount
+
+    try:
+        cart_items_deleted = _sweep_batches(
+            db_session, log_session, items, orphan_items, delete_items,
+            batch_size, delay)
+        carts_deleted = _sweep_batches(
+            db_session, log_session, carts, abandoned_carts, delete_carts,
+            batch_size, delay)
+    except Exception:
+        db_session.rollback()
+        if log_session is not db_session:
+            log_session.rollback()
+        stats.add(errors=1)
+        raise
+    return cart_items_deleted, carts_deleted
+
+
+def sweep(db_session=None, now=None, batch_size=None, delay=None):
+    """
+    Runs one sweep to completion and returns the number of cart items and
+    carts deleted.
+    """
+    from storeify.sharding import fan_out, sharding_enabled
+
+    now = now if now is not None else unix_time()
+    batch_size = batch_size or Config.SWEEPER_BATCH_SIZE
+    delay = Config.SWEEPER_BATCH_DELAY if delay is None else delay
+    started = time.time()
+
+    if db_session is None and sharding_enabled():
+        get_db_session()
+        catalog_engine = db.db_engine
+
+        def sweep_shard(shard_id, session):
+            log_session = Session(bind=catalog_engine)
+            try:
+                return _sweep_database(session, now, batch_size, delay,
+                                       shard_id, log_session)
+            finally:
+                log_session.close()
+        counts = fan_out(sweep_shard).values()
+        cart_items_deleted = sum(count[0] for count in counts)
+        carts_deleted = sum(count[1] for count in counts)
+    else:
+        cart_items_deleted, carts_deleted = _sweep_database(
+            db_session or get_db_session(), now, batch_size, delay)
+    # Kept in the catalog database when sharding
+    catalog_session = db_session or get_db_session()
+    try:
+        idempotency_keys_deleted = idempotency.expire(catalog_session, now,
+                                                      batch_size)
+    except Exception:
+        catalog_session.rollback()
+        stats.add(errors=1)
+        raise
+
+    stats.add(runs=1, cart_items_deleted=cart_items_deleted,
+              carts_deleted=carts_deleted,
+              idempotency_keys_deleted=idempotency_keys_deleted)
+    with stats.lock:
+        stats.last_run_at = now
+        stats.last_run_seconds = time.time() - started
+    return cart_items_deleted, carts_deleted
+
+
+class Sweeper(threading.Thread):
+    """Daemon thread running a sweep every `interval` seconds until stopped."""
+
+    def __init__(self, interval=None):
+        super(Sweeper, self).__init__(name='storeify-sweeper', daemon=True)
+        self.interval = interval or Config.SWEEPER_INTERVAL
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                cart_items, carts = sweep()
+                if cart_items or carts:
+                    log.info('Swept %d cart items and %d carts.',
+                             cart_items, carts)
+            except Exception:
+                log.exception('Sweep failed.')
+            finally:
+                get_db_session().remove()
+            self.stopping.wait(self.interval)
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        self.join(timeout)
@@ -1,23 +1,21 @@
 import csv
 
-from storeify.db import get_db_session
-from storeify.models import Product, Base
+from storeify.repository import get_repository
 
 
 def load_test_data(filepath):
+    repository = get_repository()
     with open(filepath) as csvf:
         # Open file and skip header row
         reader = csv.reader(csvf, delimiter=',', quotechar='"')
         next(reader)
 
-        for row in reader:
-            new_product = Product(
-                title=row[0],
-                price=row[1],
-                currency=row[2],
-                inventory_count=row[3],
-                can_purchase=bool(int(row[4]))
-            )
-
-            get_db_session().add(new_product)
-        get_db_session().commit()
+        with repository.transaction():
+            for row in reader:
+                repository.create_product(
+                    title=row[0],
+                    price=row[1],
+                    currency=row[2],
+                    inventory_count=row[3],
+                    can_purchase=bool(int(row[4]))
+                )
@@ -0,0 +1,185 @@
+import time
+from itertools import chain
+
+from flask import Response, request, stream_with_context
+from flask_graphql import GraphQLView
+from graphql import GraphQLError
+from graphql_server import HttpQueryError, get_graphql_params
+
+from storeify.admission import pool_for
+from storeify.backend import document_backend
+from storeify.config import Config
+from storeify.encoding import json_encode
+from storeify.incremental import MULTIPART_CONTENT_TYPE, \
+    IncrementalExecution, accepts_multipart, may_defer, multipart
+from storeify.loaders import Loaders
+from storeify.metrics import metrics, operation_label
+from storeify.profiling import ID_HEADER as PROFILE_ID_HEADER, start_profile
+from storeify.repository import get_repository
+from storeify.slow_queries import middleware as slow_query_middleware, \
+    operation_context
+
+
+class StoreifyGraphQLView(GraphQLView):
+    backend = document_backend
+    # A JSON array of operations is executed in order and answered with an
+    # array of results. All operations share the request's context, so one
+    # session and one set of loaders.
+    batch = True
+    encode = staticmethod(json_encode)
+    _data = None
+
+    @property
+    def schema(self):
+        # Flask instantiates the view per request, so storeify.schema is only
+        # imported and built once the first request comes in.
+        from storeify.schema import get_schema
+        return get_schema()
+
+    def parse_body(self):
+        # Parsed once per request: by the incremental path, the regular path
+        # and the request metrics alike
+        if self._data is not None:
+            return self._data
+        data = super(StoreifyGraphQLView, self).parse_body()
+        if isinstance(data, list) and \
+                len(data) > Config.GRAPHQL_MAX_BATCH_SIZE:
+            raise HttpQueryError(
+                413, 'Batch of %d operations exceeds the limit of %d.' % (
+                    len(data), Config.GRAPHQL_MAX_BATCH_SIZE))
+        self._data = data
+        return data
+
+    def get_middleware(self):
+        return slow_query_middleware()
+
+    def get_context(self):
+        return {
+            'request': request,
+            'repository': get_repository(),
+            'loaders': Loaders(),
+        }
+
+    def error_response(self, error):
+        """An HttpQueryError answered as GraphQLView answers it."""
+        return Response(self.encode({'errors': [self.format_error(error)]}),
+                        status=error.status_code, headers=error.headers,
+                        content_type='application/json')
+
+    def dispatch_request(self):
+        started = time.perf_counter()
+        try:
+            data = self.parse_body()
+        except HttpQueryError:
+            data = None
+        operation = operation_label(data)
+
+        pool = pool_for(self.schema, data, request.args)
+        release = None
+        if pool is not None:
+            try:
+                pool.acquire()
+            except HttpQueryError as error:
+                response = self.error_response(error)
+                metrics.observe_request(operation, str(error.status_code),
+                                        time.perf_counter() - started)
+                return response
+            admitted = time.perf_counter()
+
+            def release():
+                # The time spent executing, which the limit adapts to
+                pool.release(time.perf_counter() - admitted)
+
+        profile = start_profile(request)
+        try:
+            with operation_context(operation):
+                response = self.dispatch_incremental()
+                if response is not None and release is not None:
+                    # Still executing until its last part is sent
+                    response.call_on_close(release)
+                    release = None
+                response = response or \
+                    super(StoreifyGraphQLView, self).dispatch_request()
+        except BaseException:
+            if profile is not None:
+                profile.cancel()
+            raise
+        finally:
+            if release is not None:
+                release()
+        seconds = time.perf_counter() - started
+        if profile is not None:
+            profile_id = profile.finish(operation)
+            if profile_id is not None:
+                response.headers[PROFILE_ID_HEADER] = profile_id
+        metrics.observe_request(operation, str(response.status_code),
+                                seconds)
+        return response
+
+    def dispatch_incremental(self):
+        """
+        Answers an operation using @defer or @stream with a multipart/mixed
+        response (see storeify.incremental), if the client accepts one.
+        Returns None for everything else, including any request that would
+        fail, which the regular path answers.
+        """
+        if not accepts_multipart(request.accept_mimetypes) or \
+                request.method not in ('GET', 'POST'):
+            return None
+        try:
+            data = self.parse_body()
+        except HttpQueryError:
+            return None
+        if not isinstance(data, dict):
+            return None
+        try:
+            params = get_graphql_params(data, request.args)
+        except HttpQueryError:
+            return None
+        if not params.query or not may_defer(params.query):
+            return None
+        try:
+            document = self.get_backend().document_from_string(
+                self.schema, params.query)
+        except GraphQLError:
+            return None
+        if document.errors:
+            return None
+
+        try:
+            execution = IncrementalExecution(
+                self.schema, document.document_ast, self.get_root_value(),
+                self.get_context(), params.variables, params.operation_name,
+                self.get_middleware())
+        except GraphQLError:
+            return None
+        if not execution.deferring or (request.method == 'GET' and
+                                       execution.operation_type != 'query'):
+            return None
+
+        payloads = execution.payloads(self.format_error)
+        # The initial result is computed here, so that the request metrics
+        # time it; the rest is streamed after
+        payloads = chain([next(payloads)], payloads)
+        return Response(stream_with_context(multipart(payloads, self.encode)),
+                        content_type=MULTIPART_CONTENT_TYPE)
+
+
+def warm_up(operations=None):
+    """
+    Builds the schema, opens a storage connection and parses and validates
+    every known operation so that the first real request pays none of it.
+    Raises ValueError if any operation does not validate.
+    """
+    from storeify.schema import get_schema
+    schema = get_schema()
+
+    if operations is None:
+        operations = Config.WARMUP_OPERATIONS
+    for operation in operations:
+        document = document_backend.document_from_string(schema, operation)
+        if document.errors:
+            raise ValueError('Warm-up operation is invalid: %s' % (
+                '; '.join(str(e) for e in document.errors)))
+
+    get_repository().ping()
@@ -0,0 +1,155 @@
+import os
+
+import pytest
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from storeify import catalog
+from storeify import db
+from storeify import repository
+from storeify import sharding
+from storeify import util
+from storeify.app import create_app
+from storeify.config import Config
+from storeify.memory import MemoryRepository
+
+PRODUCTS_CSV = os.path.join(os.path.dirname(__file__), 'products.csv')
+STORAGE_BACKENDS = ('sqlalchemy', 'memory', 'sharded')
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'sqlalchemy_only: the test inspects the SQL backend, so '
+        'it does not run against the memory or sharded ones')
+
+
+def pytest_generate_tests(metafunc):
+    # Every test using app_client runs once per storage backend
+    if 'storage_backend' in metafunc.fixturenames:
+        backends = STORAGE_BACKENDS
+        if metafunc.definition.get_closest_marker('sqlalchemy_only'):
+            backends = ('sqlalchemy', )
+        metafunc.parametrize('storage_backend', backends, indirect=True)
+
+
+@pytest.fixture(scope='session')
+def database():
+    """
+    One in-memory database per test process (so every pytest-xdist worker
+    has its own), created and loaded with the test products once. Tests run
+    against its single connection inside a transaction that is rolled back.
+    """
+    Config.DATABASE_URI = 'sqlite://'
+    engine = create_engine(Config.DATABASE_URI, convert_unicode=True,
+                           poolclass=StaticPool,
+                           connect_args={'check_same_thread': False})
+
+    # pysqlite issues BEGIN itself and breaks SAVEPOINT; let SQLAlchemy do it
+    @event.listens_for(engine, 'connect')
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def emit_begin(connection):
+        connection.execute('BEGIN')
+
+    connection = engine.connect()
+    db.create_db(connection)
+    db.init_db_session(lambda: Session(bind=connection))
+    util.load_test_data(PRODUCTS_CSV)
+    db.get_db_session().remove()
+
+    yield connection
+
+    connection.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def db_transaction(database):
+    """
+    Runs the test inside a transaction on the shared connection. Sessions
+    work in a SAVEPOINT that is reopened whenever the code under test commits
+    or rolls back, and everything is rolled back once the test ends.
+    """
+    transaction = database.begin()
+
+    def session_factory():
+        session = Session(bind=database)
+        session.begin_nested()
+
+        @event.listens_for(session, 'after_transaction_end')
+        def restart_savepoint(session, ended):
+            if ended.nested and not ended._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        return session
+
+    db.init_db_session(session_factory)
+    catalog.reset_catalog_index()
+
+    yield database
+
+    db.get_db_session().remove()
+    transaction.rollback()
+    catalog.reset_catalog_index()
+
+
+@pytest.fixture
+def memory_store(monkeypatch):
+    """A fresh in-memory store loaded with the test products."""
+    monkeypatch.setattr(Config, 'STORAGE_BACKEND', 'memory')
+    store = MemoryRepository()
+    repository.init_repository(store)
+    util.load_test_data(PRODUCTS_CSV)
+
+    yield store
+
+    repository.init_repository()
+
+
+@pytest.fixture
+def sharded_database(tmp_path, monkeypatch):
+    """
+    A catalog and two cart shards in fresh SQLite files, loaded with the test
+    products.
+    """
+    monkeypatch.setattr(Config, 'DATABASE_URI',
+                        'sqlite:///%s' % tmp_path.joinpath('catalog.db'))
+    monkeypatch.setattr(Config, 'SHARD_URIS', [
+        'sqlite:///%s' % tmp_path.joinpath('shard%d.db' % number)
+        for number in range(2)])
+    saved_session = db.db_session
+    db.dispose_db_engine()
+    db.create_db()
+    repository.init_repository()
+    catalog.reset_catalog_index()
+    util.load_test_data(PRODUCTS_CSV)
+    db.get_db_session().remove()
+
+    yield repository.get_repository()
+
+    db.dispose_db_engine()
+    db.db_session = saved_session
+    repository.init_repository()
+    catalog.reset_catalog_index()
+
+
+@pytest.fixture
+def storage_backend(request):
+    if request.param == 'memory':
+        request.getfixturevalue('memory_store')
+    elif request.param == 'sharded':
+        request.getfixturevalue('sharded_database')
+    else:
+        repository.init_repository()
+        request.getfixturevalue('db_transaction')
+    return request.param
+
+
+@pytest.fixture
+def app_client(storage_backend):
+    yield create_app()
@@ -1,29 +1,39 @@
+import gzip
+import json
 import os
-import tempfile
+import pstats
+import socket
+import struct
+import threading
 
 from collections import OrderedDict
 
 import pytest
 
 from graphene.test import Client
-
-from storeify import util
+from graphql_server import HttpQueryError
+from sqlalchemy import event
+from sqlalchemy.orm.exc import StaleDataError
+
+from storeify import admission
+from storeify import catalog
+from storeify import concurrency
+from storeify import pricing
+from storeify import repository
 from storeify import db
+from storeify import idempotency
 from storeify import schema
-from storeify.app import create_app
+from storeify import sharding
+from storeify import slow_queries
+from storeify import subscriptions
+from storeify import sweeper
 from storeify.config import Config
-
-@pytest.fixture
-def app_client():
-    # db_path = tempfile.mkstemp()[1]
-    db_path = "testdb.sqlite3"
-    Config.DATABASE_URI = "sqlite:///"+db_path
-    app = create_app()
-    db.reset_db()
-    db.create_db()
-    db.init_db_engine()
-    util.load_test_data('test/products.csv')
-    yield app_client
+from storeify.currency import Currency as CurrencyClass, convert, currency_code
+from storeify.models import Cart as CartModel, CartItem as CartItemModel, Order as OrderModel, Product as ProductModel, unix_time
+from storeify.models import ExchangeRate as ExchangeRateModel
+from storeify.models import IdempotencyKey as IdempotencyKeyModel
+from storeify.memory import MemoryRepository
+from storeify.view import warm_up
 
 def create_cart(client, currency="USD"):
     query = '''
@@ -870,4 +880,1103 @@ def test_purchase_empty_cart(app_client):
         ''' % cartID
     executed = client.execute(query)
     print(executed)
-    assert executed['errors'][0]['message'] == 'Cart cannot be purchased. It is empty.'
\ No newline at end of file
+    assert executed['errors'][0]['message'] == 'Cart cannot be purchased. It is empty.'
+
+
+def test_warm_up_validates_operations(app_client):
+    warm_up(['query{ products { id title } }'])
+    with pytest.raises(ValueError):
+        warm_up(['query{ products { doesNotExist } }'])
+
+def test_products_sort_and_price_range(app_client):
+    client = Client(schema.schema)
+    query = '''
+        query{
+            products(priceMinimum:500, priceMaximum:10000, sort:PRICE_DESC, first:2){
+                title
+            }
+        }
+        '''
+    executed = client.execute(query)
+    assert [p['title'] for p in executed['data']['products']] == ['Whiteboard', 'Lightbulb']
+
+@pytest.mark.sqlalchemy_only
+def test_products_catalog_index_matches_sql(app_client):
+    pytest.importorskip('numpy')
+    client = Client(schema.schema)
+    queries = [
+        # Not an integer key: no match rather than an error
+        'products(id:"%s"){ id title }' % schema.encode_id('Product', 'abc'),
+        'products(inventoryMinimum:1){ id title }',
+        'products(canPurchase:true, sort:INVENTORY_COUNT){ id title }',
+        'products(currency:USD, sort:PRICE, offset:1){ id title }',
+        'products(title:"Glasses"){ id title }',
+    ]
+    expected = [client.execute('query{ %s }' % q) for q in queries]
+    assert expected[0] == {'data': {'products': []}}
+    Config.CATALOG_INDEX = True
+    try:
+        for q, sql_result in zip(queries, expected):
+            assert client.execute('query{ %s }' % q) == sql_result
+
+        # The index follows committed product changes
+        productID = sql_result['data']['products'][0]['id']
+        client.execute('''
+            mutation{ productUpdate(id:"%s", inventoryCount:0){ ok } }
+            ''' % productID)
+        executed = client.execute('query{ products(inventoryMinimum:1){ id } }')
+        assert productID not in [p['id'] for p in executed['data']['products']]
+    finally:
+        Config.CATALOG_INDEX = False
+
+@pytest.mark.sqlalchemy_only
+def test_products_catalog_index_sorts_wide_prices(app_client):
+    pytest.importorskip('numpy')
+    session = db.get_db_session()
+    session.query(ProductModel).filter(ProductModel.title == 'Whiteboard').update({'price': 2 ** 31})
+    session.query(ProductModel).filter(ProductModel.title == 'Lightbulb').update({'price': 2 ** 33})
+    session.commit()
+    client = Client(schema.schema)
+    queries = [
+        'products(sort:PRICE){ title }',
+        'products(sort:PRICE_DESC, first:2){ title }',
+    ]
+    expected = [client.execute('query{ %s }' % q) for q in queries]
+    assert [p['title'] for p in expected[1]['data']['products']] == ['Lightbulb', 'Whiteboard']
+    Config.CATALOG_INDEX = True
+    try:
+        for q, sql_result in zip(queries, expected):
+            assert client.execute('query{ %s }' % q) == sql_result
+    finally:
+        Config.CATALOG_INDEX = False
+
+@pytest.mark.sqlalchemy_only
+def test_cart_totals_match_per_line_conversion(app_client):
+    session = db.get_db_session()
+    carts = []
+    for currency in CurrencyClass:
+        cart = CartModel(userid=7, currency=str(currency.value))
+        for price in range(1, 300, 7):
+            for product_currency in ('USD', 'CAD', '2'):
+                product = ProductModel(title='P', price=price,
+                                       currency=product_currency,
+                                       inventory_count=1, can_purchase=True)
+                cart.cart_items.append(CartItemModel(product=product,
+                                                     quantity=3))
+        session.add(cart)
+        carts.append(cart)
+    session.commit()
+
+    totals = pricing.cart_totals(session, [cart.id for cart in carts])
+    for cart in carts:
+        expected = sum(
+            convert(currency_code(cart.currency).name + '/' +
+                    currency_code(item.product.currency).name,
+                    item.product.price) * item.quantity
+            for item in cart.cart_items)
+        assert totals[cart.id] == expected
+
+@pytest.mark.sqlalchemy_only
+def test_user_carts_totals_batched(app_client):
+    client = Client(schema.schema)
+    productID = client.execute(
+        'query{ products(title:"Whiteboard"){ id } }')['data']['products'][0]['id']
+    for currency in ('USD', 'CAD', 'EUR'):
+        cartID = create_cart(client, currency)[0]
+        add_item_to_cart(client, cartID, create_cart_item(client, productID, 2)[0])
+
+    statements = []
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = db.get_db_session().get_bind()
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        response = app_client.test_client().post(
+            '/graphql', data=json.dumps({'query': '{ carts(userid:1){ currency total } }'}),
+            content_type='application/json')
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+    carts = json.loads(response.data.decode())['data']['carts']
+    assert sorted((c['currency'], c['total']) for c in carts) == [
+        ('CAD', 13200), ('EUR', 20000), ('USD', 17600)]
+    assert len(statements) == 2
+
+@pytest.mark.sqlalchemy_only
+def test_product_price_in_currency(app_client):
+    client = Client(schema.schema)
+    query = '''
+        query{
+            products(title:"Whiteboard"){
+                price
+                cad: price(currency:CAD)
+                eur: price(currency:EUR)
+            }
+        }
+        '''
+    executed = client.execute(query)
+    assert executed['data']['products'][0] == {'price': 10000, 'cad': 6600, 'eur': 10000}
+
+    # New rates reprice existing products in bulk
+    updated = pricing.update_exchange_rates(db.get_db_session(), {('CAD', 'EUR'): 1.5},
+                                            chunk_size=2)
+    assert updated == 1
+    db.get_db_session().expire_all()
+    executed = client.execute(query)
+    assert executed['data']['products'][0]['cad'] == 15000
+    # and log the new prices
+    change = client.execute('query{ changes(after: 0, first: 1000){ entity operation fields } }')['data']['changes'][-1]
+    assert (change['entity'], change['operation'], json.loads(change['fields'])) == (
+        'product', 'update', {'price_usd': 8800, 'price_cad': 15000, 'price_eur': 10000})
+
+@pytest.mark.sqlalchemy_only
+def test_update_rates_command_rejects_bad_pairs(app_client):
+    runner = app_client.test_cli_runner()
+    session = db.get_db_session()
+    rates = sorted((r.base, r.quote, r.rate) for r in session.query(ExchangeRateModel))
+    # A valid rate is not written when another one is rejected
+    for bad in ['CAD/XYZ=1.5', 'CAD/EUR/USD=1.5', 'CAD=1.5', 'CAD/EUR=abc']:
+        result = runner.invoke(args=['update-rates', 'USD/CAD=2', bad])
+        assert result.exit_code == 2, bad
+        assert bad in result.output
+        session.expire_all()
+        assert sorted((r.base, r.quote, r.rate) for r in session.query(ExchangeRateModel)) == rates
+
+    result = runner.invoke(args=['update-rates', 'cad/eur=1.5'])
+    assert result.exit_code == 0 and 'Repriced 1 products.' in result.output
+    session.expire_all()
+    assert session.query(ExchangeRateModel).get(('CAD', 'EUR')).rate == 1.5
+
+def test_batched_operations(app_client):
+    client = app_client.test_client()
+    batch = [
+        {'query': 'query{ products(title:"Glasses"){ title } }'},
+        {'query': 'mutation{ cartCreate(userid:3, currency:USD, cartItems:[]){ ok } }'},
+        {'query': 'query Carts($userid:Int){ carts(userid:$userid){ total } }',
+         'variables': {'userid': 3}},
+    ]
+    response = client.post('/graphql', data=json.dumps(batch),
+                           content_type='application/json')
+    assert response.status_code == 200
+    assert json.loads(response.data.decode()) == [
+        {'data': {'products': [{'title': 'Glasses'}]}},
+        {'data': {'cartCreate': {'ok': True}}},
+        {'data': {'carts': [{'total': 0}]}},
+    ]
+
+    response = client.post('/graphql', data=json.dumps(batch * 4),
+                           content_type='application/json')
+    assert response.status_code == 413
+
+def test_large_responses_are_compressed(app_client):
+    client = app_client.test_client()
+    body = json.dumps({'query': 'query{ products{ id title price currency inventoryCount } }'})
+    plain = client.post('/graphql', data=body, content_type='application/json')
+    assert 'Content-Encoding' not in plain.headers
+
+    Config.COMPRESSION_MIN_SIZE, min_size = 100, Config.COMPRESSION_MIN_SIZE
+    try:
+        compressed = client.post('/graphql', data=body, content_type='application/json',
+                                 headers={'Accept-Encoding': 'gzip'})
+    finally:
+        Config.COMPRESSION_MIN_SIZE = min_size
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(compressed.data).decode()) == \
+        json.loads(plain.data.decode())
+
+@pytest.mark.sqlalchemy_only
+def test_add_items_statement_count_is_constant(app_client):
+    client = Client(schema.schema)
+    session = db.get_db_session()
+    product = session.query(ProductModel).filter_by(title='Cat Food').one()
+
+    def add_items(count):
+        cartID = create_cart(client)[0]
+        items = [CartItemModel(product=product, quantity=1) for _ in range(count)]
+        session.add_all(items)
+        session.commit()
+        cartItemIDs = ', '.join('"%s"' % schema.encode_id('CartItem', str(item.id))
+                                for item in items)
+        statements = []
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+        bind = session.get_bind()
+        event.listen(bind, 'before_cursor_execute', count_statement)
+        try:
+            executed = client.execute('''
+                mutation{ cartAddItems(cartID:"%s", cartItems:[%s]){ ok } }
+                ''' % (cartID, cartItemIDs))
+        finally:
+            event.remove(bind, 'before_cursor_execute', count_statement)
+        assert executed['data']['cartAddItems']['ok'] == True
+        assert session.query(CartItemModel).filter_by(
+            cart_id=schema.decode_id(cartID)).count() == count
+        return len(statements)
+
+    assert add_items(5) == add_items(200)
+
+@pytest.mark.sqlalchemy_only
+def test_set_cart_items_cart_groups_by_version(app_client, monkeypatch):
+    monkeypatch.setattr(repository, 'IN_CHUNK_SIZE', 2)
+    session = db.get_db_session()
+    product = session.query(ProductModel).first()
+    items = [CartItemModel(product=product, quantity=1) for _ in range(5)]
+    session.add_all(items)
+    session.commit()
+    table = CartItemModel.__table__
+    session.execute(table.update().where(table.c.id.in_([items[1].id, items[3].id])).values(version=2))
+    session.commit()
+    cartID = int(schema.decode_id(create_cart(Client(schema.schema))[0]))
+
+    statements = []
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+    bind = session.get_bind()
+    event.listen(bind, 'before_cursor_execute', count_statement)
+    try:
+        repository.set_cart_items_cart(session, items, cartID)
+    finally:
+        event.remove(bind, 'before_cursor_execute', count_statement)
+    # Three items at version 1 and two at version 2, two ids per statement
+    updates = [statement for statement in statements if statement.startswith('UPDATE')]
+    assert len(updates) == 3
+    assert all(' OR ' not in statement for statement in updates)
+    session.expire_all()
+    assert [(item.cart_id, item.version) for item in items] == [(cartID, 2 + index % 2) for index in range(5)]
+
+    # Items loaded at an older version are not moved
+    stale = CartItemModel(id=items[0].id, version=1)
+    with pytest.raises(StaleDataError):
+        repository.set_cart_items_cart(session, [stale, items[1]], None)
+
+def test_remove_item_not_in_cart(app_client):
+    client = Client(schema.schema)
+    cartID = create_cart(client)[0]
+    productID = client.execute(
+        'query{ products(title:"Glasses"){ id } }')['data']['products'][0]['id']
+    cartItemID = create_cart_item(client, productID, 1)[0]
+    executed = client.execute('''
+        mutation{ cartRemoveItems(cartID:"%s", cartItems:["%s"]){ ok } }
+        ''' % (cartID, cartItemID))
+    assert executed['errors'][0]['message'] == 'CartItem "%s" is not in the cart.' % cartItemID
+
+def purchase_cart(client, currency, items):
+    cartID = create_cart(client, currency)[0]
+    for title, quantity in items:
+        productID = client.execute(
+            'query{ products(title:"%s"){ id } }' % title)['data']['products'][0]['id']
+        add_item_to_cart(client, cartID, create_cart_item(client, productID, quantity)[0])
+    return client.execute('''
+        mutation{
+            cartPurchase(cartID:"%s"){
+                ok
+                order{ id currency total lines{ productId quantity unitPrice currency total } }
+            }
+        }
+        ''' % cartID)
+
+@pytest.mark.sqlalchemy_only
+def test_purchase_records_order(app_client):
+    client = Client(schema.schema)
+    executed = purchase_cart(client, "CAD", [("Whiteboard", 5), ("Glasses", 1)])
+    order = executed['data']['cartPurchase']['order']
+    assert order['currency'] == 'CAD'
+    assert order['total'] == 93000
+    assert [dict(line) for line in order['lines']] == [
+        {'productId': 3, 'quantity': 5, 'unitPrice': 10000, 'currency': 'EUR', 'total': 33000},
+        {'productId': 5, 'quantity': 1, 'unitPrice': 80000, 'currency': 'USD', 'total': 60000},
+    ]
+
+    with pytest.raises(ValueError):
+        session = db.get_db_session()
+        session.query(OrderModel).first().total = 1
+        session.flush()
+
+def test_orders_keyset_pagination(app_client):
+    client = Client(schema.schema)
+    for _ in range(3):
+        purchase_cart(client, "USD", [("Cat Food", 1)])
+
+    executed = client.execute('query{ orders(userid:1, first:2){ id total } }')
+    page = executed['data']['orders']
+    assert len(page) == 2
+    executed = client.execute(
+        'query{ orders(userid:1, first:2, after:"%s"){ id } }' % page[-1]['id'])
+    assert len(executed['data']['orders']) == 1
+    assert executed['data']['orders'][0]['id'] not in [o['id'] for o in page]
+
+def test_sales_rollups(app_client):
+    client = Client(schema.schema)
+    purchase_cart(client, "CAD", [("Whiteboard", 5), ("Glasses", 1)])
+    purchase_cart(client, "CAD", [("Cat Food", 10)])
+    purchase_cart(client, "USD", [("Cat Food", 2), ("Whiteboard", 1)])
+
+    query = '''
+        query{
+            topProducts(limit:2){ units product{ title } }
+            cad: revenue(currency:CAD)
+            usd: revenue(currency:USD)
+            future: revenue(currency:CAD, since:"2999-01-01")
+        }
+        '''
+    executed = client.execute(query)
+    assert [(p['product']['title'], p['units']) for p in executed['data']['topProducts']] == [
+        ('Cat Food', 12), ('Whiteboard', 6)]
+    assert executed['data']['cad'] == 93000 + 3750
+    assert executed['data']['usd'] == 1000 + 8800
+    assert executed['data']['future'] == 0
+
+    # A rebuild from the ledger gives the same figures
+    repository.get_repository().rebuild_rollups()
+    assert client.execute(query) == executed
+
+@pytest.mark.sqlalchemy_only
+def test_sweeper_reclaims_orphans_and_abandoned_carts(app_client):
+    client = Client(schema.schema)
+    productID = client.execute('query{ products(title:"Cat Food"){ id } }')['data']['products'][0]['id']
+    orphans = [create_cart_item(client, productID, 1)[0] for _ in range(3)]
+    abandonedID = create_cart(client)[0]
+    add_item_to_cart(client, abandonedID, create_cart_item(client, productID, 1)[0])
+    purchase_cart(client, "USD", [("Cat Food", 1)])
+
+    session = db.get_db_session()
+    carts = session.query(CartModel).count()
+    cart_items = session.query(CartItemModel).count()
+
+    # Nothing is old enough yet
+    assert sweeper.sweep(session, delay=0) == (0, 0)
+
+    changes = 'query{ changes(after: %d, first: 1000){ seq entity entityId operation } }'
+    cursor = max([0] + [change['seq'] for change in client.execute(changes % 0)['data']['changes']])
+    abandoned_items = [item.id for item in CartModel.query.get(schema.decode_id(abandonedID)).cart_items]
+    before = sweeper.stats.as_dict()
+    later = CartModel.query.get(schema.decode_id(abandonedID)).updated_at + Config.SWEEPER_CART_MAX_AGE + 1
+    assert sweeper.sweep(session, now=later, batch_size=2, delay=0) == (3, 1)
+    # The deletes are logged
+    assert sorted((change['entity'], change['entityId'], change['operation'])
+                  for change in client.execute(changes % cursor)['data']['changes']) == sorted(
+        [('cartitem', schema.decode_id(orphan), 'delete') for orphan in orphans] +
+        [('cartitem', str(id), 'delete') for id in abandoned_items] +
+        [('cart', schema.decode_id(abandonedID), 'delete')])
+    assert session.query(CartModel).count() == carts - 1
+    assert session.query(CartItemModel).count() == cart_items - 4
+    assert all(client.execute('query{ cartItem(id:"%s"){ id } }' % orphan)['data']['cartItem'] is None
+               for orphan in orphans)
+    assert client.execute('query{ cart(id:"%s"){ id } }' % abandonedID)['data']['cart'] is None
+
+    after = sweeper.stats.as_dict()
+    assert after['cart_items_deleted'] - before['cart_items_deleted'] == 3
+    assert after['carts_deleted'] - before['carts_deleted'] == 1
+    assert after['batches'] - before['batches'] == 3
+
+@pytest.mark.sqlalchemy_only
+def test_sweeper_leaves_rows_changed_since_selected(app_client, monkeypatch):
+    client = Client(schema.schema)
+    productID = client.execute('query{ products(title:"Cat Food"){ id } }')['data']['products'][0]['id']
+    orphanID = create_cart_item(client, productID, 1)[0]
+    cartID = create_cart(client)[0]
+    add_item_to_cart(client, cartID, create_cart_item(client, productID, 1)[0])
+    session = db.get_db_session()
+    carts = session.query(CartModel).count()
+    cart_items = session.query(CartItemModel).count()
+
+    # Between the SELECT and the DELETE the orphan is added to the cart,
+    # and the cart is purchased
+    select_ids = sweeper._ids
+    def ids_then_change(db_session, table, condition, limit):
+        ids = select_ids(db_session, table, condition, limit)
+        if table is CartItemModel.__table__:
+            db_session.execute(table.update().where(table.c.id.in_(ids)).values(cart_id=int(schema.decode_id(cartID))))
+        else:
+            db_session.execute(table.update().where(table.c.id.in_(ids)).values(purchased_at=unix_time()))
+        return ids
+    monkeypatch.setattr(sweeper, '_ids', ids_then_change)
+
+    later = unix_time() + Config.SWEEPER_CART_MAX_AGE + Config.SWEEPER_CART_ITEM_MAX_AGE
+    assert sweeper.sweep(session, now=later, delay=0) == (0, 0)
+    assert session.query(CartModel).count() == carts
+    assert session.query(CartItemModel).count() == cart_items
+    assert client.execute('query{ cartItem(id:"%s"){ id } }' % orphanID)['data']['cartItem'] == {'id': orphanID}
+
+def test_product_update_expected_version(app_client):
+    client = Client(schema.schema)
+    executed = client.execute('query{ products(title:"Cat Food"){ id version } }')
+    product = executed['data']['products'][0]
+    query = '''
+        mutation{
+            productUpdate(id:"%s", inventoryCount:7, expectedVersion:%d){
+                ok
+                product{ inventoryCount version }
+            }
+        }
+        '''
+    executed = client.execute(query % (product['id'], product['version']))
+    assert executed['data']['productUpdate']['product'] == {
+        'inventoryCount': 7, 'version': product['version'] + 1}
+
+    # The client's copy is now stale
+    executed = client.execute(query % (product['id'], product['version']))
+    assert executed['errors'][0]['message'] == \
+        'Product "%s" was modified concurrently. Reload it and retry.' % product['id']
+
+@pytest.mark.sqlalchemy_only
+def test_conflicting_mutation_is_retried(app_client, monkeypatch):
+    monkeypatch.setattr(Config, 'CONFLICT_BACKOFF', 0)
+    client = Client(schema.schema)
+    productID = client.execute('query{ products(title:"Cat Food"){ id } }')['data']['products'][0]['id']
+    session = db.get_db_session()()
+    conflicts = []
+
+    # Another writer updates the product between our read and our flush,
+    # on each of the first two attempts
+    def concurrent_write(session, flush_context, instances):
+        if len(conflicts) < 2:
+            conflicts.append(1)
+            session.connection().execute(
+                'UPDATE product SET version = version + 1 WHERE id = %s' % schema.decode_id(productID))
+
+    before = concurrency.stats.as_dict().get('ProductUpdate', {})
+    event.listen(session, 'before_flush', concurrent_write)
+    try:
+        executed = client.execute('''
+            mutation{ productUpdate(id:"%s", inventoryCount:3){ ok product{ inventoryCount } } }
+            ''' % productID)
+    finally:
+        event.remove(session, 'before_flush', concurrent_write)
+    assert executed['data']['productUpdate'] == {'ok': True, 'product': {'inventoryCount': 3}}
+
+    after = concurrency.stats.as_dict()['ProductUpdate']
+    assert after['attempts'] - before.get('attempts', 0) == 3
+    assert after['conflicts'] - before.get('conflicts', 0) == 2
+    assert after['failures'] == before.get('failures', 0)
+
+def test_memory_snapshot_round_trip(memory_store, tmp_path):
+    client = Client(schema.schema)
+    purchase_cart(client, "CAD", [("Whiteboard", 5), ("Glasses", 1)])
+    cartID = create_cart(client, "EUR")[0]
+    productID = client.execute('query{ products(title:"Cat Food"){ id } }')['data']['products'][0]['id']
+    add_item_to_cart(client, cartID, create_cart_item(client, productID, 2)[0])
+    query = '''
+        query{
+            products(sort:PRICE){ id title price inventoryCount version }
+            carts(userid:1){ id currency total cartItems{ id quantity product{ title } } }
+            orders(userid:1){ id total lines{ productId quantity total } }
+            revenue(currency:CAD)
+            topProducts{ units product{ title } }
+        }
+        '''
+    before = client.execute(query)
+    assert 'errors' not in before
+
+    path = str(tmp_path / 'store.json')
+    memory_store.snapshot(path)
+    restored = MemoryRepository()
+    restored.restore(path)
+    repository.init_repository(restored)
+    assert client.execute(query) == before
+
+    # New rows are numbered after the restored ones
+    assert int(schema.decode_id(create_cart(client)[0])) == int(schema.decode_id(cartID)) + 1
+
+def test_sharding_routes_carts_by_userid(sharded_database):
+    client = Client(schema.schema)
+    productID = client.execute('query{ products(title:"Cat Food"){ id } }')['data']['products'][0]['id']
+    userids = {}
+    for userid in range(1, 10):
+        userids.setdefault(sharding.shard_for_userid(userid), userid)
+    assert sorted(userids) == ['shard0', 'shard1']
+
+    carts = {}
+    for shard_id, userid in userids.items():
+        executed = client.execute('mutation{ cartCreate(userid:%d, currency:USD, cartItems:[]){ cart{ id } } }' % userid)
+        carts[shard_id] = executed['data']['cartCreate']['cart']['id']
+        # Both shards number their rows from 1
+        assert schema.decode_id(carts[shard_id]) == '%s.1' % shard_id
+
+    # Items created for the cart's user stay where they are...
+    query = 'mutation{ cartItemCreate(productID:"%s", quantity:2, userid:%d){ cartItem{ id } } }'
+    ownedID = client.execute(query % (productID, userids['shard1']))['data']['cartItemCreate']['cartItem']['id']
+    assert schema.decode_id(ownedID).startswith('shard1.')
+    # ...while those created without a userid move to the cart's shard,
+    # keeping their IDs
+    unownedID = create_cart_item(client, productID, 1)[0]
+    assert schema.decode_id(unownedID).startswith('shard0.')
+
+    executed = client.execute('''
+        mutation{
+            cartAddItems(cartID:"%s", cartItems:["%s", "%s"]){
+                cart{ cartItems{ id quantity } total }
+            }
+        }
+        ''' % (carts['shard1'], ownedID, unownedID))
+    cart = executed['data']['cartAddItems']['cart']
+    assert sorted(cartItem['id'] for cartItem in cart['cartItems']) == sorted([ownedID, unownedID])
+    assert sorted(cartItem['quantity'] for cartItem in cart['cartItems']) == [1, 2]
+    assert client.execute('query{ cartItem(id:"%s"){ id quantity } }' % unownedID)['data']['cartItem'] == {'id': unownedID, 'quantity': 1}
+    # The copy's own row id is not an ID
+    moved = sharded_database.session.query(CartItemModel).set_shard('shard1').filter(CartItemModel.moved_from.isnot(None)).one()
+    assert moved.moved_from == schema.decode_id(unownedID)
+    movedID = schema.encode_id('CartItem', sharding.encode_key('shard1', moved.id))
+    assert client.execute('query{ cartItem(id:"%s"){ id } }' % movedID)['data']['cartItem'] is None
+    price = client.execute('query{ products(title:"Cat Food"){ price } }')['data']['products'][0]['price']
+    assert cart['total'] == price * 3
+
+    assert sharding.shard_stats() == {
+        'shard0': {'carts': 1, 'cart_items': 0, 'orphan_cart_items': 0},
+        'shard1': {'carts': 1, 'cart_items': 2, 'orphan_cart_items': 0},
+    }
+
+    # The sweeper covers every shard, logging the deletes under their keys
+    later = unix_time() + Config.SWEEPER_CART_MAX_AGE + 1
+    assert sweeper.sweep(now=later, delay=0) == (0, 2)
+    deleted = client.execute('query{ changes(after: 0, first: 1000){ entity entityId operation } }')['data']['changes']
+    assert sorted((change['entity'], change['entityId']) for change in deleted if change['operation'] == 'delete') == \
+        sorted([('cart', schema.decode_id(cartID)) for cartID in carts.values()] +
+               [('cartitem', schema.decode_id(cartItemID)) for cartItemID in (ownedID, unownedID)])
+    assert client.execute('query{ cart(id:"%s"){ id } }' % carts['shard0'])['data']['cart'] is None
+
+def test_sharding_remove_items_checks_the_shard(sharded_database):
+    client = Client(schema.schema)
+    productID = client.execute('query{ products(title:"Cat Food"){ id } }')['data']['products'][0]['id']
+    userids = {}
+    for userid in range(1, 10):
+        userids.setdefault(sharding.shard_for_userid(userid), userid)
+    carts = {}
+    for shard_id, userid in userids.items():
+        executed = client.execute('mutation{ cartCreate(userid:%d, currency:USD, cartItems:[]){ cart{ id } } }' % userid)
+        carts[shard_id] = executed['data']['cartCreate']['cart']['id']
+    query = 'mutation{ cartItemCreate(productID:"%s", quantity:2, userid:%d){ cartItem{ id } } }'
+    cartItemID = client.execute(query % (productID, userids['shard1']))['data']['cartItemCreate']['cartItem']['id']
+    add_item_to_cart(client, carts['shard1'], cartItemID)
+
+    # The carts share the row id 1, but the item is only in shard1's
+    executed = client.execute('mutation{ cartRemoveItems(cartID:"%s", cartItems:["%s"]){ ok } }' % (carts['shard0'], cartItemID))
+    assert executed['errors'][0]['message'] == 'CartItem "%s" is not in the cart.' % cartItemID
+    executed = client.execute('query{ cart(id:"%s"){ cartItems{ id } } }' % carts['shard1'])
+    assert executed['data']['cart']['cartItems'] == [{'id': cartItemID}]
+
+    # Orders keep the key of their cart, shard included
+    executed = client.execute('mutation{ cartPurchase(cartID:"%s"){ order{ cartId } } }' % carts['shard1'])
+    assert executed['data']['cartPurchase']['order']['cartId'] == schema.decode_id(carts['shard1'])
+
+def test_defer_and_stream_are_delivered_incrementally(app_client, monkeypatch):
+    monkeypatch.setattr(Config, 'GRAPHQL_STREAM_BATCH_SIZE', 2)
+    client = Client(schema.schema)
+    cartID = create_cart(client, "CAD")[0]
+    productID = client.execute('query{ products(title:"Whiteboard"){ id } }')['data']['products'][0]['id']
+    add_item_to_cart(client, cartID, create_cart_item(client, productID, 5)[0])
+
+    query = json.dumps({'query': '''
+        query($cart: ID!){
+            cart(id: $cart){
+                currency
+                ... @defer(label: "total"){ total }
+            }
+            products @stream(initialCount: 1){
+                title
+                ... on Product @defer{ inventoryCount }
+            }
+        }
+        ''', 'variables': {'cart': cartID}})
+    http = app_client.test_client()
+    response = http.post('/graphql', data=query, content_type='application/json',
+                         headers={'Accept': 'multipart/mixed; deferSpec=20220824, application/json'})
+    assert response.status_code == 200
+    assert response.mimetype == 'multipart/mixed'
+    body = response.data.decode()
+    assert body.endswith('\r\n-----\r\n')
+    parts = [json.loads(part.split('\r\n\r\n', 1)[1])
+             for part in body[:-len('\r\n-----\r\n')].split('\r\n---\r\n')[1:]]
+
+    assert parts[0] == {'data': {'cart': {'currency': 'CAD'}, 'products': [{'title': 'Cat Food'}]},
+                        'hasNext': True}
+    assert [part['hasNext'] for part in parts] == [True] * (len(parts) - 1) + [False]
+    incremental = [entry for part in parts[1:] for entry in part['incremental']]
+    assert {'data': {'total': 33000}, 'path': ['cart'], 'label': 'total'} in incremental
+    streamed = [entry for entry in incremental if 'items' in entry]
+    assert [entry['path'] for entry in streamed] == [['products', 1], ['products', 3]]
+    assert [len(entry['items']) for entry in streamed] == [2, 2]
+    inventory = sorted(entry['path'][1] for entry in incremental
+                       if entry.get('data', {}).keys() == {'inventoryCount'})
+    assert inventory == [0, 1, 2, 3, 4]
+
+    # Clients that don't accept multipart get everything at once
+    response = http.post('/graphql', data=query, content_type='application/json')
+    data = json.loads(response.data.decode())['data']
+    assert data['cart'] == {'currency': 'CAD', 'total': 33000}
+    assert len(data['products']) == 5 and 'inventoryCount' in data['products'][4]
+
+    # The read slot is held until the last part is sent
+    admission.reset()
+    response = http.post('/graphql', data=query, content_type='application/json', buffered=False,
+                         headers={'Accept': 'multipart/mixed; deferSpec=20220824, application/json'})
+    pool = admission.get_pool(admission.READ)
+    assert pool.in_flight == 1
+    assert b''.join(response.response).endswith(b'\r\n-----\r\n')
+    response.close()
+    assert pool.in_flight == 0
+
+
+def test_metrics_endpoint(app_client):
+    http = app_client.test_client()
+    query = json.dumps({'query': 'query MetricsProbe { products { title } }'})
+    response = http.post('/graphql', data=query, content_type='application/json')
+    assert response.status_code == 200
+
+    response = http.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    samples = dict(line.rsplit(' ', 1) for line in response.data.decode().splitlines()
+                   if not line.startswith('#'))
+    assert int(samples['storeify_graphql_requests_total{operation="MetricsProbe",status="200"}']) >= 1
+    assert int(samples['storeify_graphql_request_duration_seconds_count{operation="MetricsProbe"}']) >= 1
+    assert int(samples['storeify_graphql_request_duration_seconds_bucket{le="+Inf",operation="MetricsProbe"}']) >= 1
+    assert 'storeify_cache_hit_ratio{cache="document"}' in samples
+    assert 'storeify_sweeper_runs_total' in samples
+
+
+def test_requests_are_profiled_on_demand(app_client, monkeypatch, tmp_path):
+    monkeypatch.setattr(Config, 'PROFILING_TOKEN', 'secret')
+    monkeypatch.setattr(Config, 'PROFILING_DIR', str(tmp_path))
+    monkeypatch.setattr(Config, 'PROFILING_MAX_PROFILES', 2)
+    http = app_client.test_client()
+
+    def post(name, **headers):
+        return http.post('/graphql', data=json.dumps({'query': 'query %s { products { title } }' % name}),
+                         content_type='application/json', headers=headers)
+
+    assert 'X-Profile-Id' not in post('Plain').headers
+    assert 'X-Profile-Id' not in post('Plain', **{'X-Profile': 'wrong'}).headers
+    first = post('First', **{'X-Profile': 'secret'}).headers['X-Profile-Id']
+    second = post('Second', **{'X-Profile': 'secret', 'X-Profile-Allocations': '1'}).headers['X-Profile-Id']
+    third = post('First', **{'X-Profile': 'secret'}).headers['X-Profile-Id']
+
+    assert http.get('/profiles').status_code == 404
+    listed = json.loads(http.get('/profiles', headers={'X-Profile': 'secret'}).data.decode())
+    assert [profile['id'] for profile in listed] == [third, second]
+    assert listed[1]['files'] == [second + '.prof', second + '.tracemalloc']
+    listed = json.loads(http.get('/profiles?operation=First', headers={'X-Profile': 'secret'}).data.decode())
+    assert [profile['id'] for profile in listed] == [third]
+    assert http.get('/profiles/%s.prof' % first, headers={'X-Profile': 'secret'}).status_code == 404
+
+    response = http.get('/profiles/%s.prof' % third, headers={'X-Profile': 'secret'})
+    assert response.status_code == 200
+    download = tmp_path / 'download.prof'
+    download.write_bytes(response.data)
+    stats = pstats.Stats(str(download))
+    assert any(function == 'dispatch_request' for _, _, function in stats.stats)
+
+
+@pytest.mark.sqlalchemy_only
+def test_slow_queries_are_logged_with_their_plan(app_client, monkeypatch, caplog):
+    monkeypatch.setattr(Config, 'SLOW_QUERY_THRESHOLD', 0)
+    monkeypatch.setattr(Config, 'PROFILING_TOKEN', 'secret')
+    slow_queries.install()
+    slow_queries.reset()
+    http = app_client.test_client()
+    query = json.dumps({'query': 'query SlowProbe { products(title: "Whiteboard") { title } }'})
+    assert http.post('/graphql', data=query, content_type='application/json').status_code == 200
+    assert http.post('/graphql', data=query, content_type='application/json').status_code == 200
+
+    report = json.loads(http.get('/slow-queries', headers={'X-Profile': 'secret'}).data.decode())
+    products = [entry for entry in report if entry['statement'].startswith('SELECT product.')]
+    assert len(products) == 1
+    assert products[0]['count'] == 2
+    assert products[0]['operation'] == 'SlowProbe' and products[0]['path'] == 'products'
+    assert 'product.title = ?' in products[0]['statement']
+    assert any('product' in step for step in products[0]['plan'])
+    assert any('Slow query' in record.getMessage() and 'SlowProbe' in record.getMessage()
+               for record in caplog.records)
+    assert http.get('/slow-queries').status_code == 404
+    slow_queries.reset()
+
+
+def test_slow_query_normalization():
+    assert slow_queries.normalize("SELECT a FROM t\n WHERE id IN (?, ?, ?) AND name = 'x' LIMIT 10") == \
+        'SELECT a FROM t WHERE id IN (?, ...) AND name = ? LIMIT ?'
+    assert slow_queries.normalize('SELECT anon_1.price_usd FROM t WHERE id = %(id_1)s') == \
+        'SELECT anon_1.price_usd FROM t WHERE id = ?'
+
+
+class WebSocketClient(object):
+    """A bare graphql-transport-ws client, masking its frames as clients must."""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.sock.sendall(('GET /graphql HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n'
+                           'Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                           'Sec-WebSocket-Version: 13\r\nSec-WebSocket-Protocol: graphql-transport-ws\r\n\r\n').encode())
+        response = b''
+        while not response.endswith(b'\r\n\r\n'):
+            response += self.sock.recv(1)
+        self.handshake = response.decode()
+
+    def send(self, message):
+        payload = json.dumps(message).encode()
+        mask = os.urandom(4)
+        header = struct.pack('!BB', 0x81, 0x80 | 126) + struct.pack('!H', len(payload)) \
+            if len(payload) >= 126 else struct.pack('!BB', 0x81, 0x80 | len(payload))
+        self.sock.sendall(header + mask + bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload)))
+
+    def _exactly(self, size):
+        data = b''
+        while len(data) < size:
+            data += self.sock.recv(size - len(data))
+        return data
+
+    def receive(self):
+        first, second = self._exactly(2)
+        length = second & 0x7F
+        if length == 126:
+            length, = struct.unpack('!H', self._exactly(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', self._exactly(8))
+        payload = self._exactly(length)
+        if first & 0x0F == 0x8:
+            return {'close': struct.unpack('!H', payload[:2])[0]}
+        return json.loads(payload.decode())
+
+    def sync(self):
+        self.send({'type': 'ping'})
+        assert self.receive() == {'type': 'pong'}
+
+
+def test_inventory_subscriptions_over_websocket(memory_store, monkeypatch):
+    from storeify.app import create_app
+    from storeify.serve import QuietRequestHandler, WorkerServer
+    monkeypatch.setattr(Config, 'SUBSCRIPTION_COALESCE_WINDOW', 0.5)
+    server = WorkerServer('127.0.0.1', 0, create_app(), QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = Client(schema.schema)
+    listed = client.execute('query{ products{ id title inventoryCount } }')['data']['products']
+    products = dict((product['title'], product['id']) for product in listed)
+    cat_food_inventory = [product['inventoryCount'] for product in listed if product['title'] == 'Cat Food'][0]
+    try:
+        ws = WebSocketClient(server.port)
+        assert ws.handshake.startswith('HTTP/1.1 101')
+        assert 'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=' in ws.handshake
+        ws.send({'type': 'subscribe', 'id': '1', 'payload': {'query': 'subscription{ productUpdated{ title } }'}})
+        assert ws.receive() == {'close': 4401}
+
+        ws = WebSocketClient(server.port)
+        ws.send({'type': 'connection_init'})
+        assert ws.receive() == {'type': 'connection_ack'}
+        ws.send({'type': 'subscribe', 'id': 'stock', 'payload': {
+            'query': 'subscription($ids: [ID!]){ inventoryChanged(productIds: $ids){ '
+                     'productId inventoryCount deleted product{ title } } }',
+            'variables': {'ids': [products['Whiteboard']]}}})
+        ws.send({'type': 'subscribe', 'id': 'updates', 'payload': {
+            'query': 'subscription{ productUpdated{ title inventoryCount } }'}})
+        # Queries and mutations go to /graphql
+        ws.send({'type': 'subscribe', 'id': 'query', 'payload': {
+            'query': 'query{ product(id: "%s"){ title } }' % products['Whiteboard']}})
+        assert ws.receive() == {'type': 'error', 'id': 'query', 'payload': [{'message':
+            'Only subscriptions are taken over WebSocket; send queries and mutations to /graphql.'}]}
+        ws.sync()
+        # One thread delivers to every subscriber
+        assert [thread.name for thread in threading.enumerate()].count('storeify-subscriptions') == 1
+
+        # Rapid changes reach each subscription once, with the latest values
+        for count in (9, 8, 7):
+            client.execute('mutation{ productUpdate(id: "%s", inventoryCount: %d){ ok } }' % (
+                products['Whiteboard'], count))
+        client.execute('mutation{ productUpdate(id: "%s", title: "Kitten Food"){ ok } }' % products['Cat Food'])
+        received = sorted((ws.receive() for _ in range(3)), key=lambda message: (message['id'], json.dumps(message)))
+        assert received == [
+            {'type': 'next', 'id': 'stock', 'payload': {'data': {'inventoryChanged': {
+                'productId': products['Whiteboard'], 'inventoryCount': 7, 'deleted': False,
+                'product': {'title': 'Whiteboard'}}}}},
+            {'type': 'next', 'id': 'updates', 'payload': {'data': {'productUpdated': {
+                'title': 'Kitten Food', 'inventoryCount': cat_food_inventory}}}},
+            {'type': 'next', 'id': 'updates', 'payload': {'data': {'productUpdated': {
+                'title': 'Whiteboard', 'inventoryCount': 7}}}},
+        ]
+        ws.sync()
+
+        ws.send({'type': 'complete', 'id': 'stock'})
+        ws.sync()
+        client.execute('mutation{ productDelete(id: "%s"){ ok } }' % products['Whiteboard'])
+        client.execute('mutation{ productUpdate(id: "%s", inventoryCount: 3){ ok } }' % products['Cat Food'])
+        assert ws.receive()['payload'] == {'data': {'productUpdated': {'title': 'Kitten Food', 'inventoryCount': 3}}}
+
+        ws.send({'type': 'subscribe', 'id': 'updates', 'payload': {'query': 'subscription{ productUpdated{ title } }'}})
+        assert ws.receive() == {'close': 4409}
+
+        # Past the worker's limit, upgrades are refused
+        while subscriptions._open:
+            threading.Event().wait(0.01)
+        monkeypatch.setattr(Config, 'SUBSCRIPTION_MAX_CONNECTIONS', 1)
+        ws = WebSocketClient(server.port)
+        ws.send({'type': 'connection_init'})
+        assert ws.receive() == {'type': 'connection_ack'}
+        assert WebSocketClient(server.port).handshake.startswith('HTTP/1.0 503')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_mutations_append_to_change_log(app_client):
+    client = Client(schema.schema)
+
+    def changes(after, first=None):
+        query = 'query{ changes(after: %d%s){ seq entity entityId operation fields } }' % (
+            after, ', first: %d' % first if first else '')
+        return client.execute(query)['data']['changes']
+
+    def key(globalID):
+        return schema.decode_id(globalID)
+
+    cursor = max([change['seq'] for change in changes(0, 1000)] or [0])
+    created = client.execute('''mutation{ productCreate(title: "Stapler", price: 500, currency: USD,
+        inventoryCount: 10, canPurchase: true){ product{ id } } }''')['data']['productCreate']['product']['id']
+    client.execute('mutation{ productUpdate(id: "%s", inventoryCount: 9){ ok } }' % created)
+    cartItemID = client.execute('mutation{ cartItemCreate(productID: "%s", quantity: 2, userid: 1){ cartItem{ id } } }'
+                                % created)['data']['cartItemCreate']['cartItem']['id']
+    cartID = create_cart(client)[0]
+    add_item_to_cart(client, cartID, cartItemID)
+    # Failed mutations log nothing
+    assert client.execute('mutation{ cartPurchase(cartID: "%s"){ ok } }' % create_cart(client)[0]).get('errors')
+    assert client.execute('mutation{ cartPurchase(cartID: "%s"){ ok } }' % cartID)['data']['cartPurchase']['ok']
+
+    logged = changes(cursor)
+    assert [change['seq'] for change in logged] == sorted(change['seq'] for change in logged)
+    assert [(change['entity'], change['operation'], json.loads(change['fields'])) for change in logged] == [
+        ('product', 'create', {'title': 'Stapler', 'price': 500, 'currency': 0, 'inventory_count': 10,
+                               'can_purchase': True}),
+        ('product', 'update', {'inventory_count': 9}),
+        ('cartitem', 'create', {'product_id': key(created), 'quantity': 2, 'userid': 1}),
+        ('cart', 'create', {'userid': 1, 'currency': 0}),
+        ('cartitem', 'update', {'cart_id': key(cartID)}),
+        ('cart', 'create', {'userid': 1, 'currency': 0}),
+        ('product', 'update', {'inventory_count': 7}),
+        ('cart', 'update', {'purchased_at': json.loads(logged[-2]['fields'])['purchased_at']}),
+        ('order', 'create', {'userid': 1, 'cart_id': key(cartID), 'currency': 'USD', 'total': 1000}),
+    ]
+    assert [change['entityId'] for change in logged[:3]] == [key(created), key(created), key(cartItemID)]
+    # Tailed in batches from a cursor
+    assert changes(cursor, 4) == logged[:4]
+    assert changes(logged[3]['seq'], 4) == logged[4:8]
+
+    client.execute('mutation{ productDelete(id: "%s"){ ok } }' % created)
+    assert repository.get_repository().compact_changes(unix_time() + 1) > 0
+    compacted = [change for change in changes(cursor)
+                 if (change['entity'], change['entityId']) in (('product', key(created)), ('cartitem', key(cartItemID)))]
+    assert [(change['entity'], change['operation'], json.loads(change['fields'])) for change in compacted] == [
+        ('cartitem', 'create', {'product_id': key(created), 'quantity': 2, 'userid': 1, 'cart_id': key(cartID)}),
+        ('product', 'delete', {}),
+    ]
+
+
+def test_admission_control_sheds_load_per_pool(app_client, monkeypatch):
+    monkeypatch.setattr(Config, 'ADMISSION_WRITE_LIMIT', 1)
+    monkeypatch.setattr(Config, 'ADMISSION_WRITE_QUEUE_SIZE', 0)
+    admission.reset()
+    http = app_client.test_client()
+    mutation = 'mutation{ cartCreate(userid: 1, currency: USD, cartItems: []){ ok } }'
+
+    def post(query):
+        return http.post('/graphql', data=json.dumps({'query': query}), content_type='application/json')
+
+    try:
+        # A checkout holding the only write slot
+        write = admission.get_pool(admission.WRITE)
+        write.acquire()
+        try:
+            response = post(mutation)
+            assert response.status_code == 429
+            assert int(response.headers['Retry-After']) >= 1
+            assert json.loads(response.data)['errors'][0]['message'] == \
+                'Too many concurrent write requests; retry later.'
+            # Reads have a pool of their own
+            assert post('query{ products{ title } }').status_code == 200
+        finally:
+            write.release(0.01)
+        assert post(mutation).status_code == 200
+        assert 'storeify_admission_rejected_total{pool="write",reason="queue_full"} 1' in \
+            http.get('/metrics').data.decode().splitlines()
+    finally:
+        admission.reset()
+
+
+def test_admission_pool_queues_and_adapts_its_limit(monkeypatch):
+    monkeypatch.setattr(Config, 'ADMISSION_QUEUE_TIMEOUT', 0.05)
+    pool = admission.Pool('write', 1, 4, 1)
+    pool.acquire()
+    # Waiting requests time out with 503
+    with pytest.raises(HttpQueryError) as error:
+        pool.acquire()
+    assert error.value.status_code == 503
+    assert pool.rejected == {'queue_full': 0, 'timeout': 1}
+    # and otherwise get the slot once it is released
+    monkeypatch.setattr(Config, 'ADMISSION_QUEUE_TIMEOUT', 5)
+    waiter = threading.Thread(target=pool.acquire)
+    waiter.start()
+    while not pool.waiting:
+        pass
+    pool.release(0.01)
+    waiter.join()
+    assert (pool.in_flight, pool.waiting) == (1, 0)
+
+    # A full pool keeping its latency grows
+    pool.release(0.01)
+    assert pool.limit == 2
+    # and shrinks once its latency climbs, at most once per latency
+    pool.acquire()
+    pool.release(1.0)
+    assert pool.limit == 2 * Config.ADMISSION_BACKOFF
+    pool.acquire()
+    pool.release(1.0)
+    assert pool.limit == 2 * Config.ADMISSION_BACKOFF
+
+
+def test_idempotency_keys_replay_mutations(app_client):
+    client = Client(schema.schema)
+    http = app_client.test_client()
+    product = client.execute('query{ products(title: "Cat Food"){ id inventoryCount } }')['data']['products'][0]
+
+    def post(query, **headers):
+        return json.loads(http.post('/graphql', data=json.dumps({'query': query}),
+                                    content_type='application/json', headers=headers).data)
+
+    create_item = 'mutation{ cartItemCreate(productID: "%s", quantity: 2, userid: 1){ ok cartItem{ id quantity } } }' % \
+        product['id']
+    first = post(create_item, **{'Idempotency-Key': 'item-1'})['data']['cartItemCreate']
+    assert post(create_item, **{'Idempotency-Key': 'item-1'})['data']['cartItemCreate'] == first
+    assert post(create_item, **{'Idempotency-Key': 'item-2'})['data']['cartItemCreate'] != first
+    assert post(create_item)['data']['cartItemCreate'] != first
+
+    cartID = create_cart(client)[0]
+    add_item_to_cart(client, cartID, first['cartItem']['id'])
+    purchase = 'mutation{ cartPurchase(cartID: "%s", idempotencyKey: "purchase-1"){ ok order{ id total } } }' % cartID
+    purchased = client.execute(purchase)['data']['cartPurchase']
+    assert purchased['ok']
+    # Answered from the store, without taking inventory again
+    assert client.execute(purchase)['data']['cartPurchase'] == purchased
+    assert client.execute('query{ product(id: "%s"){ inventoryCount } }' % product['id'])['data']['product'] == \
+        {'inventoryCount': product['inventoryCount'] - 2}
+    # A retry without the key runs again
+    assert client.execute('mutation{ cartPurchase(cartID: "%s"){ ok } }' % cartID)['errors'][0]['message'] == \
+        'Cart has already been purchased.'
+    # Keys are per mutation
+    assert client.execute(
+        'mutation{ cartCreate(userid: 1, currency: USD, cartItems: [], idempotencyKey: "purchase-1"){ ok } }'
+    )['data']['cartCreate']['ok']
+
+
+def test_idempotency_keys_are_scoped_and_checked(app_client):
+    client = Client(schema.schema)
+    http = app_client.test_client()
+    productID = client.execute('query{ products(title: "Cat Food"){ id } }')['data']['products'][0]['id']
+
+    def post(body, **headers):
+        return json.loads(http.post('/graphql', data=json.dumps(body),
+                                    content_type='application/json', headers=headers).data)
+
+    # The header covers each aliased field on its own
+    create_items = {'query': 'mutation{ a: cartItemCreate(productID: "%s", quantity: 1){ cartItem{ id } } '
+                             'b: cartItemCreate(productID: "%s", quantity: 2){ cartItem{ id } } }' % (productID, productID)}
+    first = post(create_items, **{'Idempotency-Key': 'items'})['data']
+    assert first['a'] != first['b']
+    assert post(create_items, **{'Idempotency-Key': 'items'})['data'] == first
+
+    # but not the same field in two operations of a batch
+    create_item = {'query': 'mutation{ cartItemCreate(productID: "%s", quantity: 1){ cartItem{ id } } }' % productID}
+    executed = post([create_item, create_item], **{'Idempotency-Key': 'batch'})
+    assert executed[0]['data']['cartItemCreate']['cartItem']['id']
+    assert executed[1]['errors'][0]['message'] == \
+        'The Idempotency-Key header covers one cartItemCreate field per request; ' \
+        'alias the others or send idempotencyKey arguments.'
+
+    # A key sent again with other arguments is not replayed
+    create = 'mutation{ cartItemCreate(productID: "%s", quantity: %d, idempotencyKey: "reused"){ cartItem{ id } } }'
+    assert client.execute(create % (productID, 1))['data']['cartItemCreate']['cartItem']['id']
+    assert client.execute(create % (productID, 3))['errors'][0]['message'] == \
+        'The idempotency key was already used with other arguments.'
+
+
+def test_idempotent_duplicates_in_flight_wait_for_the_first(memory_store, monkeypatch):
+    product = memory_store.find_products(title='Cat Food')[0]
+    inventory = product.inventory_count
+    client = Client(schema.schema)
+    cartItemID = client.execute('mutation{ cartItemCreate(productID: "%s", quantity: 1, userid: 1){ cartItem{ id } } }' %
+                                schema.encode_id('Product', str(product.id)))['data']['cartItemCreate']['cartItem']['id']
+    cartID = create_cart(client)[0]
+    add_item_to_cart(client, cartID, cartItemID)
+
+    purchase_cart = memory_store.purchase_cart
+    started = threading.Event()
+
+    def slow_purchase_cart(cart):
+        started.set()
+        threading.Event().wait(0.2)
+        return purchase_cart(cart)
+    monkeypatch.setattr(memory_store, 'purchase_cart', slow_purchase_cart)
+
+    purchase = 'mutation{ cartPurchase(cartID: "%s", idempotencyKey: "k"){ ok order{ id } } }' % cartID
+    results = []
+    first = threading.Thread(target=lambda: results.append(Client(schema.schema).execute(purchase)))
+    first.start()
+    started.wait(5)
+    results.append(client.execute(purchase))
+    first.join()
+    assert results[0] == results[1]
+    assert results[0]['data']['cartPurchase']['ok']
+    assert product.inventory_count == inventory - 1
+
+
+@pytest.mark.sqlalchemy_only
+def test_sweeper_expires_idempotency_keys(app_client, monkeypatch):
+    monkeypatch.setattr(Config, 'IDEMPOTENCY_MAX_KEYS', 2)
+    store = repository.get_repository()
+    now = unix_time()
+    with store.transaction():
+        for key in ['expired', 'oldest', 'older', 'newest']:
+            store.store_result(key, 'cartPurchase', '{}')
+    session = db.get_db_session()
+    for record in session.query(IdempotencyKeyModel):
+        record.created_at = {'expired': now - Config.IDEMPOTENCY_KEY_TTL - 1, 'oldest': now - 3,
+                             'older': now - 2, 'newest': now - 1}[record.key]
+    session.commit()
+    assert store.stored_result('expired', 'cartPurchase') is None
+    assert store.stored_result('oldest', 'cartPurchase') == '{}'
+
+    sweeper.sweep(now=now, delay=0)
+    assert sorted(record.key for record in session.query(IdempotencyKeyModel)) == ['newest', 'older']
+
+
+@pytest.mark.sqlalchemy_only
+def test_expiring_many_idempotency_keys_keeps_statements_small(app_client):
+    session = db.get_db_session()
+    expired = unix_time() - Config.IDEMPOTENCY_KEY_TTL - 1
+    session.execute(IdempotencyKeyModel.__table__.insert(), [
+        dict(key='k%d' % index, operation='cartPurchase', result='{}', created_at=expired)
+        for index in range(1200)])
+    session.commit()
+
+    parameters = []
+    def count_parameters(conn, cursor, statement, params, *args):
+        if statement.startswith('DELETE'):
+            parameters.append(len(params))
+    bind = session.get_bind()
+    event.listen(bind, 'before_cursor_execute', count_parameters)
+    try:
+        assert idempotency.expire(session, batch_size=500) == 1200
+    finally:
+        event.remove(bind, 'before_cursor_execute', count_parameters)
+    assert parameters and max(parameters) <= repository.IN_CHUNK_SIZE
+    assert session.query(IdempotencyKeyModel).count() == 0
+
+
+@pytest.mark.sqlalchemy_only
+def test_primary_key_lookups_are_baked(app_client):
+    store = repository.get_repository()
+    session = db.get_db_session()
+    for model, get in ((ProductModel, store.get_product), (CartModel, store.get_cart),
+                       (CartItemModel, store.get_cart_item)):
+        for key in ('1', '2', '999', 'nope'):
+            assert get(key) is session.query(model).get(key)
+    # Compiled once per model, then reused
+    baked = len(repository.bakery.cache)
+    store.get_product('3')
+    store.get_cart('3')
+    assert len(repository.bakery.cache) == baked